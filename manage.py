@@ -1,5 +1,11 @@
 #!venv/bin/python
-import os
+import os, json
+
+# patch before the app is imported, see wsgi.py
+if os.environ.get('GEVENT'):
+    from gevent import monkey
+    monkey.patch_all()
+
 from project import create_app, db
 from flask_script import Manager, Shell
 from flask_migrate import Migrate, MigrateCommand
@@ -13,5 +19,230 @@ def make_shell_context():
 manager.add_command('shell', Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
 
+
+def _sizes(**sizes):
+    return dict((key, value) for key, value in sizes.items()
+                if value is not None)
+
+
+@manager.option('--providers', type=int)
+@manager.option('--payers', type=int)
+@manager.option('--members', type=int)
+@manager.option('--terminals', type=int, help='Terminals per provider')
+@manager.option('--doctors', type=int, help='Doctors per provider')
+@manager.option('--claims', type=int)
+@manager.option('--gops', type=int)
+@manager.option('--icd-codes', dest='icd_codes', type=int)
+@manager.option('--seed', type=int, default=1)
+def seed(providers, payers, members, terminals, doctors, claims, gops,
+         icd_codes, seed):
+    """Fills the current database with a synthetic dataset"""
+    from project import synthetic
+    ids = synthetic.generate(_sizes(providers=providers, payers=payers,
+                                    members=members, terminals=terminals,
+                                    doctors=doctors, claims=claims, gops=gops,
+                                    icd_codes=icd_codes), seed=seed)
+    print('Created %d members, %d claims. Log in as %s / %s' % (
+        len(ids['members']), len(ids['claims']), ids['logins']['admin'],
+        synthetic.PASSWORD))
+
+
+@manager.option('-o', '--output', default='benchmark.json',
+                help='Where to save the JSON report')
+@manager.option('-b', '--baseline', help='JSON report to compare with')
+@manager.option('-n', '--iterations', type=int, default=20)
+@manager.option('-s', '--scenario', dest='names', action='append',
+                help='Run only the given scenario (repeatable)')
+@manager.option('-d', '--database', help='Database URI, a temporary SQLite '
+                'file is used by default. The database is emptied, the one '
+                'with tables needs --drop-existing')
+@manager.option('--drop-existing', dest='drop_existing', action='store_true',
+                help='Drop the tables of the given database')
+@manager.option('--members', type=int)
+@manager.option('--claims', type=int)
+@manager.option('--icd-codes', dest='icd_codes', type=int)
+@manager.option('--seed', type=int, default=1)
+def benchmark(output, baseline, iterations, names, database, drop_existing,
+              members, claims, icd_codes, seed):
+    """Runs the benchmark suite on a synthetic dataset"""
+    from project import benchmark as suite
+    try:
+        report = suite.run(_sizes(members=members, claims=claims,
+                                  icd_codes=icd_codes),
+                           iterations=iterations, names=names,
+                           database_uri=database, seed=seed,
+                           drop_existing=drop_existing)
+    except ValueError as e:
+        print('Not run, %s, run it with --drop-existing' % e)
+        return 1
+
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+
+    for name, result in sorted(report['scenarios'].items()):
+        print('%-24s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  '
+              '%6.1f queries  %d errors' % (name, result['throughput_rps'],
+              result['latency_ms']['p50'], result['latency_ms']['p99'],
+              result['queries_per_request'], result['errors']))
+        if 'target_met' in result and not result['target_met']:
+            print('%-24s missed the %d ms p50 target' % (name,
+                                                         result['target_ms']))
+
+    for name, result in sorted(report.get('serializers', {}).items()):
+        print('serialize %-14s %8.0f rows/s  helpers %8.0f rows/s  '
+              '%.1fx' % (name, result['serializer_rows_per_s'],
+              result['helpers_rows_per_s'], result['speedup']))
+
+    if baseline:
+        with open(baseline) as fh:
+            for line in suite.compare(report, json.load(fh)):
+                print(line)
+
+
+@manager.option('-c', '--clients', type=int, default=100,
+                help='Simulated Socket.IO clients')
+@manager.option('-w', '--workers', type=int, default=20,
+                help='Concurrent HTTP clients loading the dashboard')
+@manager.option('-r', '--rounds', type=int, default=5,
+                help='Messages sent by every Socket.IO client')
+@manager.option('-n', '--requests', dest='requests_per_worker', type=int,
+                default=5, help='Requests sent by every HTTP client')
+@manager.option('--max-lag', dest='max_lag_ms', type=int, default=100,
+                help='The event loop lag allowed, in ms')
+@manager.option('-d', '--database', help='Database URI, a temporary SQLite '
+                'file is used by default. The database is emptied, the one '
+                'with tables needs --drop-existing')
+@manager.option('--drop-existing', dest='drop_existing', action='store_true',
+                help='Drop the tables of the given database')
+@manager.option('--members', type=int)
+@manager.option('--claims', type=int)
+def concurrency(clients, workers, rounds, requests_per_worker, max_lag_ms,
+                database, drop_existing, members, claims):
+    """Checks the gevent event loop stays responsive under load
+    (run with GEVENT=1)"""
+    from project import concurrency as check
+    try:
+        report = check.run(clients=clients, workers=workers, rounds=rounds,
+                           requests_per_worker=requests_per_worker,
+                           max_lag_ms=max_lag_ms,
+                           sizes=_sizes(members=members, claims=claims),
+                           database_uri=database,
+                           drop_existing=drop_existing)
+    except ValueError as e:
+        print('Not run, %s, run it with --drop-existing' % e)
+        return 1
+
+    for name in ('sockets', 'http'):
+        result = report[name]
+        print('%-8s p50 %8.2f ms  p99 %8.2f ms  %d errors' % (name,
+              result['latency_ms']['p50'] or 0, result['latency_ms']['p99']
+              or 0, result['errors']))
+    print('loop lag p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+          report['loop_lag_ms']['p50'], report['loop_lag_ms']['p99'],
+          report['loop_lag_ms']['max']))
+
+    if not report['responsive']:
+        print('The event loop was blocked for more than %d ms' % max_lag_ms)
+        return 1
+
+
+@manager.command
+def routing():
+    """Checks the read replica routing on two temporary SQLite files"""
+    from project.routing import run
+    checks = run()
+    for name, passed in checks:
+        print('%-50s %s' % (name, 'ok' if passed else 'FAILED'))
+
+    if not all(passed for name, passed in checks):
+        return 1
+
+
+@manager.option('-i', '--interval', type=float, default=0,
+                help='Seconds between the flushes, 0 flushes once')
+def flush_heartbeats(interval):
+    """Writes the terminals' latest heartbeats from redis to the database"""
+    import time
+    from project import heartbeats
+
+    while True:
+        print('%d terminals flushed' % heartbeats.flush())
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@manager.option('-a', '--months-ahead', dest='months_ahead', type=int,
+                default=3, help='The months partitioned in advance')
+@manager.option('-s', '--since', help='The first partitioned month, YYYY-MM, '
+                'the oldest row\'s month by default')
+@manager.option('-x', '--execute', action='store_true',
+                help='Run the statements instead of printing them')
+@manager.option('-f', '--drop-foreign-keys', dest='drop_foreign_keys',
+                action='store_true', help='Drop the foreign keys from and '
+                'to the tables, the first run needs it if they have any')
+def partition(months_ahead, since, execute, drop_foreign_keys):
+    """Partitions the claim and guarantee_of_payment tables by month
+    (MySQL only), run it monthly to add the months ahead. The first run
+    sets the rows without the date to 1970-01-01"""
+    from datetime import datetime
+    from project import lifecycle
+
+    if db.engine.name != 'mysql':
+        print('The partitioning needs MySQL, the database is %s' % \
+              db.engine.name)
+        return 1
+
+    if since:
+        since = datetime.strptime(since, '%Y-%m')
+
+    with db.engine.connect() as connection:
+        try:
+            statements = [statement
+                          for table in sorted(lifecycle.PARTITIONED)
+                          for statement in lifecycle.partition_statements(
+                            connection, table, months_ahead, since,
+                            drop_foreign_keys)]
+        except ValueError as e:
+            print('Not partitioned, %s, run it with --drop-foreign-keys' % e)
+            return 1
+
+        for statement in statements:
+            print(statement + ';')
+            if execute:
+                connection.execute(statement)
+
+
+@manager.option('-m', '--months', type=int,
+                help='Archive the claims older than that, '
+                'CLAIM_ARCHIVE_MONTHS by default')
+def archive_claims(months):
+    """Moves the old claims to the claim_archive table"""
+    from project import lifecycle
+    print('%d claims archived' % lifecycle.archive_claims(months))
+
+
+@manager.option('-r', '--reset', action='store_true',
+                help='Reset the counters after printing them')
+def transactions(reset):
+    """Prints the units of work's transaction counts and durations"""
+    from project.database import transaction_metrics
+
+    metrics = transaction_metrics(reset)
+    for name, counters in sorted(metrics.items()):
+        count = counters['count'] or 1
+        print('%-40s %7d tx  %5d failed  %5d slow  mean %8.2f ms  '
+              'writing %8.2f ms' % (name, counters['count'],
+              counters['failed'], counters['slow'], counters['ms'] / count,
+              counters['write_ms'] / count))
+
+
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int,
+                default=500, help='The members indexed per transaction')
+def reindex_members(chunk_size):
+    """Rebuilds the front desk lookup's index of the members"""
+    from project import lookup
+    print('%d members indexed' % lookup.reindex(chunk_size))
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
@@ -1,20 +1,22 @@
 from flask import Flask
-from flask import session, g
+from flask import request, g
 from flask_cors import CORS, cross_origin
 from flask_redis import FlaskRedis
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_login import current_user
 from flask_socketio import SocketIO
 from .config import config
 from flask_mail import Mail
-from datetime import timedelta
+from .database import RoutingSQLAlchemy
+from .profiler import Profiler
+from .sessions import RedisSessionInterface
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 mail = Mail()
 socketio = SocketIO()
 login_manager = LoginManager()
 redis_store = FlaskRedis()
+profiler = Profiler()
 login_manager.session_protection = 'strong'
 login_manager.login_view = 'auth.login'
 
@@ -25,19 +27,23 @@ def create_app(config_name):
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
 
-    # Auto Time Out After 60 Minutes For Session
+    # the sessions time out after PERMANENT_SESSION_LIFETIME of inactivity,
+    # the stateless API doesn't use them at all
+    if app.config['SESSION_REDIS']:
+        app.session_interface = RedisSessionInterface(
+            redis_store, stateless_blueprints=('api',))
+
     @app.before_request
     def before_request():
-        session.permanent = True
-        app.permanent_session_lifetime = timedelta(minutes=60)
-        session.modified = True
-        g.user = current_user
+        if request.blueprint != 'api':
+            g.user = current_user
 
     db.init_app(app)
     redis_store.init_app(app)
-    socketio.init_app(app)
+    socketio.init_app(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'])
     login_manager.init_app(app)
     mail.init_app(app)
+    profiler.init_app(app)
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
@@ -0,0 +1,192 @@
+"""GOP turnaround analytics. The turnaround of a guarantee of payment is the
+time from its creation to its last edit (or until now for the pending ones),
+see GuaranteeOfPayment.turnaround_time. The distributions per payer or
+provider are computed by the database: one grouped query returns the
+histogram of the turnarounds by the minute, so a year of GOPs is never
+loaded into Python. The reports are cached in redis for CACHE_TIMEOUT."""
+import json
+
+from datetime import datetime, timedelta
+from sqlalchemy import Integer, func, literal_column
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from . import db, models, redis_store
+
+# the seconds the reports are cached for
+CACHE_TIMEOUT = 600
+# the histogram's resolution, in seconds
+BUCKET_SIZE = 60
+DEFAULT_DAYS = 365
+
+GROUPS = {
+    'payer': (models.GuaranteeOfPayment.payer_id, models.Payer),
+    'provider': (models.GuaranteeOfPayment.provider_id, models.Provider)
+}
+
+
+class elapsed(FunctionElement):
+    """The whole number of "unit" seconds from "start" to "end",
+    e.g. elapsed(GOP.timestamp, GOP.timestamp_edited, 60) in minutes"""
+    type = Integer()
+    name = 'elapsed'
+
+    def __init__(self, start, end, unit=1):
+        self.unit = int(unit)
+        FunctionElement.__init__(self, start, end)
+
+
+@compiles(elapsed)
+def _elapsed(element, compiler, **kw):
+    start, end = [compiler.process(arg, **kw)
+                  for arg in element.clauses.clauses]
+    return 'FLOOR(EXTRACT(EPOCH FROM (%s - %s)) / %d)' % (end, start,
+                                                         element.unit)
+
+
+@compiles(elapsed, 'mysql')
+def _elapsed_mysql(element, compiler, **kw):
+    start, end = [compiler.process(arg, **kw)
+                  for arg in element.clauses.clauses]
+    return 'TIMESTAMPDIFF(SECOND, %s, %s) DIV %d' % (start, end,
+                                                     element.unit)
+
+
+@compiles(elapsed, 'sqlite')
+def _elapsed_sqlite(element, compiler, **kw):
+    start, end = [compiler.process(arg, **kw)
+                  for arg in element.clauses.clauses]
+    return 'CAST(ROUND((julianday(%s) - julianday(%s)) * 86400) / %d ' \
+           'AS INTEGER)' % (end, start, element.unit)
+
+
+def _percentile(histogram, count, percent):
+    # the bucket holding the percentile of the sorted (bucket, count) pairs
+    rank = percent / 100.0 * count
+    seen = 0
+    for bucket, bucket_count in histogram:
+        seen += bucket_count
+        if seen >= rank:
+            return bucket * BUCKET_SIZE
+    return histogram[-1][0] * BUCKET_SIZE if histogram else None
+
+
+def _hours(seconds):
+    return round(seconds / 3600.0, 2) if seconds is not None else None
+
+
+class _Distribution(object):
+    def __init__(self):
+        self.histogram = {}
+        self.count = 0
+        self.total = 0
+
+    def add(self, bucket, count, total):
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+        self.count += count
+        self.total += total or 0
+
+    def report(self):
+        histogram = sorted(self.histogram.items())
+        return {
+            'count': self.count,
+            'mean_hours': _hours(float(self.total) / self.count
+                                 if self.count else None),
+            'median_hours': _hours(_percentile(histogram, self.count, 50)),
+            'p90_hours': _hours(_percentile(histogram, self.count, 90))
+        }
+
+
+def _compute(by, days, payer_id, provider_id):
+    GOP = models.GuaranteeOfPayment
+    group_column, group_model = GROUPS[by]
+    now = datetime.now()
+    end = func.coalesce(GOP.timestamp_edited, now)
+
+    query = db.session.query(group_column, GOP.status, GOP.reason,
+                             elapsed(GOP.timestamp, end, BUCKET_SIZE)
+                             .label('bucket'),
+                             func.count(GOP.id),
+                             func.sum(elapsed(GOP.timestamp, end)))\
+                      .filter(GOP.timestamp >= now - timedelta(days=days))
+
+    if payer_id:
+        query = query.filter(GOP.payer_id == payer_id)
+    if provider_id:
+        query = query.filter(GOP.provider_id == provider_id)
+
+    # the bucket is grouped by its label, the expression has
+    # the bound "now" parameter
+    query = query.group_by(group_column, GOP.status, GOP.reason,
+                           literal_column('bucket'))
+
+    groups = {}
+    for group_id, status, reason, bucket, count, total in query:
+        group = groups.get(group_id)
+        if group is None:
+            group = groups[group_id] = (_Distribution(), {}, {})
+        overall, statuses, reasons = group
+        overall.add(bucket, count, total)
+        statuses.setdefault(status, _Distribution()).add(bucket, count, total)
+        reasons.setdefault(reason, _Distribution()).add(bucket, count, total)
+
+    names = {}
+    if groups:
+        names = dict(db.session.query(group_model.id, group_model.company)
+                               .filter(group_model.id.in_(
+                                   [group_id for group_id in groups
+                                    if group_id is not None])))
+
+    report = []
+    for group_id, (overall, statuses, reasons) in groups.items():
+        result = overall.report()
+        result.update(id=group_id, name=names.get(group_id),
+            statuses=dict((status, distribution.report())
+                          for status, distribution in statuses.items()),
+            reasons=dict((reason, distribution.report())
+                         for reason, distribution in reasons.items()))
+        report.append(result)
+
+    report.sort(key=lambda result: -result['count'])
+    return report
+
+
+def turnaround(by='payer', days=DEFAULT_DAYS, payer_id=None,
+               provider_id=None):
+    """Returns the turnaround distributions of the GOPs created in the last
+    "days" per payer or provider ("by"), the busiest first: the count,
+    mean, median and 90th percentile in hours overall, by status and by
+    reason. The percentiles are precise to BUCKET_SIZE seconds"""
+    if by not in GROUPS:
+        raise ValueError('"by" is either "payer" or "provider"')
+
+    key = 'turnaround:%s:%d:%s:%s' % (by, days, payer_id or '',
+                                      provider_id or '')
+    try:
+        cached = redis_store.get(key)
+        if cached:
+            return json.loads(cached.decode('utf-8')
+                              if isinstance(cached, bytes) else cached)
+    except Exception:
+        pass
+
+    report = _compute(by, days, payer_id, provider_id)
+
+    try:
+        redis_store.set(key, json.dumps(report), ex=CACHE_TIMEOUT)
+    except Exception:
+        pass
+
+    return report
+
+
+def turnaround_for_user(user, days=DEFAULT_DAYS):
+    """The payers' turnaround the user may see: every payer for the admins,
+    their own for the payers and the ones of their GOPs for the providers"""
+    if user.get_role() == 'admin':
+        return turnaround('payer', days)
+    if user.get_type() == 'payer' and user.payer:
+        return turnaround('payer', days, payer_id=user.payer.id)
+    if user.get_type() == 'provider' and user.provider:
+        return turnaround('payer', days, provider_id=user.provider.id)
+    return []
@@ -0,0 +1,595 @@
+"""Set-based bulk updates for the edit endpoints. The targeted rows are
+loaded with one IN query per chunk, every edit is diffed against its row
+and only the changed columns are written, with one executemany per set
+of changed columns."""
+from collections import Counter
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import and_, bindparam, select
+from werkzeug.security import generate_password_hash
+
+from .. import db, models
+from ..changes import key_columns, record
+from ..dates import DateParseError, parse_date, parse_datetime
+from .helpers import prepare_terminal_claim_dict
+from .helpers import resolve_terminals
+
+try:
+    from gevent import monkey
+    from gevent.threadpool import ThreadPool as OSThreadPool
+except ImportError:
+    monkey = OSThreadPool = None
+
+# the bound parameters per IN clause
+CHUNK_SIZE = 500
+# the IDs per range scan, used when the IDs are dense
+RANGE_SIZE = 5000
+# the threads hashing the passwords of a batch
+HASH_THREADS = 4
+# the claims per terminals' batch upload
+TERMINAL_BATCH_SIZE = 1000
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _greenlets():
+    # under gevent the patched threads are greenlets of one OS thread,
+    # they'd hash one by one and block the other requests meanwhile
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def hash_passwords(passwords, threads=HASH_THREADS):
+    """Hashes the passwords in a pool of threads, hashlib's pbkdf2
+    releases the GIL, so the threads hash in parallel. Under gevent they
+    are the real OS threads of gevent's pool, the request's greenlet
+    waits for them without blocking the hub"""
+    if _greenlets():
+        pool = OSThreadPool(max(1, min(threads, len(passwords))))
+        try:
+            return list(pool.map(generate_password_hash, passwords))
+        finally:
+            pool.kill()
+
+    if len(passwords) < 2:
+        return [generate_password_hash(password) for password in passwords]
+
+    pool = ThreadPool(min(threads, len(passwords)))
+    try:
+        return pool.map(generate_password_hash, passwords)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _id_filters(column, ids):
+    """Yields the filters selecting the rows with the given IDs (and maybe
+    some others): a BETWEEN for the dense runs of the IDs, which is much
+    cheaper to build and execute than an IN with thousands of parameters,
+    and the IN clauses for the rest"""
+    for chunk in _chunks(sorted(set(ids)), RANGE_SIZE):
+        if chunk[-1] - chunk[0] < 2 * len(chunk):
+            yield column.between(chunk[0], chunk[-1])
+        else:
+            for part in _chunks(chunk):
+                yield column.in_(part)
+
+
+class BulkUpdate(object):
+    """Applies the edits {id: {field: value}} to the model's rows.
+
+    "fields" are the editable fields, the other keys of an edit are
+    ignored. "parsers" maps the fields to the functions converting their
+    JSON values (raising ValueError), "columns" maps the fields stored
+    under another attribute, e.g. {'password': 'password_hash'}.
+    "required" are the fields which can't be emptied, "unique" the ones
+    which can't repeat, "compare" maps them to the SQL functions their
+    column is compared by (the existing values are parsed like the edited
+    ones then), "references" maps the foreign keys to the models
+    they refer to. "prepare" is called with the valid rows' changes before
+    they are diffed. The updates are recorded as the change events, with
+    the key columns the subscribers ask for (see changes.py)."""
+
+    def __init__(self, model, fields, parsers=None, columns=None,
+                 required=(), unique=(), compare=None, references=None,
+                 prepare=None):
+        self.model = model
+        self.fields = list(fields)
+        self.parsers = parsers or {}
+        self.columns = dict((field, field) for field in self.fields)
+        self.columns.update(columns or {})
+        self.required = required
+        self.unique = unique
+        self.compare = compare or {}
+        self.references = references or {}
+        self.prepare = prepare
+
+        self.fields_by_column = dict((column, field) for field, column
+                                     in self.columns.items())
+        self.table = model.__tablename__
+
+    def load(self, ids, names=None):
+        """Returns {id: {column: value}} of the existing rows, with the
+        given columns only (the edited and the key ones by default)"""
+        if names is None:
+            names = set(self.columns.values()) | \
+                    key_columns(self.table)
+        names = sorted(names)
+        table = self.model.__table__
+        columns = [table.c.id] + [table.c[name] for name in names]
+        wanted = set(ids)
+        rows = {}
+        for id_filter in _id_filters(table.c.id, wanted):
+            # Core rows, the ORM's loading is the slowest part otherwise
+            result = db.session.execute(select(columns).where(id_filter))
+            for row in result.fetchall():
+                if row[0] in wanted:
+                    rows[row[0]] = dict(zip(names, row[1:]))
+        return rows
+
+    def _existing(self, column, values, compare=None, parser=None):
+        # {value: id} of the rows with the given column values
+        found = {}
+        model = column.class_
+        if compare:
+            column = compare(column)
+        for chunk in _chunks(values):
+            query = db.session.query(column, model.id)\
+                              .filter(column.in_(chunk))
+            for value, row_id in query:
+                found[parser(value) if parser else value] = row_id
+        return found
+
+    def _parse(self, edits):
+        # -> [(id, {column: value}, errors)], the unknown fields are ignored
+        parsed = []
+        for row_id, values in edits:
+            changes, errors = {}, []
+            for field in self.fields:
+                if field not in values:
+                    continue
+                value = values[field]
+                if field in self.required and value in (None, ''):
+                    errors.append('the "%s" parameter cannot be empty' % \
+                                  field)
+                    continue
+                parser = self.parsers.get(field)
+                if parser:
+                    try:
+                        value = parser(value)
+                    except ValueError as e:
+                        errors.append('"%s": %s' % (field, e))
+                        continue
+                changes[self.columns[field]] = value
+            parsed.append((row_id, changes, errors))
+        return parsed
+
+    def _check_unique(self, parsed):
+        for field in self.unique:
+            column = self.columns[field]
+            values = set(changes[column] for row_id, changes, errors
+                         in parsed if changes.get(column) is not None)
+            if not values:
+                continue
+            compare = self.compare.get(field)
+            existing = self._existing(getattr(self.model, column), values,
+                                      compare,
+                                      compare and self.parsers.get(field))
+            taken = {}
+            for row_id, changes, errors in parsed:
+                value = changes.get(column)
+                if value is None:
+                    continue
+                owner = taken.setdefault(value, existing.get(value, row_id))
+                if owner != row_id:
+                    errors.append('the "%s" is already registered' % field)
+
+    def _check_references(self, parsed):
+        for field, model in self.references.items():
+            column = self.columns[field]
+            values = set(changes[column] for row_id, changes, errors
+                         in parsed if changes.get(column) is not None)
+            if not values:
+                continue
+            existing = self._existing(model.id, values)
+            for row_id, changes, errors in parsed:
+                value = changes.get(column)
+                if value is not None and value not in existing:
+                    errors.append('no %s #%s is found' % (
+                                  model.__tablename__, value))
+
+    def write(self, mappings):
+        """Writes the changes {"id": id, column: value}, a single
+        executemany per set of changed columns"""
+        table = self.model.__table__
+        groups = {}
+        for mapping in mappings:
+            groups.setdefault(tuple(sorted(mapping)), []).append(mapping)
+
+        for keys, group in groups.items():
+            params = [dict(('_' + key, value) for key, value
+                           in mapping.items()) for mapping in group]
+            statement = table.update()\
+                             .where(table.c.id == bindparam('_id'))\
+                             .values(dict((key, bindparam('_' + key))
+                                          for key in keys if key != 'id'))
+            db.session.execute(statement, params)
+
+    def record(self, updated):
+        """Records the change events of the updated rows' (id, current
+        values, changed values)"""
+        keys = key_columns(self.table)
+        for row_id, row, changed in updated:
+            values = {}
+            for name in keys:
+                found = set([row[name], changed.get(name, row[name])])
+                found.discard(None)
+                if found:
+                    values[name] = tuple(sorted(found))
+            record(db.session, self.table, [row_id],
+                   columns=changed, keys={row_id: values})
+
+    def run(self, edits):
+        """Applies the edits, returns the list of per-row results with the
+        "status": updated, unchanged, invalid or not_found"""
+        results, valid = [], []
+
+        for key, values in sorted(edits.items()):
+            try:
+                row_id = int(key)
+            except (TypeError, ValueError):
+                results.append({'id': key, 'status': 'invalid',
+                                'errors': ['the id is not a number']})
+                continue
+            if not isinstance(values, dict):
+                results.append({'id': row_id, 'status': 'invalid',
+                                'errors': ['the changes are not an object']})
+                continue
+            valid.append((row_id, values))
+
+        parsed = self._parse(valid)
+
+        # only the columns the edits touch are loaded and compared
+        touched = set(key_columns(self.table))
+        for row_id, changes, errors in parsed:
+            touched.update(changes)
+        current = self.load([row_id for row_id, values in valid], touched)
+
+        parsed = [item for item in parsed if item[0] in current]
+        self._check_unique(parsed)
+        self._check_references(parsed)
+
+        mappings, updated = [], []
+        for row_id, values in valid:
+            if row_id not in current:
+                results.append({'id': row_id, 'status': 'not_found'})
+
+        if self.prepare:
+            self.prepare([changes for row_id, changes, errors in parsed
+                          if not errors])
+
+        for row_id, changes, errors in parsed:
+            if errors:
+                results.append({'id': row_id, 'status': 'invalid',
+                                'errors': errors})
+                continue
+
+            row = current[row_id]
+            changed = dict((column, value) for column, value
+                           in changes.items() if row[column] != value)
+            if not changed:
+                results.append({'id': row_id, 'status': 'unchanged'})
+                continue
+
+            mapping = dict(changed, id=row_id)
+            mappings.append(mapping)
+            updated.append((row_id, row, changed))
+            results.append({'id': row_id, 'status': 'updated',
+                            'changed': sorted(self.fields_by_column[column]
+                                              for column in changed)})
+
+        if mappings:
+            self.write(mappings)
+            self.record(updated)
+
+        # the numeric IDs first, in order
+        results.sort(key=lambda result: (not isinstance(result['id'], int),
+                                         result['id']))
+        return results
+
+
+def summary(results):
+    """The response of the edit endpoints: the amounts and the results"""
+    counts = {'updated': 0, 'unchanged': 0, 'invalid': 0, 'not_found': 0}
+    for result in results:
+        counts[result['status']] += 1
+    return dict(counts, results=results)
+
+
+def parse_email(value):
+    """The normalized email, raises ValueError if it's not a string"""
+    if not hasattr(value, 'strip'):
+        raise ValueError('the email is not a string')
+    return models.normalize_email(value)
+
+
+def _hash_changed_passwords(changes_list):
+    changes_list = [changes for changes in changes_list
+                    if 'password_hash' in changes]
+    hashes = hash_passwords([changes['password_hash']
+                             for changes in changes_list])
+    for changes, password_hash in zip(changes_list, hashes):
+        changes['password_hash'] = password_hash
+
+
+member_update = BulkUpdate(models.Member,
+    fields=['photo', 'name', 'email', 'action', 'address',
+            'address_additional', 'tel', 'dob', 'gender', 'marital_status',
+            'start_date', 'effective_date', 'mature_date', 'exit_date',
+            'product', 'plan', 'policy_number', 'national_id', 'card_number',
+            'plan_type', 'remarks', 'dependents', 'sequence', 'patient_type'],
+    parsers={'dob': parse_date, 'start_date': parse_date,
+             'effective_date': parse_date, 'mature_date': parse_date,
+             'exit_date': parse_date},
+    required=('name',))
+
+user_update = BulkUpdate(models.User,
+    fields=['name', 'email', 'role', 'password'],
+    parsers={'email': parse_email},
+    columns={'password': 'password_hash'},
+    required=('name', 'email', 'password'),
+    unique=('email',),
+    compare={'email': models.email_key},
+    prepare=_hash_changed_passwords)
+
+terminal_update = BulkUpdate(models.Terminal,
+    fields=['status', 'serial_number', 'model', 'provider_id', 'location',
+            'version', 'last_update', 'remarks'],
+    parsers={'last_update': parse_date},
+    references={'provider_id': models.Provider})
+
+claim_update = BulkUpdate(models.Claim,
+    fields=['status', 'claim_number', 'claim_type', 'datetime', 'admitted',
+            'discharged', 'amount', 'icd_code', 'provider_id', 'member_id',
+            'terminal_id'],
+    parsers={'datetime': parse_date},
+    references={'provider_id': models.Provider, 'member_id': models.Member,
+                'terminal_id': models.Terminal})
+
+
+# the fields of the imported users
+USER_FIELDS = ('name', 'email', 'role', 'user_type', 'password')
+
+
+def import_users(rows, chunk_size=CHUNK_SIZE):
+    """Creates the users of the rows, all or none of them. The rows are
+    validated first, the emails are checked with one query and against
+    each other, so the error report lists every problem of the batch.
+    Returns the created users' dictionaries and the list of the errors"""
+    errors = []
+    users = []
+    emails = {}
+
+    for row_num, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append('row %d: the user is not an object' % row_num)
+            continue
+
+        for field in ('name', 'email', 'password'):
+            if not row.get(field):
+                errors.append('row %d: the "%s" parameter cannot be '
+                              'empty' % (row_num, field))
+
+        user = dict((field, row.get(field)) for field in USER_FIELDS)
+        if user['email']:
+            # the email is normalized once, it's looked up and saved
+            # as that (see models.normalize_email)
+            try:
+                user['email'] = parse_email(user['email'])
+            except ValueError:
+                errors.append('row %d: the "email" is not a string' % \
+                              row_num)
+            else:
+                if user['email'] in emails:
+                    errors.append('row %d: the "email" repeats row %d' % (
+                                  row_num, emails[user['email']]))
+                else:
+                    emails[user['email']] = row_num
+
+        users.append(user)
+
+    # the collation may match the registered emails differing from the
+    # given ones, e.g. by an accent, they have no row to report
+    for email, user_id in sorted(_existing_emails(list(emails)),
+                                 key=lambda found: emails.get(found[0], -1)):
+        if email in emails:
+            errors.append('row %d: the "email" is already registered' % \
+                          emails[email])
+        else:
+            errors.append('the "email" %s is already registered' % email)
+
+    if errors:
+        return [], errors
+
+    # the slowest part, the passwords are hashed once the batch is valid
+    hashes = hash_passwords([user.pop('password') for user in users])
+    for user, password_hash in zip(users, hashes):
+        user['password_hash'] = password_hash
+
+    table = models.User.__table__
+    for chunk in _chunks(users, chunk_size):
+        db.session.execute(table.insert(), chunk)
+
+    ids = dict(_existing_emails([user['email'] for user in users]))
+    for user in users:
+        del user['password_hash']
+        user['id'] = ids.get(user['email'])
+
+    return users, []
+
+
+def _existing_emails(emails):
+    # (normalized email, id) of the registered users with the given
+    # normalized emails, whatever the case they were saved with
+    email = models.email_key(models.User.email)
+    found = []
+    for chunk in _chunks(set(emails)):
+        found.extend((models.normalize_email(value), user_id)
+                     for value, user_id in db.session.query(
+                         email, models.User.id).filter(email.in_(chunk)))
+    return found
+
+
+def _invalid_claim(key, error):
+    return {'id': key, 'status': 'invalid', 'error': error}
+
+
+def _terminal_claims(pairs):
+    # {(terminal id, idempotency key): claim row} of the existing claims
+    Claim = models.Claim
+    found = {}
+    terminal_ids = set(terminal_id for terminal_id, key in pairs)
+    for chunk in _chunks(set(key for terminal_id, key in pairs)):
+        rows = db.session.query(Claim.id, Claim.status, Claim.datetime,
+                                Claim.amount, Claim.terminal_id,
+                                Claim.idempotency_key)\
+                         .filter(Claim.terminal_id.in_(terminal_ids),
+                                 Claim.idempotency_key.in_(chunk))
+        for row in rows:
+            found[(row.terminal_id, row.idempotency_key)] = row
+    return found
+
+
+def _existing_members(member_ids):
+    found = set()
+    for chunk in _chunks(set(member_ids)):
+        found.update(member_id for member_id, in db.session.query(
+            models.Member.id).filter(models.Member.id.in_(chunk)))
+    return found
+
+
+def _existing_links(links):
+    # the (member id, provider id) pairs already in custom_members
+    table = models.custom_members
+    provider_ids = set(provider_id for member_id, provider_id in links)
+    found = set()
+    for chunk in _chunks(set(member_id for member_id, provider_id in links)):
+        found.update(tuple(link) for link in db.session.execute(
+            select([table.c.member_id, table.c.provider_id])
+            .where(and_(table.c.member_id.in_(chunk),
+                        table.c.provider_id.in_(provider_ids)))))
+    return found
+
+
+def import_terminal_claims(rows, terminal_uid=None, chunk_size=CHUNK_SIZE):
+    """Creates the claims the terminals have queued while offline. Every row
+    is {"id": the terminal's claim ID, "user_id": the member's ID,
+    "datetime": the check-in time in DATETIME_FORMAT, "terminal_uid"},
+    the batch's "terminal_uid" is used if the row has none.
+
+    The terminals, the members, the providers' links and the already
+    uploaded claims are looked up with one query per chunk, the claims
+    uploaded before (the same terminal and ID) are returned as duplicates.
+    The caller commits the transaction.
+
+    Returns the results per row and {provider's user id: created claims}"""
+    results = [None] * len(rows)
+    checked = []
+
+    for row_num, row in enumerate(rows):
+        if not isinstance(row, dict):
+            results[row_num] = _invalid_claim(None, 'the claim is not '
+                                                    'an object')
+            continue
+
+        key = row.get('id')
+        device_uid = row.get('terminal_uid') or terminal_uid
+        if not key or not device_uid or not row.get('user_id'):
+            results[row_num] = _invalid_claim(key, 'not enough parameters')
+            continue
+
+        try:
+            member_id = int(row['user_id'])
+            claim_datetime = parse_datetime(row.get('datetime'), 'datetime')
+        except (TypeError, ValueError) as e:
+            error = str(e) if isinstance(e, DateParseError) else \
+                    'the "user_id" is not a number'
+            results[row_num] = _invalid_claim(key, error)
+            continue
+
+        checked.append((row_num, key, str(key)[:80], device_uid, member_id,
+                        claim_datetime or datetime.now()))
+
+    terminals = resolve_terminals(set(row[3] for row in checked))
+    members = _existing_members(row[4] for row in checked)
+    existing = _terminal_claims(set((terminals[row[3]].id, row[2])
+                                    for row in checked if row[3] in terminals))
+
+    claims = []
+    links = set()
+    new = {}
+    repeated = []
+
+    for row_num, key, claim_key, device_uid, member_id, claim_datetime in \
+      checked:
+        terminal = terminals.get(device_uid)
+        if not terminal or not terminal.provider_id:
+            results[row_num] = _invalid_claim(key, 'no such terminal')
+            continue
+
+        if member_id not in members:
+            results[row_num] = _invalid_claim(key, 'no such member')
+            continue
+
+        pair = (terminal.id, claim_key)
+        if pair in existing or pair in new:
+            repeated.append((row_num, key, pair, terminal))
+            continue
+
+        new[pair] = (row_num, key, terminal)
+        links.add((member_id, terminal.provider_id))
+        claims.append({'datetime': claim_datetime,
+                       'provider_id': terminal.provider_id,
+                       'terminal_id': terminal.id,
+                       'member_id': member_id,
+                       'idempotency_key': claim_key,
+                       'new_claim': 1})
+
+    # the first visits to the providers add them to the members' lists
+    links = sorted(links - _existing_links(links))
+    for chunk in _chunks(links, chunk_size):
+        db.session.execute(models.custom_members.insert(),
+                           [{'member_id': member_id,
+                             'provider_id': provider_id}
+                            for member_id, provider_id in chunk])
+    record(db.session, 'member', set(member_id for member_id, _ in links),
+           columns=('providers',))
+
+    for chunk in _chunks(claims, chunk_size):
+        db.session.execute(models.Claim.__table__.insert(), chunk)
+
+    created = _terminal_claims(list(new)) if new else {}
+    # the keys' rows fail the concurrent batch with the same claims
+    keys = [{'terminal_id': terminal_id, 'idempotency_key': claim_key,
+             'claim_id': created[(terminal_id, claim_key)].id}
+            for terminal_id, claim_key in new]
+    for chunk in _chunks(keys, chunk_size):
+        db.session.execute(models.ClaimIdempotencyKey.__table__.insert(),
+                           chunk)
+    providers = Counter()
+
+    for pair, (row_num, key, terminal) in new.items():
+        results[row_num] = {'id': key, 'status': 'created', 'claim':
+            prepare_terminal_claim_dict(created[pair], terminal.company)}
+        if terminal.provider_user_id:
+            providers[terminal.provider_user_id] += 1
+
+    for row_num, key, pair, terminal in repeated:
+        claim = existing.get(pair) or created[pair]
+        results[row_num] = {'id': key, 'status': 'duplicate', 'claim':
+            prepare_terminal_claim_dict(claim, terminal.company)}
+
+    return results, dict(providers)
@@ -1,94 +1,71 @@
-from flask import request
-from .. import db, models
+import json, time, zlib
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app, request
+from itsdangerous import BadData, URLSafeTimedSerializer
+from sqlalchemy import and_, desc, exists, or_
+from .. import changes, db, models, redis_store
+from ..dates import parse_date, parse_datetime
+from .serializers import member_serializer, user_serializer
+from .serializers import terminal_serializer, claim_serializer
+
+# the date fields of the member rows, parsed as DATE_FORMAT
+MEMBER_DATE_FIELDS = ('dob', 'start_date', 'effective_date', 'mature_date',
+                      'exit_date')
+
+# the claims returned with the member's profile, and the largest page
+# of the member's claims endpoint
+MEMBER_CLAIMS_LIMIT = 20
+MEMBER_CLAIMS_MAX_LIMIT = 100
+
+# the version tokens of the members' sync, "<since>.<loaded>": the UTC
+# time the next sync reads the changes from and the time of the profile's
+# last full load
+SYNC_VERSION_FORMAT = '%Y%m%d%H%M%S'
+# the seconds the sync looks back before its own time: the sync reads
+# a replica, and the rows of the transactions still running, or not
+# replicated yet, have the earlier updated_at, so they would be skipped.
+# Longer than the replica lag and the longest transaction
+SYNC_VERSION_MARGIN = 5 * 60
+# the seconds after the last full load the sync tells the app to reload
+# the profile ("reset"), the deleted claims and the ones moved to another
+# member are not tracked, the reload drops them
+SYNC_RESET_INTERVAL = 24 * 60 * 60
+
+# the salt of the members' app tokens, see member_token()
+MEMBER_TOKEN_SALT = 'member-token'
+
+# the largest decompressed body of the compressed requests
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+# the seconds the terminal lookups are cached for
+TERMINAL_CACHE_TIMEOUT = 300
+
+TerminalInfo = namedtuple('TerminalInfo', ['id', 'provider_id',
+                                           'provider_user_id', 'company'])
+
+# device uid -> (expiration time, TerminalInfo)
+_terminals_cache = {}
 
-def date_set_to_current_date_on_failure(data):
-    from datetime import datetime
-    try:
-        date_data = datetime.strptime(data, '%m/%d/%Y')
-    except Exception as e:
-        date_data = datetime.now()
-    
-    return date_data
-
-def datetime_set_to_current_date_on_failure(data):
-    from datetime import datetime
-    try:
-        date_data = datetime.strptime(data, '%m/%d/%Y %I:%M %p')
-    except Exception as e:
-        date_data = datetime.now()
-    
-    return date_data
 
 # prepare models dictionaries
 def prepare_member_dict(member):
     """The function takes the Member model object
     and convert it to the python dictionary"""
-
-    if not member:
-        return None
-
-    claim_ids = []
-
-    for claim in member.claims:
-        claim_ids.append(str(claim.id))
-
-    message_ids = []
-
-    for message in member.messages:
-        message_ids.append(str(message.id))
-
-    call_request_ids = []
-
-    for call_request in member.call_requests:
-        call_request_ids.append(str(call_request.id))
-
-
-    member_dict = {
-        'id': member.id,
-        'photo': member.photo,
-        'name': member.name,
-        'email': member.email,
-        'action': member.action,
-        'address': member.address,
-        'address_additional': member.address_additional,
-        'tel': member.tel,
-        'dob': member.dob.strftime('%m/%d/%Y'),
-        'gender': member.gender,
-        'marital_status': member.marital_status,
-        'start_date': member.start_date.strftime('%m/%d/%Y'),
-        'effective_date': member.effective_date.strftime('%m/%d/%Y'),
-        'mature_date': member.mature_date.strftime('%m/%d/%Y'),
-        'exit_date': member.exit_date.strftime('%m/%d/%Y'),
-        'product': member.product,
-        'plan': member.plan,
-        'policy_number': member.policy_number,
-        'national_id': member.national_id,
-        'card_number': member.card_number,
-        'plan_type': member.plan_type,
-        'remarks': member.remarks,
-        'dependents': member.dependents,
-        'sequence': member.sequence,
-        'patient_type': member.patient_type,
-        'device_uid': member.device_uid,
-        'claims': claim_ids,
-        'messages': message_ids,
-        'call_requests': call_request_ids
-    }
-
-    return member_dict
+    return member_serializer.dump(member)
 
 # convert member dictionaries to models
 def convert_dict_member_model(member_dict):
     """The function takes the Member python dictionary
     and convert it to the Member model object"""
     
-    dob = date_set_to_current_date_on_failure(member_dict['dob'])
-    start_date = date_set_to_current_date_on_failure(member_dict['start_date'])
-    effective_date = date_set_to_current_date_on_failure(
-                            member_dict['effective_date'])
-    mature_date = date_set_to_current_date_on_failure(
-                        member_dict['mature_date'])
-    exit_date = date_set_to_current_date_on_failure(member_dict['exit_date'])
+    dob = parse_date(member_dict['dob'], 'dob')
+    start_date = parse_date(member_dict['start_date'], 'start_date')
+    effective_date = parse_date(member_dict['effective_date'],
+                                'effective_date')
+    mature_date = parse_date(member_dict['mature_date'], 'mature_date')
+    exit_date = parse_date(member_dict['exit_date'], 'exit_date')
     
     member = models.Member(
                 photo=member_dict['photo'],
@@ -123,111 +100,28 @@ def convert_dict_member_model(member_dict):
 def prepare_user_dict(user):
     """The function takes the User model object
     and convert it to the python dictionary"""
-
-    terminal_ids = []
-
-    for terminal in user.terminals:
-        terminal_ids.append(str(terminal.id))
-
-    claim_ids = []
-
-    for claim in user.claims:
-        claim_ids.append(str(claim.id))
-
-    message_ids = []
-
-    for message in user.messages:
-        message_ids.append(str(message.id))
-
-    call_request_ids = []
-
-    for call_request in user.call_requests:
-        call_request_ids.append(str(call_request.id))
-
-    user_dict = {
-        'id': user.id,
-        'name': user.name,
-        'email': user.email,
-        'role': user.role,
-        'terminals': terminal_ids,
-        'claims': claim_ids,
-        'messages': message_ids,
-        'call_requests': call_request_ids,
-        'setup_serial_number': user.setup_serial_number,
-        'setup_server_url': user.setup_server_url,
-        'setup_server_port': user.setup_server_port,
-        'setup_module_name': user.setup_module_name,
-        'setup_proxy_url': user.setup_module_name,
-        'setup_proxy_port': user.setup_proxy_port,
-        'setup_username': user.setup_username,
-        'setup_password': user.setup_password,
-        'setup_request_url': user.setup_request_url,
-        'setup_default_path': user.setup_default_path,
-        'setup_language': user.setup_language
-    }
-
-    return user_dict
+    return user_serializer.dump(user)
 
 
 # prepare terminal dict
 def prepare_terminal_dict(terminal):
     """The function takes the Terminal model object
     and convert it to the python dictionary"""
-
-    claim_ids = []
-
-    for claim in terminal.claims:
-        claim_ids.append(str(claim.id))
-
-    terminal_dict = {
-        'id': terminal.id,
-        'status': terminal.status,
-        'serial_number': terminal.serial_number,
-        'model': terminal.model,
-        'user_id': terminal.user_id,
-        'claims': claim_ids,
-        'location': terminal.location,
-        'version': terminal.version,
-        'last_update': terminal.last_update.strftime('%m/%d/%Y'),
-        'remarks': terminal.remarks
-    }
-
-    return terminal_dict
+    return terminal_serializer.dump(terminal)
 
 
 # prepare claim dict
 def prepare_claim_dict(claim):
     """The function takes the Claim model object
     and convert it to the python dictionary"""
+    return claim_serializer.dump(claim)
 
-    claim_dict = {
-        'id': claim.id,
-        'status': claim.status,
-        'claim_number': claim.claim_number,
-        'claim_type': claim.claim_type,
-        'datetime': claim.datetime.strftime('%m/%d/%Y %I:%M %p'),
-        'admitted': claim.admitted,
-        'discharged': claim.discharged,
-        'location': claim.location,
-        'amount': claim.amount,
-        'icd_code': claim.icd_code,
-        'user_id': claim.user_id,
-        'member_id': claim.member_id,
-        'terminal_id': claim.terminal_id,
-        'medipay_id': claim.medipay_id,
-
-        # temporarily
-        'debug': claim.debug
-    }
-
-    return claim_dict
-    
 # convert claim dictionaries to models
 def convert_dict_claim_model(claim_dict):
     """The function takes the Claim python dictionary
     and convert it to the Claim model object"""
     
-    claim_date_time = datetime_set_to_current_date_on_failure(claim_dict['datetime'])
+    claim_date_time = parse_datetime(claim_dict['datetime'], 'datetime')
     
     claim = models.Claim(
                 status=claim_dict['status'],
@@ -248,65 +142,25 @@ def convert_dict_claim_model(claim_dict):
 def prepare_members_list(members):
     """The function takes the Member model objects list and convert it to the
     python dictionary"""
-
-    if not members:
-        return []
-
-    # initialize the results list
-    results = []
-
-    for member in members:
-        results.append(prepare_member_dict(member))
-
-    return results
+    return member_serializer.dump_objects(members or [])
 
 
 def prepare_terminals_list(terminals):
     """The function takes the Terminal model objects list and convert it to the
     python dictionary"""
-
-    if not terminals:
-        return []
-
-    # initialize the results list
-    results = []
-
-    for terminal in terminals:
-        results.append(prepare_terminal_dict(terminal))
-
-    return results
+    return terminal_serializer.dump_objects(terminals or [])
 
 
 def prepare_claims_list(claims):
     """The function takes the Claim model objects list and convert it to the
     python dictionary"""
-
-    if not claims:
-        return []
-
-    # initialize the results list
-    results = []
-
-    for claim in claims:
-        results.append(prepare_claim_dict(claim))
-
-    return results
+    return claim_serializer.dump_objects(claims or [])
 
 
 def prepare_users_list(users):
     """The function takes the User model objects list and convert it to the
     python dictionary"""
-
-    if not users:
-        return []
-
-    # initialize the results list
-    results = []
-
-    for user in users:
-        results.append(prepare_user_dict(user))
-
-    return results
+    return user_serializer.dump_objects(users or [])
 
 
 # functions for getting parameters from POST parameters and JSON
@@ -350,6 +204,28 @@ def from_json_to_dict(json_dict, dest_dict, overwrite=False):
     return dest_dict
 
 
+def request_json(max_size=MAX_REQUEST_SIZE):
+    """The request's JSON, the body may be compressed with gzip
+    ("Content-Encoding: gzip"). Returns None if it's not valid"""
+    if request.headers.get('Content-Encoding', '').lower() != 'gzip':
+        return request.get_json(silent=True)
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(request.get_data(), max_size)
+    except zlib.error:
+        return None
+
+    # the body is larger than max_size once decompressed
+    if decompressor.unconsumed_tail:
+        return None
+
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError:
+        return None
+
+
 def authorize_api_key():
     api_key = request.args.get('api_key')
 
@@ -367,6 +243,35 @@ def authorize_api_key():
     return (True, None, user)
 
 
+def _member_signer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'],
+                                  salt=MEMBER_TOKEN_SALT)
+
+
+def member_token(member_id):
+    """The signed token /member/login gives the members' app, the app
+    sends it in the "X-Member-Token" header (or the "token" parameter)"""
+    return _member_signer().dumps({'member_id': member_id})
+
+
+def authorize_member_token():
+    """Returns the ID of the member of the request's token, None if the
+    token is missing, forged or older than MEMBER_TOKEN_TIMEOUT"""
+    token = request.headers.get('X-Member-Token') or \
+        request.args.get('token')
+
+    if not token:
+        return None
+
+    try:
+        data = _member_signer().loads(
+            token, max_age=current_app.config['MEMBER_TOKEN_TIMEOUT'])
+    except BadData:
+        return None
+
+    return data.get('member_id')
+
+
 def exclude_keys(keys, dest):
     if keys:
         if type(dest) is dict:
@@ -378,3 +283,346 @@ def exclude_keys(keys, dest):
                     del row[key]
 
     return dest
+
+
+def _terminals_query():
+    # the TerminalInfo columns
+    return db.session.query(models.Terminal.id,
+                            models.Terminal.provider_id,
+                            models.Provider.user_id,
+                            models.Provider.company)\
+                     .outerjoin(models.Provider,
+                                models.Terminal.provider_id == \
+                                models.Provider.id)
+
+
+def resolve_terminal(device_uid):
+    """Returns the TerminalInfo of the terminal with the given device uid.
+    The lookups are cached per process, unknown terminals are not cached"""
+    cached = _terminals_cache.get(device_uid)
+
+    if cached and cached[0] > time.time():
+        return cached[1]
+
+    row = _terminals_query()\
+          .filter(models.Terminal.device_uid == device_uid).first()
+
+    if not row:
+        return None
+
+    terminal = TerminalInfo(*row)
+    _terminals_cache[device_uid] = (time.time() + TERMINAL_CACHE_TIMEOUT,
+                                    terminal)
+    return terminal
+
+
+def resolve_terminals(device_uids):
+    """Returns {device uid: TerminalInfo} of the known terminals,
+    the lookups missing from the cache are made with one query"""
+    now = time.time()
+    terminals = {}
+    missing = []
+
+    for device_uid in set(device_uids):
+        cached = _terminals_cache.get(device_uid)
+        if cached and cached[0] > now:
+            terminals[device_uid] = cached[1]
+        else:
+            missing.append(device_uid)
+
+    if missing:
+        rows = _terminals_query().add_columns(models.Terminal.device_uid)\
+               .filter(models.Terminal.device_uid.in_(missing))
+        for row in rows:
+            terminal = TerminalInfo(*row[:4])
+            _terminals_cache[row.device_uid] = (now + TERMINAL_CACHE_TIMEOUT,
+                                                terminal)
+            terminals[row.device_uid] = terminal
+
+    return terminals
+
+
+def forget_terminal(device_uid):
+    """Drops the cached lookup of the terminal"""
+    _terminals_cache.pop(device_uid, None)
+
+
+def forget_provider_terminals(provider_ids):
+    """Drops the cached lookups of the providers' terminals"""
+    provider_ids = set(provider_ids)
+    for device_uid, (_, terminal) in list(_terminals_cache.items()):
+        if terminal.provider_id in provider_ids:
+            _terminals_cache.pop(device_uid, None)
+
+
+@changes.subscribe('terminal', keys=('device_uid',))
+def terminals_changed(records):
+    # the edited and deleted terminals, by their current
+    # and previous device uids
+    for record in records:
+        for device_uid in record.keys.get('device_uid', ()):
+            forget_terminal(device_uid)
+
+
+@changes.subscribe('provider')
+def providers_terminals_changed(records):
+    # the lookups carry the provider's company and user
+    forget_provider_terminals(record.id for record in records
+                              if record.op == changes.DELETE or
+                              set(record.columns) & set(('company',
+                                                         'user_id')))
+
+
+def member_provider_link(member_id, provider_id):
+    """Returns None if there is no such member, otherwise
+    whether the member is already linked to the provider"""
+    linked = exists().where(and_(
+        models.custom_members.c.member_id == models.Member.id,
+        models.custom_members.c.provider_id == provider_id))
+
+    row = db.session.query(models.Member.id, linked.label('linked'))\
+                    .filter(models.Member.id == member_id).first()
+
+    if not row:
+        return None
+
+    return bool(row.linked)
+
+
+def idempotency_key(json_dict):
+    """Returns the request's idempotency key, taken from the
+    "Idempotency-Key" header or the "idempotency_key" JSON field"""
+    key = request.headers.get('Idempotency-Key') or \
+        json_dict.get('idempotency_key')
+
+    if not key:
+        return None
+
+    return str(key)[:80]
+
+
+def _idempotency_redis_key(terminal_id, key):
+    return 'idempotency:%d:%s' % (terminal_id, key)
+
+
+def find_idempotent_claim(terminal_id, key):
+    """Returns the ID of the claim already created by the terminal
+    with the given idempotency key, or None. The keys are unique per
+    terminal for good (see ClaimIdempotencyKey), redis
+    only caches the recent ones"""
+    try:
+        claim_id = redis_store.get(_idempotency_redis_key(terminal_id, key))
+    except Exception:
+        claim_id = None
+
+    if claim_id:
+        return int(claim_id)
+
+    # redis may be down, restarted or have expired the key,
+    # fall back to the claims table, without a time window like the
+    # keys' table (see ClaimIdempotencyKey) and the batch path
+    row = db.session.query(models.Claim.id)\
+                    .filter(models.Claim.terminal_id == terminal_id,
+                            models.Claim.idempotency_key == key).first()
+
+    return row.id if row else None
+
+
+def remember_idempotent_claim(terminal_id, key, claim_id):
+    try:
+        redis_store.set(_idempotency_redis_key(terminal_id, key), claim_id,
+                        ex=current_app.config['IDEMPOTENCY_KEY_TIMEOUT'])
+    except Exception:
+        pass
+
+
+def prepare_terminal_claim_dict(claim, company):
+    """The claim dictionary returned to the terminals and the members"""
+    if claim.datetime:
+        claim_datetime = claim.datetime.strftime('%d/%m/%Y %I:%M %p')
+    else:
+        claim_datetime = None
+
+    return {
+        'id': claim.id,
+        'status': claim.status,
+        'datetime': claim_datetime,
+        'amount': claim.amount,
+        'company': company
+    }
+
+
+def encode_cursor(value, row_id):
+    """The keyset pagination cursor pointing after the row
+    with the given (datetime, id)"""
+    if value is None:
+        return '_%d' % row_id
+    return '%s_%d' % (value.strftime('%Y%m%d%H%M%S%f'), row_id)
+
+
+def decode_cursor(cursor):
+    """Returns the (datetime, id) of the cursor, raises ValueError"""
+    value, row_id = cursor.split('_')
+    if value:
+        value = datetime.strptime(value, '%Y%m%d%H%M%S%f')
+    return value or None, int(row_id)
+
+
+def _member_claims_query(member_id):
+    # the providers' companies come with the same query
+    Claim = models.Claim
+    return db.session.query(Claim.id, Claim.status, Claim.datetime,
+                            Claim.amount, models.Provider.company)\
+                     .outerjoin(models.Provider,
+                                Claim.provider_id == models.Provider.id)\
+                     .filter(Claim.member_id == member_id)
+
+
+def member_claims_page(member_id, cursor=None, limit=MEMBER_CLAIMS_LIMIT):
+    """Returns the member's claims, the latest first, starting after
+    the cursor, and the cursor of the next page (None on the last one)"""
+    Claim = models.Claim
+    query = _member_claims_query(member_id)
+
+    # the keyset pagination by (datetime, id), the claims without
+    # the date go last both in MySQL and SQLite
+    if cursor:
+        after_datetime, after_id = decode_cursor(cursor)
+        if after_datetime is None:
+            query = query.filter(Claim.datetime.is_(None),
+                                 Claim.id < after_id)
+        else:
+            query = query.filter(or_(
+                Claim.datetime < after_datetime,
+                and_(Claim.datetime == after_datetime, Claim.id < after_id),
+                Claim.datetime.is_(None)))
+
+    rows = query.order_by(desc(Claim.datetime), desc(Claim.id))\
+                .limit(limit + 1).all()
+
+    claims = [prepare_terminal_claim_dict(row, row.company)
+              for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.datetime, last.id)
+
+    return claims, next_cursor
+
+
+def _member_fields(member):
+    return {
+        'id': member.id,
+        'name': member.name,
+        'photo': member.photo,
+        'dob': member.dob.strftime('%Y-%m-%d') if member.dob else None,
+        'gender': member.gender,
+        'tel': member.tel,
+        'national_id': member.national_id
+    }
+
+
+def sync_version(loaded=None):
+    """The version token of the data read from now on, "loaded" is the
+    time of the profile's last full load (now by default)"""
+    now = datetime.utcnow()
+    since = now - timedelta(seconds=SYNC_VERSION_MARGIN)
+    return '%s.%s' % (since.strftime(SYNC_VERSION_FORMAT),
+                      (loaded or now).strftime(SYNC_VERSION_FORMAT))
+
+
+def parse_sync_version(version):
+    """The (since, loaded) times of the version token, raises ValueError.
+    The former tokens have no load time, it's taken to be their since"""
+    parts = [datetime.strptime(part, SYNC_VERSION_FORMAT)
+             for part in version.split('.')]
+    if len(parts) == 1:
+        return parts[0], parts[0]
+    if len(parts) != 2:
+        raise ValueError(version)
+    return parts[0], parts[1]
+
+
+def prepare_member_profile(member, claims_limit=MEMBER_CLAIMS_LIMIT):
+    """The member's profile returned to the members' app with the latest
+    claims, the older ones are loaded by the cursor. The app syncs
+    the later changes by the returned version"""
+    version = sync_version()
+    claims, claims_cursor = member_claims_page(member.id, limit=claims_limit)
+
+    profile = _member_fields(member)
+    profile.update(claims=claims, claims_cursor=claims_cursor,
+                   version=version)
+    return profile
+
+
+def prepare_gop_status_dict(gop):
+    """The guarantee of payment's status returned to the members' app"""
+    return {
+        'id': gop.id,
+        'status': gop.status,
+        'closed': gop.closed,
+        'final': gop.final,
+        'reason_decline': gop.reason_decline,
+        'reason_close': gop.reason_close,
+        'timestamp_edited': gop.timestamp_edited.strftime('%d/%m/%Y %I:%M %p')
+                            if gop.timestamp_edited else None
+    }
+
+
+def member_sync(member_id, version, limit=MEMBER_CLAIMS_MAX_LIMIT):
+    """Returns the member's profile, claims and guarantees of payment
+    changed since the version, None if there's no such member.
+
+    The rows changed in the last SYNC_VERSION_MARGIN before the version
+    are sent again, the app replaces them by ID. If more than "limit"
+    claims or guarantees of payment have changed, or the profile was
+    loaded SYNC_RESET_INTERVAL ago, "reset" tells the app to reload the
+    profile. Raises ValueError on an invalid version"""
+    since, loaded = parse_sync_version(version)
+    new_version = sync_version(loaded)
+    Member = models.Member
+    Claim = models.Claim
+    GOP = models.GuaranteeOfPayment
+
+    # one indexed probe, which is all the work when nothing has changed
+    probe = db.session.query(
+        Member.updated_at >= since,
+        exists().where(and_(Claim.member_id == member_id,
+                            Claim.updated_at >= since)),
+        exists().where(and_(GOP.member_id == member_id,
+                            GOP.updated_at >= since)))\
+                      .filter(Member.id == member_id).first()
+
+    if probe is None:
+        return None
+
+    member_changed, claims_changed, gops_changed = probe
+    result = {'version': new_version, 'member': None, 'claims': [],
+              'gops': [], 'reset': False}
+
+    if datetime.utcnow() - loaded > timedelta(seconds=SYNC_RESET_INTERVAL):
+        result['reset'] = True
+        return result
+
+    if member_changed:
+        result['member'] = _member_fields(Member.query.get(member_id))
+
+    if claims_changed:
+        rows = _member_claims_query(member_id)\
+               .filter(Claim.updated_at >= since)\
+               .order_by(Claim.id).limit(limit + 1).all()
+        result['claims'] = [prepare_terminal_claim_dict(row, row.company)
+                            for row in rows[:limit]]
+        result['reset'] = len(rows) > limit
+
+    if gops_changed:
+        gops = GOP.query.filter(GOP.member_id == member_id,
+                                GOP.updated_at >= since)\
+                        .order_by(GOP.id).limit(limit + 1).all()
+        result['gops'] = [prepare_gop_status_dict(gop)
+                          for gop in gops[:limit]]
+        result['reset'] = result['reset'] or len(gops) > limit
+
+    return result
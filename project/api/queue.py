@@ -0,0 +1,142 @@
+"""The payers' work queues of the pending GOPs. A queue is read with the
+(payer_id, status, timestamp) index, the oldest GOPs first, and paginated
+by the (timestamp, id) keyset. A reviewer takes the GOPs with a lease: the
+conditional UPDATE sets the lease only if nobody else holds it, so the
+reviewers pulling work at the same time never get the same GOP, and the
+leases of the reviewers who went away expire after LEASE_TIMEOUT."""
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+
+from .. import db, models
+from .helpers import decode_cursor, encode_cursor
+from .serializers import DATETIME_FORMAT, Serializer
+
+# the seconds a reviewer holds the leased GOPs for
+LEASE_TIMEOUT = 15 * 60
+QUEUE_LIMIT = 20
+QUEUE_MAX_LIMIT = 100
+# the rounds of the lease attempts when the other reviewers
+# take the candidates first
+LEASE_ROUNDS = 3
+
+PENDING = 'pending'
+
+gop_serializer = Serializer(models.GuaranteeOfPayment,
+    fields=['id', 'status', 'payer_id', 'provider_id', 'member_id',
+            'reason', 'doctor_name', 'quotation', 'leased_by'],
+    dates={'timestamp': DATETIME_FORMAT, 'lease_expires': DATETIME_FORMAT})
+
+
+def _available(query, user_id, now):
+    # the GOPs nobody holds, the expired leases and the user's own ones
+    GOP = models.GuaranteeOfPayment
+    return query.filter(or_(GOP.leased_by.is_(None),
+                            GOP.lease_expires < now,
+                            GOP.leased_by == user_id))
+
+
+def _queue(payer_id, user_id, cursor, now, limit):
+    # the keyset pagination by (timestamp, id), the oldest first and the
+    # ones without the timestamp last. They're two queries, each ordered
+    # by the index: an ORDER BY of "timestamp IS NULL" would sort all of
+    # the payer's pending GOPs, and MySQL and SQLite sort the NULLs first
+    GOP = models.GuaranteeOfPayment
+    query = _available(gop_serializer.select()
+                       .filter(GOP.payer_id == payer_id,
+                               GOP.status == PENDING), user_id, now)
+
+    after_timestamp, after_id = decode_cursor(cursor) if cursor else \
+                                (None, None)
+    rows = []
+
+    if after_id is None or after_timestamp is not None:
+        dated = query.filter(GOP.timestamp.isnot(None))
+        if after_id is not None:
+            dated = dated.filter(or_(
+                GOP.timestamp > after_timestamp,
+                and_(GOP.timestamp == after_timestamp, GOP.id > after_id)))
+        rows = dated.order_by(GOP.timestamp, GOP.id).limit(limit).all()
+        if len(rows) == limit:
+            return rows
+        after_id = None
+
+    undated = query.filter(GOP.timestamp.is_(None))
+    if after_id is not None:
+        undated = undated.filter(GOP.id > after_id)
+    return rows + undated.order_by(GOP.id).limit(limit - len(rows)).all()
+
+
+def _cursor(row):
+    keys = gop_serializer.keys
+    return encode_cursor(row[keys.index('timestamp')], row[keys.index('id')])
+
+
+def pending(payer_id, user_id, cursor=None, limit=QUEUE_LIMIT):
+    """Returns the page of the payer's pending GOPs available to the user,
+    the oldest first, and the cursor of the next page (None on the last
+    one). Raises ValueError on an invalid cursor"""
+    rows = _queue(payer_id, user_id, cursor, datetime.now(), limit + 1)
+
+    next_cursor = _cursor(rows[limit - 1]) if len(rows) > limit else None
+    return gop_serializer.dump_rows(rows[:limit]), next_cursor
+
+
+def lease(payer_id, user_id, limit=1):
+    """Leases up to "limit" of the payer's oldest available pending GOPs
+    to the user for LEASE_TIMEOUT and returns them. The user's own leases
+    are renewed. The caller commits the transaction"""
+    GOP = models.GuaranteeOfPayment
+    table = GOP.__table__
+    now = datetime.now()
+    expires = now + timedelta(seconds=LEASE_TIMEOUT)
+    leased = []
+    cursor = None
+
+    for _ in range(LEASE_ROUNDS):
+        # a few spare candidates for the ones taken concurrently
+        candidates = _queue(payer_id, user_id, cursor, now,
+                            (limit - len(leased)) * 2)
+        if not candidates:
+            break
+
+        for row in candidates:
+            gop_id = row[gop_serializer.id_index]
+            # the lease is set only if it's still available, the row lock
+            # of the UPDATE makes the concurrent attempts wait and fail;
+            # updated_at stays, the lease is not the GOP's change
+            result = db.session.execute(table.update()
+                .where(and_(table.c.id == gop_id,
+                            table.c.status == PENDING,
+                            or_(table.c.leased_by.is_(None),
+                                table.c.lease_expires < now,
+                                table.c.leased_by == user_id)))
+                .values(leased_by=user_id, lease_expires=expires,
+                        updated_at=table.c.updated_at))
+            if result.rowcount == 1:
+                leased.append(gop_id)
+                if len(leased) == limit:
+                    break
+
+        if len(leased) == limit:
+            break
+        cursor = _cursor(candidates[-1])
+
+    if not leased:
+        return []
+
+    # in the queue's order, they're a few rows found by the primary key
+    return gop_serializer.dump_query(gop_serializer.select()
+                                     .filter(GOP.id.in_(leased))
+                                     .order_by(GOP.timestamp.is_(None),
+                                               GOP.timestamp, GOP.id))
+
+
+def release(gop_id, user_id):
+    """Releases the user's lease of the GOP, returns whether it was held.
+    The caller commits the transaction"""
+    table = models.GuaranteeOfPayment.__table__
+    result = db.session.execute(table.update()
+        .where(and_(table.c.id == gop_id, table.c.leased_by == user_id))
+        .values(leased_by=None, lease_expires=None,
+                updated_at=table.c.updated_at))
+    return result.rowcount == 1
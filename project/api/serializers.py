@@ -0,0 +1,161 @@
+"""The API serializers. Every serializer compiles its model's field plan once:
+the selected columns, the date formatters and the relationship IDs, which
+are loaded in bulk with one query per relationship. The rows may be Core
+result tuples (see Serializer.select) or model objects."""
+from flask import current_app
+
+from .. import db, models
+
+try:
+    import ujson
+
+    def to_json(data):
+        return ujson.dumps(data, escape_forward_slashes=False)
+except ImportError:
+    import json
+
+    def to_json(data):
+        return json.dumps(data, separators=(',', ':'))
+
+DATE_FORMAT = '%m/%d/%Y'
+DATETIME_FORMAT = '%m/%d/%Y %I:%M %p'
+
+# the bound parameters per IN clause of the relationship IDs queries
+CHUNK_SIZE = 500
+
+
+def _format_date(value):
+    return '%02d/%02d/%04d' % (value.month, value.day, value.year)
+
+
+def _format_datetime(value):
+    hour = value.hour % 12 or 12
+    return '%02d/%02d/%04d %02d:%02d %s' % (value.month, value.day,
+        value.year, hour, value.minute, 'AM' if value.hour < 12 else 'PM')
+
+
+# the formats with a hand-written formatter, strftime is much slower
+_formatters = {
+    DATE_FORMAT: _format_date,
+    DATETIME_FORMAT: _format_datetime
+}
+
+
+def date_formatter(fmt):
+    """Returns the function formatting a date by the strftime format"""
+    formatter = _formatters.get(fmt) or (lambda value: value.strftime(fmt))
+
+    def format_date(value):
+        return formatter(value) if value is not None else None
+    return format_date
+
+
+class Serializer(object):
+    """Converts the model's rows to the dictionaries.
+
+    "fields" are the model's column attributes put in the output as is,
+    "dates" maps the date columns to their strftime formats and
+    "id_lists" maps the output keys to the foreign key columns of the
+    related models, e.g. {'claims': models.Claim.member_id}"""
+
+    def __init__(self, model, fields, dates=None, id_lists=None):
+        self.model = model
+        self.dates = dict(dates or {})
+        self.keys = list(fields) + list(dates or {})
+        self.columns = [getattr(model, key) for key in self.keys]
+        self.id_lists = sorted((id_lists or {}).items())
+
+        # (key, row index, converter) per field, the plan is the same
+        # for every row, so it's compiled only once
+        self.plan = [(key, index, None) for index, key in enumerate(fields)]
+        self.plan += [(key, len(fields) + index, date_formatter(fmt))
+                      for index, (key, fmt) in enumerate((dates or {}).items())]
+        self.id_index = self.keys.index('id')
+
+    def select(self):
+        """The query of the serialized columns, the rows it returns
+        may be passed to dump_rows() as is"""
+        return db.session.query(*self.columns)
+
+    def load_id_lists(self, ids):
+        """Returns {output key: {parent id: [related ids]}}, one query
+        per relationship and chunk of the parent IDs"""
+        result = {}
+        for key, column in self.id_lists:
+            related = result[key] = {}
+            id_column = column.class_.id
+            for i in range(0, len(ids), CHUNK_SIZE):
+                query = db.session.query(column, id_column)\
+                                  .filter(column.in_(ids[i:i + CHUNK_SIZE]))\
+                                  .order_by(id_column)
+                for parent_id, related_id in query:
+                    related.setdefault(parent_id, []).append(str(related_id))
+        return result
+
+    def dump_rows(self, rows):
+        """Serializes the tuples with the columns of select()"""
+        plan = self.plan
+        id_index = self.id_index
+        id_lists = self.load_id_lists([row[id_index] for row in rows]) \
+                   if self.id_lists and rows else {}
+
+        results = []
+        for row in rows:
+            data = {}
+            for key, index, convert in plan:
+                value = row[index]
+                data[key] = convert(value) if convert else value
+            for key, related in id_lists.items():
+                data[key] = related.get(row[id_index], [])
+            results.append(data)
+        return results
+
+    def dump_objects(self, objects):
+        """Serializes the model objects"""
+        keys = self.keys
+        return self.dump_rows([tuple(getattr(obj, key) for key in keys)
+                               for obj in objects if obj is not None])
+
+    def dump(self, obj):
+        """Serializes the single model object, None stays None"""
+        if obj is None:
+            return None
+        return self.dump_objects([obj])[0]
+
+    def dump_query(self, query=None):
+        """Serializes the rows of the query of select()"""
+        return self.dump_rows((query if query is not None
+                               else self.select()).all())
+
+
+def json_response(data, status=200):
+    """The compact JSON response, encoded by the fastest available encoder"""
+    return current_app.response_class(to_json(data), status=status,
+                                      mimetype='application/json')
+
+
+member_serializer = Serializer(models.Member,
+    fields=['id', 'photo', 'name', 'email', 'action', 'address',
+            'address_additional', 'tel', 'gender', 'marital_status',
+            'product', 'plan', 'policy_number', 'national_id', 'card_number',
+            'plan_type', 'remarks', 'dependents', 'sequence', 'patient_type',
+            'device_uid'],
+    dates={'dob': DATE_FORMAT, 'start_date': DATE_FORMAT,
+           'effective_date': DATE_FORMAT, 'mature_date': DATE_FORMAT,
+           'exit_date': DATE_FORMAT},
+    id_lists={'claims': models.Claim.member_id})
+
+user_serializer = Serializer(models.User,
+    fields=['id', 'name', 'email', 'user_type', 'role'])
+
+terminal_serializer = Serializer(models.Terminal,
+    fields=['id', 'status', 'serial_number', 'model', 'provider_id',
+            'location', 'version', 'remarks'],
+    dates={'last_update': DATE_FORMAT},
+    id_lists={'claims': models.Claim.terminal_id})
+
+claim_serializer = Serializer(models.Claim,
+    fields=['id', 'status', 'claim_number', 'claim_type', 'admitted',
+            'discharged', 'amount', 'icd_code', 'provider_id', 'member_id',
+            'terminal_id', 'gop_id'],
+    dates={'datetime': DATETIME_FORMAT})
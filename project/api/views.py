@@ -2,13 +2,23 @@ import os, json, re, requests, random
 
 from datetime import datetime
 from functools import wraps
-from flask import jsonify, request, render_template, url_for
+from flask import g, jsonify, request, render_template, url_for
 from sqlalchemy import desc
+from sqlalchemy.exc import IntegrityError
 
 from .helpers import *
-from . import api
-from ..main.helpers import notify
-from .. import db, models, config
+from .serializers import json_response, member_serializer
+from .serializers import user_serializer, terminal_serializer
+from .serializers import claim_serializer
+from .bulk import member_update, user_update, terminal_update, claim_update
+from .bulk import TERMINAL_BATCH_SIZE, import_terminal_claims
+from .bulk import import_users, summary
+from ..dates import DateParseError, parse_date, parse_iso_date
+from ..dates import parse_date_columns, date_errors_message
+from . import api, queue
+from ..main.helpers import notify, notify_async
+from .. import analytics, changes, db, heartbeats, lifecycle, models, config
+from ..database import read_only, unit_of_work
 
 
 def api_auth():
@@ -20,10 +30,33 @@ def api_auth():
             authorized, error, user = authorize_api_key()
             if not authorized:
                 return error
+            # the views acting on the user's behalf take it from here
+            g.api_user = user
             return fn(*args, **kwargs)
         return decorated_view
     return wrapper
 
+
+def member_auth():
+    """Requires the /member/login token of the view's member,
+    the other members' tokens are forbidden"""
+    def wrapper(fn):
+        @wraps(fn)
+        def decorated_view(member_id, *args, **kwargs):
+            token_member_id = authorize_member_token()
+            if token_member_id is None:
+                response = jsonify({'msg': 'missing or invalid token'})
+                response.status_code = 401
+                return response
+            if token_member_id != member_id:
+                response = jsonify({'msg': 'forbidden'})
+                response.status_code = 403
+                return response
+            return fn(member_id, *args, **kwargs)
+        return decorated_view
+    return wrapper
+
+
 # def api_auth(func):
 #     def wrapper(*args, **kwargs):
 #         authorized, error, user = authorize_api_key()
@@ -35,17 +68,17 @@ def api_auth():
 
 @api.route('/members', methods=['GET'])
 @api_auth()
+@read_only
 def members():
     """The function returns all the members"""
 
-    members = models.Member.query.all()
-
     # return the result in a JSON format
-    return jsonify(prepare_members_list(members))
+    return json_response(member_serializer.dump_query())
 
 
 @api.route('/member/<int:member_id>', methods=['GET'])
 @api_auth()
+@read_only
 def member_get(member_id):
     """The function returns the member by its ID"""
 
@@ -57,22 +90,22 @@ def member_get(member_id):
     # return the result in a JSON format.
     # The one request is returned like a list
     # with the single element
-    return jsonify([prepare_member_dict(member)])
+    return json_response([member_serializer.dump(member)])
 
 
 @api.route('/users', methods=['GET'])
 @api_auth()
+@read_only
 def users():
     """The function returns all the users"""
 
-    users = models.User.query.all()
-
     # return the result in a JSON format
-    return jsonify(prepare_users_list(users))
+    return json_response(user_serializer.dump_query())
 
 
 @api.route('/user/<int:user_id>', methods=['GET'])
 @api_auth()
+@read_only
 def user_get(user_id):
     """The function returns the user by its ID"""
 
@@ -84,22 +117,22 @@ def user_get(user_id):
     # return the result in a JSON format.
     # The one request is returned like a list
     # with the single element
-    return jsonify([prepare_user_dict(user)])
+    return json_response([user_serializer.dump(user)])
 
 
 @api.route('/terminals', methods=['GET'])
 @api_auth()
+@read_only
 def terminals():
     """The function returns all the terminals"""
 
-    terminals = models.Terminal.query.all()
-
     # return the result in a JSON format
-    return jsonify(prepare_terminals_list(terminals))
+    return json_response(terminal_serializer.dump_query())
 
 
 @api.route('/terminal/<int:terminal_id>', methods=['GET'])
 @api_auth()
+@read_only
 def terminal_get(terminal_id):
     """The function returns the terminal by its ID"""
 
@@ -111,38 +144,135 @@ def terminal_get(terminal_id):
     # return the result in a JSON format.
     # The one request is returned like a list
     # with the single element
-    return jsonify([prepare_terminal_dict(terminal)])
+    return json_response([terminal_serializer.dump(terminal)])
 
 
 @api.route('/claim', methods=['GET'])
 @api_auth()
+@read_only
 def claim():
     """The function returns all the claims"""
 
-    claims = models.Claim.query.all()
-
     # return the result in a JSON format
-    return jsonify(prepare_claims_list(claims))
+    return json_response(claim_serializer.dump_query())
+
+
+@api.route('/analytics/turnaround', methods=['GET'])
+@api_auth()
+@read_only
+def analytics_turnaround():
+    """Returns the GOPs' turnaround distributions per payer or provider"""
+    try:
+        report = analytics.turnaround(
+            request.args.get('by', 'payer'),
+            int(request.args.get('days', analytics.DEFAULT_DAYS)),
+            request.args.get('payer_id', type=int),
+            request.args.get('provider_id', type=int))
+    except ValueError as e:
+        return 'Error: %s' % e
+
+    return json_response(report)
+
+
+def queue_payer_id(user):
+    """The payer whose GOP queue the user works on, the admins
+    pass the "payer_id" parameter"""
+    if user.get_type() == 'payer' and user.payer:
+        return user.payer.id
+    if user.get_role() == 'admin':
+        return request.args.get('payer_id', type=int)
+    return None
+
+
+@api.route('/gop/queue', methods=['GET'])
+@api_auth()
+def gop_queue():
+    """Returns the page of the payer's pending GOPs, the oldest first"""
+    payer_id = queue_payer_id(g.api_user)
+    if not payer_id:
+        return 'Error: no payer is given'
+
+    try:
+        limit = min(request.args.get('limit', queue.QUEUE_LIMIT, type=int),
+                    queue.QUEUE_MAX_LIMIT)
+        gops, next_cursor = queue.pending(payer_id, g.api_user.id,
+                                          request.args.get('cursor'),
+                                          max(limit, 1))
+    except ValueError:
+        return 'Error: invalid cursor'
+
+    return json_response({'gops': gops, 'cursor': next_cursor})
+
+
+@api.route('/gop/queue/lease', methods=['POST'])
+@api_auth()
+@unit_of_work
+def gop_queue_lease():
+    """Leases the payer's oldest available pending GOPs to the user"""
+    payer_id = queue_payer_id(g.api_user)
+    if not payer_id:
+        return 'Error: no payer is given'
+
+    limit = min(request.args.get('limit', 1, type=int),
+                queue.QUEUE_MAX_LIMIT)
+    gops = queue.lease(payer_id, g.api_user.id, max(limit, 1))
+
+    return json_response({'gops': gops,
+                          'lease_timeout': queue.LEASE_TIMEOUT})
+
+
+@api.route('/gop/<int:gop_id>/release', methods=['POST'])
+@api_auth()
+@unit_of_work
+def gop_release(gop_id):
+    """Releases the user's lease of the GOP"""
+    released = queue.release(gop_id, g.api_user.id)
+
+    return json_response({'released': released})
+
+
+@api.route('/claim/archive', methods=['GET'])
+@api_auth()
+@read_only
+def claim_archive():
+    """Returns the archived claims of the member or the provider,
+    "from" and "to" are the optional dates of the range"""
+    try:
+        claims = lifecycle.archived_claims(
+            member_id=request.args.get('member_id', type=int),
+            provider_id=request.args.get('provider_id', type=int),
+            start=parse_date(request.args.get('from'), 'from'),
+            end=parse_date(request.args.get('to'), 'to'))
+    except DateParseError as e:
+        return 'Error: %s' % e
+
+    return json_response(claim_serializer.dump_objects(claims))
 
 
 @api.route('/claim/<int:claim_id>', methods=['GET'])
 @api_auth()
+@read_only
 def claim_get(claim_id):
     """The function returns the claim by its ID"""
 
     claim = models.Claim.query.get(claim_id)
 
+    # the old claims are in the archive
+    if not claim:
+        claim = next(iter(lifecycle.archived_claims(ids=[claim_id])), None)
+
     if not claim:
         return 'Error: no claim #%d is found' % claim_id
 
     # return the result in a JSON format.
     # The one request is returned like a list
     # with the single element
-    return jsonify([prepare_claim_dict(claim)])
+    return json_response([claim_serializer.dump(claim)])
 
 
 @api.route('/member/add/json', methods=['POST'])
 @api_auth()
+@unit_of_work
 def member_add_json():
     json = request.get_json()
 
@@ -179,10 +309,16 @@ def member_add_json():
         member_dict = from_json_to_dict(row, member_dict)
         members_list.append(member_dict)
 
-    for row_num, row in enumerate(members_list):
-        if not row['name']:
-            return 'Error: the "name" parameter cannot be empty'
+    # the invalid dates reject the whole batch
+    dates, errors = parse_date_columns(members_list, MEMBER_DATE_FIELDS)
+    if errors:
+        return date_errors_message(errors)
 
+    if not all(row['name'] for row in members_list):
+        return 'Error: the "name" parameter cannot be empty'
+
+    members = []
+    for row_num, row in enumerate(members_list):
         member = models.Member(photo=row['photo'],
                                name=row['name'],
                                email=row['email'],
@@ -190,19 +326,14 @@ def member_add_json():
                                address=row['address'],
                                address_additional=row['address_additional'],
                                tel=row['tel'],
-                               dob=datetime.strptime(row['dob'], '%m/%d/%Y'),
+                               dob=dates['dob'][row_num],
                                gender=row['gender'],
                                marital_status=row['marital_status'],
-                               start_date=datetime.strptime(row['start_date'],
-                                                            '%m/%d/%Y'),
-                               effective_date=datetime.strptime(
-                                                row['effective_date'],
-                                                '%m/%d/%Y'),
-                               mature_date=datetime.strptime(
-                                                row['mature_date'],
-                                                '%m/%d/%Y'),
-                               exit_date=datetime.strptime(row['exit_date'],
-                                                           '%m/%d/%Y'),
+                               start_date=dates['start_date'][row_num],
+                               effective_date=\
+                                   dates['effective_date'][row_num],
+                               mature_date=dates['mature_date'][row_num],
+                               exit_date=dates['exit_date'][row_num],
                                product=row['product'],
                                plan=row['plan'],
                                policy_number=\
@@ -216,70 +347,29 @@ def member_add_json():
                                patient_type=row['patient_type'])
 
         db.session.add(member)
-        db.session.commit()
+        members.append(member)
+
+    # the members get their IDs at once
+    db.session.flush()
 
-        members_list[row_num]['id'] = member.id
+    for row, member in zip(members_list, members):
+        row['id'] = member.id
 
     return jsonify(members_list)
 
 
 @api.route('/member/edit/json', methods=['POST'])
 @api_auth()
+@unit_of_work
 def member_edit_json():
+    """Updates the members, the keys of the JSON object are their IDs
+    and the values are the changed fields"""
     json = request.get_json()
 
-    members_list = []
-
-    # the keys of the json dictionary are the IDs of the objects
-    for key, value in json.iteritems():
-        member_id = key
-        member = models.Member.query.get(member_id)
+    if not isinstance(json, dict):
+        return 'Error: the JSON object {"<id>": {<changes>}} is expected'
 
-        if not member:
-            return 'The Member with the ' + \
-                    'id = %s is not found.' % member_id
-
-        # put the found object's data in a dictionary
-        member_dict = prepare_member_dict(member)
-
-        member_dict = from_json_to_dict(value, member_dict, overwrite=True)
-        members_list.append(member_dict)
-
-    for row in members_list:
-        member = models.User.query.get(row['id'])
-
-        if not row['name']:
-            return 'Error: the "name" parameter cannot be empty'
-
-        member.photo = row['photo']
-        member.name = row['name']
-        member.email = row['email']
-        member.action = row['action']
-        member.address = row['address']
-        member.address_additional = row['address_additional']
-        member.tel = row['tel']
-        member.dob = datetime.strptime(row['dob'], '%m/%d/%Y')
-        member.gender = row['gender']
-        member.marital_status = row['marital_status']
-        member.start_date = datetime.strptime(row['start_date'], '%m/%d/%Y')
-        member.effective_date = datetime.strptime(row['effective_date'],
-                                                  '%m/%d/%Y')
-        member.mature_date = datetime.strptime(row['mature_date'], '%m/%d/%Y')
-        member.exit_date = datetime.strptime(row['exit_date'], '%m/%d/%Y')
-        member.product = row['product']
-        member.plan = row['plan']
-        member.policy_number = row['policy_number']
-        member.national_id = row['national_id']
-        member.card_number = row['card_number']
-        member.plan_type = row['plan_type']
-        member.remarks = row['remarks']
-        member.dependents = row['dependents']
-        member.sequence = row['sequence']
-        member.patient_type = row['patient_type']
-
-        db.session.add(member)
-
-    return jsonify(members_list)
+    return json_response(summary(member_update.run(json)))
 
 
 @api.route('/member/login', methods=['POST'])
@@ -293,50 +383,59 @@ def member_login():
     if 'email' not in json or 'password' not in json:
         return jsonify({'msg': 'missing required parameters'})
 
-    user = models.User.query.filter_by(email=json['email'],
-                                       user_type='member').first()
+    user = models.User.by_email(json['email'])\
+                      .filter_by(user_type='member').first()
 
     if user is not None and user.verify_password(json['password']):
-        member = user.member
-
-        claims_list = []
-        claims = member.claims.order_by(desc(models.Claim.datetime))
-        for claim in claims:
-            if claim.datetime:
-                claim_datetime = claim.datetime.strftime('%d/%m/%Y %I:%M %p')
-            else:
-                claim_datetime = None
-            claim_dict = {
-                'id': claim.id,
-                'status': claim.status,
-                'datetime': claim_datetime,
-                'amount': claim.amount,
-                'company': claim.provider.company
-            }
-            claims_list.append(claim_dict)
-
-        if member.dob:
-            member_dob = member.dob.strftime('%Y-%m-%d')
-        else:
-            member_dob = None
-
-        member_dict = {
-            'id': member.id,
-            'name': member.name,
-            'photo': member.photo,
-            'dob': member_dob,
-            'gender': member.gender,
-            'tel': member.tel,
-            'national_id': member.national_id,
-            'claims': claims_list
-        }
-
-        return jsonify({'msg': 'success', 'member': member_dict})
+        # the token authorizes the member's claims and sync endpoints
+        return jsonify({'msg': 'success',
+                        'member': prepare_member_profile(user.member),
+                        'token': member_token(user.member.id)})
     else:
         return jsonify({'msg': 'Wrong email or password'})
 
 
+@api.route('/member/<int:member_id>/claims', methods=['GET'])
+@member_auth()
+@read_only
+def member_claims(member_id):
+    """Returns the page of the member's claims, the latest first,
+    the next page starts after the returned cursor"""
+    try:
+        limit = min(int(request.args.get('limit', MEMBER_CLAIMS_LIMIT)),
+                    MEMBER_CLAIMS_MAX_LIMIT)
+        claims, next_cursor = member_claims_page(
+            member_id, request.args.get('cursor'), max(limit, 1))
+    except ValueError:
+        return jsonify({'msg': 'invalid cursor or limit'})
+
+    return jsonify({'msg': 'success', 'claims': claims,
+                    'cursor': next_cursor})
+
+
+@api.route('/member/<int:member_id>/sync', methods=['GET'])
+@member_auth()
+@read_only
+def member_sync_get(member_id):
+    """Returns the member's changes since the version token
+    of /member/login, /member/info/update or the previous sync"""
+    if not request.args.get('version'):
+        return jsonify({'msg': 'missing version'})
+
+    try:
+        changes = member_sync(member_id, request.args['version'])
+    except ValueError:
+        return jsonify({'msg': 'invalid version'})
+
+    if changes is None:
+        return jsonify({'msg': 'no such member'})
+
+    changes['msg'] = 'success'
+    return jsonify(changes)
+
+
 @api.route('/member/register', methods=['POST'])
+@unit_of_work
 def member_register():
     """Registers a new member"""
     json = request.get_json()
@@ -347,7 +446,7 @@ def member_register():
     if 'email' not in json or 'password' not in json:
         return jsonify({'msg': 'Missing required parameters'})
 
-    user = models.User.query.filter_by(email=json['email']).first()
+    user = models.User.by_email(json['email']).first()
 
     # is user with such email exists, reuturn an error
     if user:
@@ -357,7 +456,6 @@ def member_register():
         user = models.User(email=json['email'], password=json['password'],
                            user_type='member', member=member)
         db.session.add(user)
-        db.session.commit()
 
         return jsonify({'msg': 'success'})
 
@@ -370,6 +468,7 @@ def member_logout():
 
 
 @api.route('/member/info/update', methods=['POST'])
+@unit_of_work
 def member_info_update():
     """Updates general member's info"""
     json = request.get_json()
@@ -401,179 +500,54 @@ def member_info_update():
         member.photo = filename
 
     try:
-        member.dob = datetime.strptime(json['dob'], '%Y-%m-%d')
-    except:
+        member.dob = parse_iso_date(json.get('dob'), 'dob')
+    except DateParseError:
         member.dob = None
     member.gender = json['gender']
     member.tel = json['tel']
     member.national_id = json['national_id']
 
     db.session.add(member)
-    db.session.commit()
+    db.session.flush()
 
-    claims_list = []
-    claims = member.claims.order_by(desc(models.Claim.datetime))
-    for claim in claims:
-        if claim.datetime:
-            claim_datetime = claim.datetime.strftime('%d/%m/%Y %I:%M %p')
-        else:
-            claim_datetime = None
-        claim_dict = {
-            'id': claim.id,
-            'status': claim.status,
-            'datetime': claim_datetime,
-            'amount': claim.amount,
-            'company': claim.provider.company
-        }
-        claims_list.append(claim_dict)
-
-    if member.dob:
-        member_dob = member.dob.strftime('%Y-%m-%d')
-    else:
-        member_dob = None
-
-    member_dict = {
-        'id': member.id,
-        'name': member.name,
-        'photo': member.photo,
-        'dob': member_dob,
-        'gender': member.gender,
-        'tel': member.tel,
-        'national_id': member.national_id,
-        'claims': claims_list
-    }
-
-    return jsonify({'msg': 'success', 'member': member_dict})
+    return jsonify({'msg': 'success', 'member': prepare_member_profile(member)})
 
 
 @api.route('/user/add/json', methods=['POST'])
 @api_auth()
+@unit_of_work
 def user_add_json():
+    """Creates the users of the JSON list, all of them or none"""
     json = request.get_json()
 
-    users_list = []
-
-    for row in json:
-        user_dict = {
-            'name': None,
-            'email': None,
-            'role': None,
-            'password': None,
-            'setup_serial_number': None,
-            'setup_server_url': None,
-            'setup_server_port': None,
-            'setup_module_name': None,
-            'setup_proxy_url': None,
-            'setup_proxy_port': None,
-            'setup_username': None,
-            'setup_password': None,
-            'setup_request_url': None,
-            'setup_default_path': None,
-            'setup_language': None,
-        }
-
-        user_dict = from_json_to_dict(row, user_dict)
-        users_list.append(user_dict)
-
-    for row_num, row in enumerate(users_list):
-        if not row['name']:
-            return 'Error: the "name" parameter cannot be empty'
-
-        if not row['email']:
-            return 'Error: the "email" parameter cannot be empty'
-
-        if not row['password']:
-            return 'Error: the "password" parameter cannot be empty'
-
-        if models.User.query.filter_by(
-          email=row['email']).first():
-            return 'Error: the "email" is already registered'
-
-        user = models.User(name=row['name'],
-                           email=row['email'],
-                           role=row['role'],
-                           password=row['password'],
-                           setup_serial_number=row['setup_serial_number'],
-                           setup_server_url=row['setup_server_url'],
-                           setup_server_port=row['setup_server_port'],
-                           setup_module_name=row['setup_module_name'],
-                           setup_proxy_url=row['setup_proxy_url'],
-                           setup_proxy_port=row['setup_proxy_port'],
-                           setup_username=row['setup_username'],
-                           setup_password=row['setup_password'],
-                           setup_request_url=row['setup_request_url'],
-                           setup_default_path=row['setup_default_path'],
-                           setup_language=row['setup_language'])
+    if not isinstance(json, list):
+        return 'Error: the JSON list of the users is expected'
 
-        db.session.add(user)
-        db.session.commit()
+    users, errors = import_users(json)
 
-        users_list[row_num]['id'] = user.id
+    if errors:
+        return json_response({'errors': errors}, status=400)
 
-    return jsonify(users_list)
+    return json_response(users)
 
 
 @api.route('/user/edit/json', methods=['POST'])
 @api_auth()
+@unit_of_work
 def user_edit_json():
+    """Updates the users, the keys of the JSON object are their IDs
+    and the values are the changed fields"""
     json = request.get_json()
 
-    users_list = []
-
-    # the keys of the json dictionary are the IDs of the objects
-    for key, value in json.iteritems():
-        user_id = key
-        user = models.User.query.get(user_id)
-
-        if not user:
-            return 'The User with the ' + \
-                    'id = %s is not found.' % user_id
-
-        # put the found object's data in a dictionary
-        user_dict = prepare_user_dict(user)
-
-        user_dict = from_json_to_dict(value, user_dict, overwrite=True)
-        users_list.append(user_dict)
+    if not isinstance(json, dict):
+        return 'Error: the JSON object {"<id>": {<changes>}} is expected'
 
-    for row in users_list:
-        user = models.User.query.get(row['id'])
-
-        if not row['name']:
-            return 'Error: the "name" parameter cannot be empty'
-
-        if not row['email']:
-            return 'Error: the "email" parameter cannot be empty'
-
-        if not row['password']:
-            return 'Error: the "password" parameter cannot be empty'
-
-        if models.User.query.filter_by(
-          email=row['email']).first():
-            return 'Error: the "email" is already registered'
-
-        user.name = row['name']
-        user.email = row['email']
-        user.role = row['role']
-        user.password = row['password']
-        user.setup_serial_number = row['setup_serial_number']
-        user.setup_server_url = row['setup_server_url']
-        user.setup_server_port = row['setup_server_port']
-        user.setup_module_name = row['setup_module_name']
-        user.setup_proxy_url = row['setup_proxy_url']
-        user.setup_proxy_port = row['setup_proxy_port']
-        user.setup_username = row['setup_username']
-        user.setup_password = row['setup_password']
-        user.setup_request_url = row['setup_request_url']
-        user.setup_default_path = row['setup_default_path']
-        user.setup_language = row['setup_language']
-
-        db.session.add(user)
-
-    return jsonify(users_list)
+    return json_response(summary(user_update.run(json)))
 
 
 @api.route('/terminal/add/json', methods=['POST'])
 @api_auth()
+@unit_of_work
 def terminal_add_json():
     json = request.get_json()
 
@@ -594,74 +568,54 @@ def terminal_add_json():
         terminal_dict = from_json_to_dict(row, terminal_dict)
         terminals_list.append(terminal_dict)
 
-    for row_num, row in enumerate(temrinals_list):
+    dates, errors = parse_date_columns(terminals_list, ['last_update'])
+    if errors:
+        return date_errors_message(errors)
+
+    for row in terminals_list:
         if not models.User.query.get(row['user_id']):
             return 'Error: no user #%d is found' % row['user_id']
 
+    terminals = []
+    for row_num, row in enumerate(terminals_list):
         terminal = models.Terminal(status=row['status'],
                                    serial_number=row['serial_number'],
                                    model=row['model'],
                                    user_id=row['user_id'],
                                    location=row['location'],
                                    version=row['version'],
-                                   last_update=datetime.strptime(
-                                                 row['last_update'],
-                                                 '%m/%d/%Y'),
+                                   last_update=\
+                                       dates['last_update'][row_num],
                                    remarks=row['remarks'])
 
         db.session.add(terminal)
-        db.session.commit()
+        terminals.append(terminal)
+
+    db.session.flush()
 
-        terminals_list[row_num]['id'] = terminal.id
+    for row, terminal in zip(terminals_list, terminals):
+        row['id'] = terminal.id
 
     return jsonify(terminals_list)
 
 
 @api.route('/terminal/edit/json', methods=['POST'])
 @api_auth()
+@unit_of_work
 def terminal_edit_json():
+    """Updates the terminals, the keys of the JSON object are their IDs
+    and the values are the changed fields"""
     json = request.get_json()
 
-    terminals_list = []
-
-    # the keys of the json dictionary are the IDs of the objects
-    for key, value in json.iteritems():
-        terminal_id = key
-        terminal = models.Terminal.query.get(terminal_id)
-
-        if not terminal:
-            return 'The Terminal with the ' + \
-                    'id = %s is not found.' % terminal_id
+    if not isinstance(json, dict):
+        return 'Error: the JSON object {"<id>": {<changes>}} is expected'
 
-        # put the found object's data in a dictionary
-        terminal_dict = prepare_terminal_dict(terminal)
-
-        terminal_dict = from_json_to_dict(value, terminal_dict, overwrite=True)
-        terminals_list.append(terminal_dict)
-
-    for row in terminals_list:
-        terminal = models.Terminal.query.get(row['id'])
-
-        if not models.User.query.get(row['user_id']):
-            return 'Error: no user #%d is found' % row['user_id']
-
-        terminal.status = row['status']
-        terminal.serial_number = row['serial_number']
-        terminal.model = row['model']
-        terminal.user_id = row['user_id']
-        terminal.location = row['location']
-        terminal.version = row['version']
-        terminal.last_update = datetime.strptime(row['last_update'],
-                                                 '%m/%d/%Y')
-        terminal.remarks = row['remarks']
-
-        db.session.add(terminal)
-
-    return jsonify(terminals_list)
+    return json_response(summary(terminal_update.run(json)))
 
 
 @api.route('/terminal/add', methods=['POST'])
 @api_auth()
+@unit_of_work
 def terminal_add():
     json_ = request.get_json()
 
@@ -673,11 +627,10 @@ def terminal_add():
         terminal = models.Terminal(device_uid=json_['uid'],
                                    provider_id=user.provider.id)
         db.session.add(terminal)
-        db.session.commit()
+        db.session.flush()
     elif terminal not in user.provider.terminals:
         user.provider.terminals.append(terminal)
         db.session.add(user.provider)
-        db.session.commit()
 
     # returns the url on the current terminal's edit page
     # it will redirect the user of the 1TAP desktop app to this page
@@ -688,6 +641,7 @@ def terminal_add():
 
 @api.route('/claim/check-new', methods=['GET'])
 @api_auth()
+@unit_of_work
 def claim_check_new():
     json_ = request.get_json()
 
@@ -699,13 +653,12 @@ def claim_check_new():
         claim.new_claim = 0
         db.session.add(claim)
 
-    db.session.commit()
-
     return jsonify(claims_urls)
 
 
 @api.route('/claim/add', methods=['POST'])
 @api_auth()
+@unit_of_work
 def claim_add():
     json_ = request.get_json()
 
@@ -717,25 +670,23 @@ def claim_add():
         member = models.Member(device_uid=json_['uid'])
         member.providers.append(user.provider)
         db.session.add(member)
-        db.session.commit()
     elif user.provider not in member.providers:
         member.providers.append(user.provider)
         db.session.add(member)
-        db.session.commit()
 
     # add new claim
     claim = models.Claim(datetime=datetime.now(),
                          provider_id=user.provider.id,
-                         member_id=member.id)
+                         member=member)
 
     db.session.add(claim)
-    db.session.commit()
+    db.session.flush()
 
     notification = """A <a href="%s" target="_blank">new claim #%d</a>
         has been added!""" % (url_for('main.claim', claim_id=claim.id),
         claim.id)
 
-    notify('id' + str(provider.user.id), notification)
+    db.after_commit(notify, 'id' + str(provider.user.id), notification)
 
     # returns the url on the current claim's edit page
     # it will redirect the user of the 1TAP desktop app to this page
@@ -744,64 +695,176 @@ def claim_add():
     }])
 
 
+@api.route('/terminal/heartbeat', methods=['POST'])
+def terminal_heartbeat():
+    """Records the terminal's status, the database is updated
+    by the periodic flush (manage.py flush_heartbeats)"""
+    json = request.get_json()
+
+    if not json or 'terminal_uid' not in json:
+        return jsonify({'msg': 'Not enough parameters'})
+
+    terminal = resolve_terminal(json['terminal_uid'])
+
+    if not terminal:
+        return jsonify({'msg': 'No such terminal'})
+
+    heartbeats.record(terminal.id, json.get('status'), json.get('version'))
+
+    return jsonify({'msg': 'success'})
+
+
+@api.route('/terminals/status', methods=['GET'])
+@api_auth()
+def terminals_status():
+    """Returns the live status of the terminals which have reported"""
+    terminals = sorted(heartbeats.fleet_status().values(),
+                       key=lambda state: state['id'])
+
+    for state in terminals:
+        state['last_update'] = state['last_update']\
+                               .strftime('%m/%d/%Y %I:%M:%S %p')
+
+    online = sum(1 for state in terminals if state['online'])
+
+    return json_response({'online': online,
+                          'offline': len(terminals) - online,
+                          'terminals': terminals})
+
+
 @api.route('/claim/add-by-terminal', methods=['POST'])
+@unit_of_work
 def claim_add_by_terminal():
     json = request.get_json()
 
-    if 'user_id' not in json or 'terminal_uid' not in json:
+    if not json or 'user_id' not in json or 'terminal_uid' not in json:
         return jsonify({'msg': 'Not enough parameters'})
 
-    # find the member with the given id
-    member = models.Member.query.filter_by(id=json['user_id']).first()
+    # find the terminal with the given device_uid,
+    # the terminal's provider is resolved from the cache
+    terminal = resolve_terminal(json['terminal_uid'])
 
-    # find the terminal with the given device_uid
-    terminal = models.Terminal.query.filter_by(
-        device_uid=json['terminal_uid']).first()
+    if not terminal or not terminal.provider_id:
+        return jsonify({'msg': 'No such terminal'})
 
-    if not member:
-        return jsonify({'msg': 'No such member'})
+    # the terminals retry on timeouts, if the claim with the same
+    # idempotency key exists, it is returned instead of the new one
+    key = idempotency_key(json)
 
-    if not terminal:
-        return jsonify({'msg': 'No such terminal'})
+    if key:
+        claim_id = find_idempotent_claim(terminal.id, key)
+        if claim_id:
+            return claim_add_by_terminal_replay(claim_id, terminal)
+
+    # find the member with the given id and check at once
+    # if he has already visited the terminal's provider
+    linked = member_provider_link(json['user_id'], terminal.provider_id)
 
-    provider = terminal.provider
+    if linked is None:
+        return jsonify({'msg': 'No such member'})
 
     # if it's the first visit to the hospital,
     # add the provider to member's providers list
-    if provider not in member.providers:
-        member.providers.append(provider)
-        db.session.add(member)
-        db.session.commit()
+    if not linked:
+        db.session.execute(models.custom_members.insert().values(
+            member_id=json['user_id'], provider_id=terminal.provider_id))
+        changes.record(db.session, 'member', [json['user_id']],
+                       columns=('providers',))
 
-    # add new claim
+    # add new claim, the link and the claim are saved in one transaction
     claim = models.Claim(datetime=datetime.now(),
-                         provider_id=provider.id,
+                         provider_id=terminal.provider_id,
                          terminal_id=terminal.id,
-                         member_id=member.id,
+                         member_id=json['user_id'],
+                         idempotency_key=key,
                          new_claim=1)
 
     db.session.add(claim)
-    db.session.commit()
-
-    notification = """A <a href="%s" target="_blank">new claim #%d</a>
-        has been added!""" % (url_for('main.claim', claim_id=claim.id),
-        claim.id)
-    notify('id' + str(provider.user.id), notification)
 
-    claim_dict = {
-        'id': claim.id,
-        'status': claim.status,
-        'datetime': claim.datetime.strftime('%d/%m/%Y %I:%M %p'),
-        'amount': claim.amount,
-        'company': claim.provider.company
-    }
+    try:
+        db.session.flush()
+        if key:
+            db.session.execute(models.ClaimIdempotencyKey.__table__.insert(),
+                               {'terminal_id': terminal.id,
+                                'idempotency_key': key,
+                                'claim_id': claim.id})
+    except IntegrityError:
+        # the concurrent retry has saved the claim first
+        db.session.rollback()
+        claim_id = find_idempotent_claim(terminal.id, key)
+        if not key or not claim_id:
+            raise
+        return claim_add_by_terminal_replay(claim_id, terminal)
+
+    claim_dict = prepare_terminal_claim_dict(claim, terminal.company)
+
+    if key:
+        db.after_commit(remember_idempotent_claim, terminal.id, key,
+                        claim_dict['id'])
+
+    if terminal.provider_user_id:
+        notification = """A <a href="%s" target="_blank">new claim #%d</a>
+            has been added!""" % (url_for('main.claim',
+            claim_id=claim_dict['id']), claim_dict['id'])
+        db.after_commit(notify_async, 'id' + str(terminal.provider_user_id),
+                        notification)
 
     # returns successful json
     return jsonify({'msg': 'success', 'claim': claim_dict})
 
 
+@api.route('/claim/add-by-terminal/batch', methods=['POST'])
+@unit_of_work
+def claim_add_by_terminal_batch():
+    """Creates the claims the terminals have queued while offline, the body
+    is {"terminal_uid": ..., "claims": [...]} and may be gzip-compressed.
+    The claims uploaded before are returned as the duplicates, so the
+    terminals may retry the whole batch"""
+    json = request_json()
+
+    if not isinstance(json, dict) or not isinstance(json.get('claims'), list):
+        return jsonify({'msg': 'Not enough parameters'})
+
+    if len(json['claims']) > TERMINAL_BATCH_SIZE:
+        return jsonify({'msg': 'Too many claims, the limit is %d' % \
+                               TERMINAL_BATCH_SIZE})
+
+    try:
+        results, providers = import_terminal_claims(json['claims'],
+                                                    json.get('terminal_uid'))
+    except IntegrityError:
+        # the concurrent retry of the batch has saved some claims first,
+        # they are the duplicates now
+        db.session.rollback()
+        results, providers = import_terminal_claims(json['claims'],
+                                                    json.get('terminal_uid'))
+
+    # one notification per provider for the whole batch
+    for provider_user_id, amount in providers.items():
+        notification = """%d <a href="%s" target="_blank">new claims</a>
+            have been added!""" % (amount, url_for('main.claims'))
+        db.after_commit(notify_async, 'id' + str(provider_user_id),
+                        notification)
+
+    return json_response({'msg': 'success', 'claims': results})
+
+
+def claim_add_by_terminal_replay(claim_id, terminal):
+    """Returns the response of the original idempotent claim submission"""
+    claim = db.session.query(models.Claim.id, models.Claim.status,
+                             models.Claim.datetime, models.Claim.amount)\
+                      .filter(models.Claim.id == claim_id).first()
+
+    response = jsonify({'msg': 'success',
+        'claim': prepare_terminal_claim_dict(claim, terminal.company)})
+    response.headers['Idempotent-Replayed'] = 'true'
+
+    return response
+
+
 @api.route('/claim/add/json', methods=['POST'])
 @api_auth()
+@unit_of_work
 def claim_add_json():
     json = request.get_json()
 
@@ -826,7 +889,11 @@ def claim_add_json():
         claim_dict = from_json_to_dict(row, claim_dict)
         claims_list.append(claim_dict)
 
-    for row_num, row in enumerate(claims_list):
+    dates, errors = parse_date_columns(claims_list, ['datetime'])
+    if errors:
+        return date_errors_message(errors)
+
+    for row in claims_list:
         if not models.User.query.get(row['user_id']):
             return 'Error: no user #%d is found' % row['user_id']
 
@@ -836,11 +903,9 @@ def claim_add_json():
         if not models.Terminal.query.get(row['terminal_id']):
             return 'Error: no terminal #%d is found' % row['terminal_id']
 
-        if 'datetime' in row and row['datetime']:
-            claim_datetime = datetime.strptime(row['datetime'],
-                                                 '%m/%d/%Y')
-        else:
-            claim_datetime = datetime.now()
+    claims = []
+    for row_num, row in enumerate(claims_list):
+        claim_datetime = dates['datetime'][row_num] or datetime.now()
 
         claim = models.Claim(status=row['status'],
                              claim_number=row['claim_number'],
@@ -856,61 +921,25 @@ def claim_add_json():
                              medipay_id=row['medipay_id'])
 
         db.session.add(claim)
-        db.session.commit()
+        claims.append(claim)
+
+    db.session.flush()
 
-        claims_list[row_num]['id'] = claim.id
+    for row, claim in zip(claims_list, claims):
+        row['id'] = claim.id
 
     return jsonify(claims_list)
 
 
 @api.route('/claim/edit/json', methods=['POST'])
 @api_auth()
+@unit_of_work
 def claim_edit_json():
+    """Updates the claims, the keys of the JSON object are their IDs
+    and the values are the changed fields"""
     json = request.get_json()
 
-    claims_list = []
-
-    # the keys of the json dictionary are the IDs of the objects
-    for key, value in json.iteritems():
-        claim_id = key
-        claim = models.Claim.query.get(claim_id)
-
-        if not claim:
-            return 'The Claim with the ' + \
-                    'id = %s is not found.' % claim_id
-
-        # put the found object's data in a dictionary
-        claim_dict = prepare_claim_dict(claim)
-
-        claim_dict = from_json_to_dict(value, claim_dict,
-                                             overwrite=True)
-        claim_list.append(claim_dict)
-
-    for row in claims_list:
-        claim = models.Claim.query.get(row['id'])
-
-        if not models.User.query.get(row['user_id']):
-            return 'Error: no user #%d is found' % row['user_id']
-
-        if not models.Member.query.get(row['member_id']):
-            return 'Error: no member #%d is found' % row['member_id']
-
-        if not models.Terminal.query.get(row['terminal_id']):
-            return 'Error: no terminal #%d is found' % row['terminal_id']
-
-        claim.status = row['status']
-        claim.claim_number = row['claim_number']
-        claim.claim_type = row['claim_type']
-        claim.datetime = datetime.strptime(row['datetime'], '%m/%d/%Y')
-        claim.admitted = row['admitted']
-        claim.discharged = row['discharged']
-        claim.amount = row['amount']
-        claim.icd_code = row['icd_code']
-        claim.user_id = row['user_id']
-        claim.member_id = row['member_id']
-        claim.medipay_id = row['medipay_id']
-        claim.terminal_id = row['terminal_id']
-
-        db.session.add(claim)
+    if not isinstance(json, dict):
+        return 'Error: the JSON object {"<id>": {<changes>}} is expected'
 
-    return jsonify(claims_list)
\ No newline at end of file
+    return json_response(summary(claim_update.run(json)))
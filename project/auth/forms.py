@@ -46,6 +46,6 @@ class ForgotPasswordForm(BaseForm):
     submit = SubmitField('Submit')
 
     def validate_email(self, field):
-        if not User.query.filter_by(email=field.data).first():
+        if not User.by_email(field.data).first():
             raise ValidationError('The email is not found.')
 
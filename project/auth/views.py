@@ -7,6 +7,8 @@ from flask_mail import Message
 from . import auth
 from .. import mail
 from ..models import db, User
+from ..database import unit_of_work
+from ..sessions import regenerate_session
 from .forms import LoginForm, ForgotPasswordForm
 
 
@@ -15,10 +17,12 @@ def pass_generator(size=6, chars=string.ascii_uppercase + string.digits):
 
 
 def login_validation(form):
-    user = User.query.filter_by(email=form.email.data).first()
+    user = User.by_email(form.email.data).first()
 
     if user is not None and user.verify_password(form.password.data):
         login_user(user, form.remember_me.data)
+        # the session id used before the login is not trusted
+        regenerate_session(session)
         return redirect(request.args.get('next') or url_for('main.index'))
     else:
         flash('Invalid username or password.')
@@ -42,16 +46,18 @@ def login():
 @login_required
 def logout():
     logout_user()
+    regenerate_session(session)
     #flash('You have been logged out.')
     return redirect(url_for('main.index'))
 
 
 @auth.route('/forgot-password', methods=['GET', 'POST'])
+@unit_of_work
 def forgot_password():
     form = ForgotPasswordForm()
 
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = User.by_email(form.email.data).first()
         rand_pass = pass_generator(size=8)
         user.password = rand_pass
         db.session.add(user)
@@ -68,7 +74,8 @@ def forgot_password():
         Password: %s</p>
         """ % (user.email, rand_pass)
 
-        mail.send(msg)
+        # the new password is sent once it's saved
+        db.after_commit(mail.send, msg)
         flash('Please, check your email for a new password.')
         return redirect(url_for('auth.login'))
 
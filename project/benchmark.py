@@ -0,0 +1,453 @@
+"""Benchmark suite for the hot endpoints. It generates a synthetic dataset in
+a dedicated database, drives the endpoints through the Flask test client and
+reports throughput, latency percentiles and SQL query counts as JSON, so the
+reports of different commits can be compared."""
+import json, os, random, subprocess, tempfile, time
+
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event
+
+from . import create_app, db, synthetic
+from .api import helpers, serializers
+
+# the registered scenarios in the order they are run
+SCENARIOS = []
+
+
+class Scenario(object):
+    def __init__(self, name, func, login=None, target_ms=None):
+        self.name = name
+        self.func = func
+        self.login = login
+        self.target_ms = target_ms
+
+
+def scenario(name, login=None, target_ms=None):
+    """Registers a benchmark scenario. The decorated function takes
+    the test client, the synthetic dataset IDs and a random generator
+    and performs a single request, returning the response.
+    The optional target_ms is the p50 latency the scenario should meet"""
+    def wrapper(func):
+        SCENARIOS.append(Scenario(name, func, login, target_ms))
+        return func
+    return wrapper
+
+
+class QueryCounter(object):
+    """Counts the SQL statements executed by the given engine"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+    def remove(self):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of the sorted values"""
+    if not values:
+        return None
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def _post_json(client, url, data):
+    return client.post(url, data=json.dumps(data),
+                       content_type='application/json')
+
+
+@scenario('index', login='provider')
+def index(client, ids, rnd):
+    return client.get('/')
+
+
+@scenario('search', login='provider')
+def search(client, ids, rnd):
+    return client.get('/search?query=open')
+
+
+@scenario('member_lookup', login='provider')
+def member_lookup(client, ids, rnd):
+    query = rnd.choice(['NID%06d' % (rnd.choice(ids['members']) // 1000),
+                        'POL%09d' % rnd.choice(ids['members']),
+                        rnd.choice(['ab', 'ka', 'mo', 'ti'])])
+    return client.get('/member/lookup?q=' + query)
+
+
+@scenario('icd_code_search', login='provider')
+def icd_code_search(client, ids, rnd):
+    return client.get('/icd-code/search?query=ab')
+
+
+@scenario('claim_add_by_terminal', target_ms=10)
+def claim_add_by_terminal(client, ids, rnd):
+    return _post_json(client, '/api/claim/add-by-terminal', {
+        'user_id': rnd.choice(ids['members']),
+        'terminal_uid': rnd.choice(ids['terminal_uids'])})
+
+
+@scenario('claim_add_by_terminal_batch')
+def claim_add_by_terminal_batch(client, ids, rnd):
+    batch = rnd.randint(0, 10 ** 9)
+    return _post_json(client, '/api/claim/add-by-terminal/batch', {
+        'terminal_uid': rnd.choice(ids['terminal_uids']),
+        'claims': [{'id': '%d-%d' % (batch, num),
+                    'user_id': rnd.choice(ids['members']),
+                    'datetime': '01/15/2017 09:%02d AM' % num}
+                   for num in range(50)]})
+
+
+@scenario('terminal_heartbeat')
+def terminal_heartbeat(client, ids, rnd):
+    return _post_json(client, '/api/terminal/heartbeat', {
+        'terminal_uid': rnd.choice(ids['terminal_uids']),
+        'status': 'active', 'version': '1.0'})
+
+
+@scenario('claim_check_new')
+def claim_check_new(client, ids, rnd):
+    return client.get('/api/claim/check-new?api_key=%s' % synthetic.API_KEY)
+
+
+@scenario('member_add_json')
+def member_add_json(client, ids, rnd):
+    rows = []
+    for num in range(20):
+        rows.append({
+            'photo': None, 'name': 'Bulk Member %d' % num,
+            'email': 'bulk.%d@example.com' % num, 'action': None,
+            'address': None, 'address_additional': None, 'tel': None,
+            'dob': '01/31/1980', 'gender': 'male', 'marital_status': 'single',
+            'start_date': '01/01/2016', 'effective_date': '01/01/2016',
+            'mature_date': '01/01/2026', 'exit_date': '01/01/2026',
+            'product': None, 'plan': None, 'policy_number': 'BULK%d' % num,
+            'national_id': 'BULK%d' % num, 'card_number': None,
+            'plan_type': None, 'remarks': None, 'dependents': None,
+            'sequence': None, 'patient_type': 'in'})
+    return _post_json(client, '/api/member/add/json?api_key=%s' % \
+                      synthetic.API_KEY, rows)
+
+
+@scenario('member_edit_json')
+def member_edit_json(client, ids, rnd):
+    edits = {}
+    for member_id in rnd.sample(ids['members'], 20):
+        edits[str(member_id)] = {'remarks': 'corrected %d' % rnd.randint(0, 9),
+                                 'dob': '01/%02d/1980' % rnd.randint(1, 28)}
+    return _post_json(client, '/api/member/edit/json?api_key=%s' % \
+                      synthetic.API_KEY, edits)
+
+
+@scenario('user_add_json')
+def user_add_json(client, ids, rnd):
+    batch = rnd.randint(0, 10 ** 9)
+    return _post_json(client, '/api/user/add/json?api_key=%s' % \
+                      synthetic.API_KEY, [
+                          {'name': 'Staff %d' % num, 'user_type': 'provider',
+                           'email': 'staff.%d.%d@example.com' % (batch, num),
+                           'role': 'user', 'password': 'password'}
+                          for num in range(20)])
+
+
+def _member_headers(client, member_id):
+    # the token of /member/login
+    with client.application.app_context():
+        return {'X-Member-Token': helpers.member_token(member_id)}
+
+
+@scenario('member_claims')
+def member_claims(client, ids, rnd):
+    member_id = rnd.choice(ids['members'])
+    return client.get('/api/member/%d/claims' % member_id,
+                      headers=_member_headers(client, member_id))
+
+
+@scenario('member_sync')
+def member_sync(client, ids, rnd):
+    member_id = rnd.choice(ids['members'])
+    return client.get('/api/member/%d/sync?version=%s' % (
+        member_id, helpers.sync_version()),
+        headers=_member_headers(client, member_id))
+
+
+@scenario('analytics_turnaround')
+def analytics_turnaround(client, ids, rnd):
+    return client.get('/api/analytics/turnaround?api_key=%s&days=%d' % (
+        synthetic.API_KEY, rnd.randint(30, 730)))
+
+
+@scenario('claim_series', login='provider')
+def claim_series(client, ids, rnd):
+    return client.get('/claims/series?start=%s&bucket=%s' % (
+        (datetime.now().date() - timedelta(days=rnd.randint(30, 900)))
+        .isoformat(), rnd.choice(['day', 'week', 'month'])))
+
+
+@scenario('gop_queue')
+def gop_queue(client, ids, rnd):
+    return client.get('/api/gop/queue?api_key=%s&payer_id=%d' % (
+        synthetic.API_KEY, rnd.choice(ids['payers'])))
+
+
+@scenario('gop_queue_lease')
+def gop_queue_lease(client, ids, rnd):
+    return client.post('/api/gop/queue/lease?api_key=%s&payer_id=%d&'
+                       'limit=5' % (synthetic.API_KEY,
+                                    rnd.choice(ids['payers'])))
+
+
+@scenario('api_members')
+def api_members(client, ids, rnd):
+    return client.get('/api/members?api_key=%s' % synthetic.API_KEY)
+
+
+@scenario('api_claims')
+def api_claims(client, ids, rnd):
+    return client.get('/api/claim?api_key=%s' % synthetic.API_KEY)
+
+
+@scenario('api_terminals')
+def api_terminals(client, ids, rnd):
+    return client.get('/api/terminals?api_key=%s' % synthetic.API_KEY)
+
+
+@scenario('api_users')
+def api_users(client, ids, rnd):
+    return client.get('/api/users?api_key=%s' % synthetic.API_KEY)
+
+
+def _helper_dicts(serializer, objects):
+    # the conversion of the former prepare_*_dict helpers: attribute by
+    # attribute, strftime per date and a query per relationship per row
+    results = []
+    for obj in objects:
+        data = {}
+        for key in serializer.keys:
+            value = getattr(obj, key)
+            if key in serializer.dates and value is not None:
+                value = value.strftime(serializer.dates[key])
+            data[key] = value
+        for key, column in serializer.id_lists:
+            data[key] = [str(related.id) for related in getattr(obj, key)]
+        results.append(data)
+    return results
+
+
+def run_serializers(app, iterations=3):
+    """Compares the rows per second of the API serializers with the
+    former helpers (model objects and the pretty-printed jsonify output)"""
+    results = {}
+    with app.app_context():
+        for name, serializer in [('members', serializers.member_serializer),
+                                 ('claims', serializers.claim_serializer),
+                                 ('terminals',
+                                  serializers.terminal_serializer),
+                                 ('users', serializers.user_serializer)]:
+            helpers_time = serializer_time = None
+            for _ in range(iterations):
+                db.session.expunge_all()
+                started = time.time()
+                objects = serializer.model.query.all()
+                json.dumps(_helper_dicts(serializer, objects), indent=2)
+                elapsed = time.time() - started
+                helpers_time = min(helpers_time or elapsed, elapsed)
+
+                db.session.expunge_all()
+                started = time.time()
+                data = serializer.dump_query()
+                serializers.to_json(data)
+                elapsed = time.time() - started
+                serializer_time = min(serializer_time or elapsed, elapsed)
+
+            rows = len(data)
+            results[name] = {
+                'rows': rows,
+                'helpers_rows_per_s': rows / helpers_time,
+                'serializer_rows_per_s': rows / serializer_time,
+                'speedup': helpers_time / serializer_time
+            }
+    return results
+
+
+def _login(client, email):
+    return client.post('/auth/login', data={'email': email,
+                                            'password': synthetic.PASSWORD})
+
+
+def run_scenario(app, scenario, ids, iterations, rnd, counter):
+    client = app.test_client()
+
+    if scenario.login:
+        _login(client, ids['logins'][scenario.login])
+
+    latencies = []
+    status_codes = {}
+    errors = 0
+    queries = 0
+
+    started = time.time()
+    for _ in range(iterations):
+        counter.count = 0
+        request_started = time.time()
+        try:
+            response = scenario.func(client, ids, rnd)
+            status = response.status_code
+        except Exception:
+            # the broken endpoints are counted, not fatal for the suite
+            status = 'exception'
+        latencies.append((time.time() - request_started) * 1000)
+        queries += counter.count
+
+        status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+        if status == 'exception' or status >= 400:
+            errors += 1
+    elapsed = time.time() - started
+
+    latencies.sort()
+
+    result = {
+        'requests': iterations,
+        'errors': errors,
+        'status_codes': status_codes,
+        'throughput_rps': iterations / elapsed if elapsed else None,
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1]
+        },
+        'queries_per_request': float(queries) / iterations
+    }
+
+    if scenario.target_ms:
+        result['target_ms'] = scenario.target_ms
+        result['target_met'] = result['latency_ms']['p50'] <= \
+                               scenario.target_ms
+
+    return result
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def setup(sizes=None, database_uri=None, seed=1, drop_existing=False):
+    """Creates the testing app on the given database (a temporary SQLite
+    file by default) filled with the synthetic dataset, the database is
+    emptied first. Raises ValueError if the given database has tables
+    and "drop_existing" is not set.
+    Returns the app, the database URI and the dataset IDs"""
+    path = None
+    if database_uri and not drop_existing:
+        engine = create_engine(database_uri)
+        try:
+            tables = engine.table_names()
+        finally:
+            engine.dispose()
+        if tables:
+            raise ValueError('the database has tables (%s), they would be '
+                             'dropped' % ', '.join(sorted(tables)[:5]))
+    if not database_uri:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='benchmark-')
+        os.close(handle)
+        database_uri = 'sqlite:///' + path
+
+    app = create_app('testing')
+    app.config.update(SQLALCHEMY_DATABASE_URI=database_uri,
+                      WTF_CSRF_ENABLED=False,
+                      SQLALCHEMY_COMMIT_ON_TEARDOWN=True,
+                      # the temporary file teardown() removes
+                      BENCHMARK_DATABASE_FILE=path)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        ids = synthetic.generate(sizes, seed=seed)
+        db.session.remove()
+
+    return app, database_uri, ids
+
+
+def teardown(app):
+    """Closes the app's connections and removes
+    the temporary database of setup()"""
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+    path = app.config.get('BENCHMARK_DATABASE_FILE')
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def run(sizes=None, iterations=20, names=None, database_uri=None, seed=1,
+        drop_existing=False):
+    """Runs the benchmark scenarios against a freshly generated
+    synthetic dataset and returns the report dictionary"""
+    app, database_uri, ids = setup(sizes, database_uri, seed, drop_existing)
+    try:
+        return _run(app, database_uri, ids, sizes, iterations, names, seed)
+    finally:
+        teardown(app)
+
+
+def _run(app, database_uri, ids, sizes, iterations, names, seed):
+    with app.app_context():
+        engine = db.engine
+
+    report = {
+        'revision': _git_revision(),
+        'timestamp': datetime.now().isoformat(),
+        'database': database_uri.split(':')[0],
+        'iterations': iterations,
+        'seed': seed,
+        'sizes': dict(synthetic.DEFAULT_SIZES, **(sizes or {})),
+        'scenarios': {}
+    }
+
+    # the requests have to run outside of the app context above,
+    # otherwise they would share its session instead of tearing it down
+    counter = QueryCounter(engine)
+    rnd = random.Random(seed)
+    try:
+        for scenario in SCENARIOS:
+            if names and scenario.name not in names:
+                continue
+            report['scenarios'][scenario.name] = run_scenario(
+                app, scenario, ids, iterations, rnd, counter)
+    finally:
+        counter.remove()
+
+    if not names or 'serializers' in names:
+        report['serializers'] = run_serializers(app)
+
+    return report
+
+
+def compare(report, baseline):
+    """Returns the lines describing the difference between
+    the report and the baseline report"""
+    lines = []
+    for name, result in sorted(report['scenarios'].items()):
+        base = baseline.get('scenarios', {}).get(name)
+        if not base:
+            lines.append('%-24s new scenario' % name)
+            continue
+
+        p50, base_p50 = result['latency_ms']['p50'], base['latency_ms']['p50']
+        change = (p50 - base_p50) / base_p50 * 100 if base_p50 else 0.0
+        lines.append('%-24s p50 %8.2f ms -> %8.2f ms (%+.1f%%), '
+                     'queries %.1f -> %.1f' % (name, base_p50, p50, change,
+                     base['queries_per_request'],
+                     result['queries_per_request']))
+    return lines
@@ -0,0 +1,234 @@
+"""The change events. The ORM changes of a transaction are collected at every
+flush and published once it's committed, as the compact Change records: the
+model's table, the row's ID, the operation, the names of the changed columns
+of an update and the values (the current and the previous ones) of the "key"
+columns the subscribers asked for, e.g. the provider of a doctor, to find
+the caches to drop. The Core writes record their changes explicitly, see
+record(). With CHANGES_CHANNEL set the records are forwarded to that redis
+channel, and listen() publishes them to the other processes' subscribers.
+It replaces Flask-SQLAlchemy's modification tracking, which is off."""
+import binascii, json, os, time
+
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy import event, inspect
+
+from . import redis_store
+from .database import RoutingSession
+
+INSERT, UPDATE, DELETE = 'insert', 'update', 'delete'
+
+Change = namedtuple('Change', ['model', 'id', 'op', 'columns', 'keys'])
+
+# the session.info key of the changes of the session's transaction
+INFO_KEY = 'changes'
+# the process's own forwarded changes are not received back
+_ORIGIN = '%d:%s' % (os.getpid(),
+                     binascii.hexlify(os.urandom(4)).decode('ascii'))
+
+# the seconds listen() waits to reconnect after the first failure in a row,
+# it doubles after each next one up to the max
+LISTEN_RETRY_DELAY = 1
+LISTEN_MAX_RETRY_DELAY = 60
+
+# [(the models or None for all, handler, local)]
+_handlers = []
+# {model: the key columns}
+_keys = {}
+
+
+def subscribe(*models, **options):
+    """Registers the handler of the committed changes of the models (the
+    table names, every model by default), it's called with the list of the
+    Change records of a transaction. "keys" are the columns whose values
+    the records carry. The handlers run after the commit, outside of the
+    session's transaction, they use their own connection if they need one.
+    The "local" handlers only get the process's own changes, not the ones
+    forwarded by the others, e.g. the ones writing to the shared database"""
+    keys = options.get('keys', ())
+    local = options.get('local', False)
+
+    def decorator(handler):
+        for model in models:
+            _keys.setdefault(model, set()).update(keys)
+        _handlers.append((frozenset(models) or None, handler, local))
+        return handler
+
+    return decorator
+
+
+def key_columns(model):
+    """The key columns of the model's records"""
+    return _keys.get(model, set())
+
+
+def pending(session):
+    """The changes of the session's transaction recorded so far"""
+    return session.info.setdefault(INFO_KEY, [])
+
+
+def record(session, model, ids, op=UPDATE, columns=(), keys=None):
+    """Records the changes written with Core, "keys" maps the IDs to their
+    {key column: values}"""
+    keys = keys or {}
+    pending(session).extend(Change(model, row_id, op, tuple(sorted(columns)),
+                                   keys.get(row_id, {})) for row_id in ids)
+
+
+def _values(history):
+    return tuple(sorted(set(value for values in history for value in values
+                            if value is not None)))
+
+
+def _change(state, op):
+    model = state.mapper.local_table.name
+    row_id = state.mapper.primary_key_from_instance(state.obj())
+    row_id = row_id[0] if len(row_id) == 1 else tuple(row_id)
+
+    columns = ()
+    if op == UPDATE:
+        columns = tuple(sorted(attr.key for attr in state.attrs
+                               if attr.history.has_changes()))
+        if not columns:
+            return None
+
+    keys = {}
+    for name in key_columns(model):
+        values = _values(state.attrs[name].history)
+        if values:
+            keys[name] = values
+
+    return Change(model, row_id, op, columns, keys)
+
+
+def _merge(changes):
+    # a change per row, e.g. an insert and the following updates
+    # make an insert
+    merged = {}
+    order = []
+    for change in changes:
+        key = (change.model, change.id)
+        previous = merged.get(key)
+        if previous is None:
+            merged[key] = change
+            order.append(key)
+            continue
+
+        if DELETE in (previous.op, change.op):
+            op = DELETE
+        else:
+            op = previous.op
+        columns = () if op != UPDATE else \
+                  tuple(sorted(set(previous.columns) | set(change.columns)))
+        keys = dict(previous.keys)
+        for name, values in change.keys.items():
+            keys[name] = tuple(sorted(set(keys.get(name, ())) | set(values)))
+        merged[key] = Change(change.model, change.id, op, columns, keys)
+
+    return [merged[key] for key in order]
+
+
+def publish(changes, forward=True):
+    """Calls the handlers of the changes, and forwards them to
+    CHANGES_CHANNEL. The forwarded changes ("forward" is false) skip
+    the local handlers. A failed handler doesn't stop the others"""
+    for models, handler, local in _handlers:
+        if local and not forward:
+            continue
+        selected = changes if models is None else \
+                   [change for change in changes if change.model in models]
+        if not selected:
+            continue
+        try:
+            handler(selected)
+        except Exception:
+            current_app.logger.exception('The changes handler %s failed' % \
+                                         handler.__name__)
+
+    channel = current_app.config.get('CHANGES_CHANNEL')
+    if forward and channel:
+        try:
+            redis_store.publish(channel, json.dumps({
+                'origin': _ORIGIN,
+                'changes': [list(change) for change in changes]}))
+        except Exception:
+            pass
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _received(data):
+    # the forwarded Change records, None for the process's own ones
+    data = json.loads(_text(data))
+    if data['origin'] == _ORIGIN:
+        return None
+    return [Change(model, row_id, op, tuple(columns),
+                   dict((name, tuple(values))
+                        for name, values in keys.items()))
+            for model, row_id, op, columns, keys in data['changes']]
+
+
+def listen(app, channel=None):
+    """Publishes the changes forwarded by the other processes to this
+    process's handlers, it's run in a background task (see wsgi.py).
+    It reconnects when redis fails, waiting longer after every failure
+    in a row, and logs and skips the messages it can't decode"""
+    channel = channel or app.config['CHANGES_CHANNEL']
+    delay = LISTEN_RETRY_DELAY
+
+    with app.app_context():
+        while True:
+            pubsub = None
+            try:
+                pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                for message in pubsub.listen():
+                    delay = LISTEN_RETRY_DELAY
+                    try:
+                        received = _received(message['data'])
+                    except Exception:
+                        app.logger.exception('The invalid changes message '
+                                             '%r' % message['data'][:200])
+                        continue
+                    if received:
+                        publish(received, forward=False)
+            except Exception:
+                app.logger.exception('The changes channel failed, '
+                                     'reconnecting in %d s' % delay)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+            time.sleep(delay)
+            delay = min(delay * 2, LISTEN_MAX_RETRY_DELAY)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    changes = pending(session)
+    for instances, op in ((session.new, INSERT), (session.dirty, UPDATE),
+                          (session.deleted, DELETE)):
+        for instance in instances:
+            change = _change(inspect(instance), op)
+            if change is not None:
+                changes.append(change)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop(INFO_KEY, None)
+    if changes:
+        publish(_merge(changes))
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    # the rolled back transaction's changes are dropped, a rolled back
+    # savepoint's ones stay, they're only more than there are
+    if transaction._parent is None:
+        session.info.pop(INFO_KEY, None)
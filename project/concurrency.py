@@ -0,0 +1,167 @@
+"""Concurrency check for the gevent deployment (GEVENT=1, see wsgi.py).
+It serves the app with the gevent WSGI server, connects many simulated
+Socket.IO clients over Engine.IO long-polling while sending concurrent
+database-bound HTTP requests, and measures how late a timer greenlet wakes
+up. A driver which blocks the event loop shows up as a large loop lag."""
+import json, re, time
+
+from .benchmark import percentile, setup, teardown
+from . import synthetic
+
+# the seconds between the loop lag probe's wake-ups
+PROBE_INTERVAL = 0.01
+
+
+def is_cooperative():
+    """Whether the standard library is patched by gevent"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def _encode_packets(*packets):
+    # the Engine.IO v3 text payload: "<length>:<packet>" per packet
+    return ''.join('%d:%s' % (len(packet), packet) for packet in packets)
+
+
+def _latencies(values):
+    values = sorted(values)
+    return {
+        'p50': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None
+    }
+
+
+def socket_client(base_url, rounds, latencies, errors):
+    """Connects to Socket.IO over long-polling, then asks for the
+    notifications and pings the server "rounds" times"""
+    import requests
+
+    session = requests.Session()
+    url = base_url + '/socket.io/?EIO=3&transport=polling&b64=1'
+
+    try:
+        found = re.search(r'"sid":"([^"]+)"', session.get(url).text)
+        if not found:
+            errors.append('handshake')
+            return
+        url += '&sid=' + found.group(1)
+
+        for num in range(rounds):
+            started = time.time()
+            session.post(url, data=_encode_packets(
+                '42' + json.dumps(['check-notifications', num]), '2'))
+            # the long-polling request returns with the pong
+            response = session.get(url)
+            latencies.append((time.time() - started) * 1000)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+    except requests.RequestException as e:
+        errors.append(e.__class__.__name__)
+
+
+def http_client(base_url, email, amount, latencies, errors):
+    """Logs in and loads the dashboard, the heaviest database-bound page,
+    "amount" times"""
+    import requests
+
+    session = requests.Session()
+
+    try:
+        session.post(base_url + '/auth/login',
+                     data={'email': email, 'password': synthetic.PASSWORD})
+
+        for _ in range(amount):
+            started = time.time()
+            response = session.get(base_url + '/')
+            latencies.append((time.time() - started) * 1000)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+    except requests.RequestException as e:
+        errors.append(e.__class__.__name__)
+
+
+def probe(lags, done):
+    """Sleeps PROBE_INTERVAL in a loop and records how late it wakes up"""
+    import gevent
+
+    while not done.is_set():
+        started = time.time()
+        gevent.sleep(PROBE_INTERVAL)
+        lags.append((time.time() - started - PROBE_INTERVAL) * 1000)
+
+
+def run(clients=100, workers=20, rounds=5, requests_per_worker=5,
+        max_lag_ms=100, sizes=None, database_uri=None, seed=1,
+        drop_existing=False):
+    """Runs the concurrency check and returns the report dictionary.
+    The process has to be patched by gevent beforehand"""
+    if not is_cooperative():
+        raise RuntimeError('The concurrency check needs the gevent mode, '
+                           'run it with GEVENT=1')
+
+    app, database_uri, ids = setup(sizes, database_uri, seed, drop_existing)
+    try:
+        return _run(app, database_uri, ids, clients, workers, rounds,
+                    requests_per_worker, max_lag_ms)
+    finally:
+        teardown(app)
+
+
+def _run(app, database_uri, ids, clients, workers, rounds,
+         requests_per_worker, max_lag_ms):
+    import gevent
+    from gevent.event import Event
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer(('127.0.0.1', 0), app, log=None)
+    server.start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    socket_latencies, socket_errors = [], []
+    http_latencies, http_errors = [], []
+    lags, done = [], Event()
+
+    started = time.time()
+    prober = gevent.spawn(probe, lags, done)
+    try:
+        greenlets = [gevent.spawn(socket_client, base_url, rounds,
+                                  socket_latencies, socket_errors)
+                     for _ in range(clients)]
+        greenlets += [gevent.spawn(http_client, base_url,
+                                   ids['logins']['provider'],
+                                   requests_per_worker, http_latencies,
+                                   http_errors)
+                      for _ in range(workers)]
+        gevent.joinall(greenlets)
+    finally:
+        done.set()
+        prober.join()
+        server.stop()
+    elapsed = time.time() - started
+
+    loop_lag = _latencies(lags)
+
+    return {
+        'database': database_uri.split(':')[0],
+        'elapsed_s': elapsed,
+        'sockets': {
+            'clients': clients,
+            'rounds': rounds,
+            'errors': len(socket_errors),
+            'latency_ms': _latencies(socket_latencies)
+        },
+        'http': {
+            'workers': workers,
+            'requests': workers * requests_per_worker,
+            'errors': len(http_errors),
+            'latency_ms': _latencies(http_latencies)
+        },
+        'loop_lag_ms': loop_lag,
+        'max_lag_ms': max_lag_ms,
+        'responsive': loop_lag['max'] is not None and \
+                      loop_lag['max'] <= max_lag_ms
+    }
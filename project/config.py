@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 class Config:
@@ -8,15 +9,57 @@ class Config:
     # REDIS_URL = "redis://:password@localhost:6379/0"
     REDIS_URL = "redis://localhost:6379/0"
 
+    # keep the sessions in redis, they expire after an hour of inactivity
+    SESSION_REDIS = True
+    PERMANENT_SESSION_LIFETIME = timedelta(minutes=60)
+    # the seconds between the session's expiration time refreshes
+    SESSION_REFRESH_INTERVAL = 60
+
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
     # SQLALCHEMY_DATABASE_URI = 'sqlite:////home/apps/medipay_qa/project/app.db'
     SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    # the changes are published by changes.py instead
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # the read replicas' URIs, the read-only views (see database.read_only)
+    # use them, e.g. a copy of app.db: "sqlite:////path/to/replica.db"
+    SQLALCHEMY_REPLICAS = [uri for uri in
+        (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if uri]
+    SQLALCHEMY_POOL_PRE_PING = False
+    # the gevent workers (GEVENT=1, see wsgi.py) need the pure-python
+    # MySQL driver, the C one blocks the event loop during the queries
+    DATABASE_DRIVER = 'mysql+pymysql' if os.environ.get('GEVENT') \
+                      else 'mysql'
+    # None picks the best available mode (gevent if it's installed)
+    SOCKETIO_ASYNC_MODE = 'gevent' if os.environ.get('GEVENT') else None
+
+    # the seconds a terminal's claim idempotency key is cached in redis
+    # for, the claims table keeps the keys for good
+    IDEMPOTENCY_KEY_TIMEOUT = 24 * 60 * 60
+    # the seconds the members' app tokens are valid for, see /member/login
+    MEMBER_TOKEN_TIMEOUT = 30 * 24 * 60 * 60
+    # the claims older than that are moved to the archive
+    # ("manage.py archive_claims"), the dashboard looks no further back
+    CLAIM_ARCHIVE_MONTHS = 24
+    # the redis channel the committed changes are forwarded to, for the
+    # other processes' caches (see changes.listen), None doesn't forward
+    CHANGES_CHANNEL = os.environ.get('CHANGES_CHANNEL')
+    # the units of work taking longer are logged and counted as slow
+    # ("manage.py transactions")
+    TRANSACTION_SLOW_MS = 500
+
+    # the seconds without a heartbeat after which a terminal is offline
+    TERMINAL_HEARTBEAT_TIMEOUT = 60
 
     UPLOAD_FOLDER = os.path.join(basedir, 'static/uploads')
     ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif', 'csv'])
 
+    # share of requests picked by the sampling profiler (0 disables it),
+    # admins may profile any request with "?profile=1" or "X-Profile: 1"
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE') or 0)
+    PROFILER_INTERVAL = 0.005
+    PROFILER_FOLDER = os.path.join(basedir, 'profiles')
+
     MAIL_SERVER = 'smtp.googlemail.com'
     MAIL_PORT = 465
     MAIL_USE_TLS = False
@@ -37,8 +80,24 @@ class TestingConfig(Config):
 class ProductionConfig(Config):
     try:
         from . import config_mysql
-        SQLALCHEMY_DATABASE_URI = 'mysql://%s:%s@localhost/%s' % (
-            config_mysql.username, config_mysql.password, config_mysql.db)
+        SQLALCHEMY_DATABASE_URI = '%s://%s:%s@localhost/%s' % (
+            Config.DATABASE_DRIVER, config_mysql.username,
+            config_mysql.password, config_mysql.db)
+        # the replicas: config_mysql.replicas = ['host1', 'host2']
+        SQLALCHEMY_REPLICAS = Config.SQLALCHEMY_REPLICAS or [
+            '%s://%s:%s@%s/%s' % (Config.DATABASE_DRIVER,
+                config_mysql.username, config_mysql.password, host,
+                config_mysql.db)
+            for host in getattr(config_mysql, 'replicas', [])]
+
+        # the pool of every engine (the primary and each replica),
+        # the connections are recycled before MySQL's wait_timeout
+        SQLALCHEMY_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+        SQLALCHEMY_MAX_OVERFLOW = int(
+            os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+        SQLALCHEMY_POOL_TIMEOUT = 10
+        SQLALCHEMY_POOL_RECYCLE = 3600
+        SQLALCHEMY_POOL_PRE_PING = True
     except ImportError:
         pass
 
@@ -0,0 +1,246 @@
+import random, time
+
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector
+from sqlalchemy import event, exc, select
+from sqlalchemy.sql.dml import UpdateBase
+
+
+def ping_connection(connection, branch):
+    """Checks the pooled connection before it's used and reconnects
+    if the database has closed it (the "pre-ping")"""
+    if branch:
+        return
+
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        # the invalidated connection is reconnected on the next use
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+class EngineConnector(_EngineConnector):
+    def get_engine(self):
+        engine = _EngineConnector.get_engine(self)
+
+        if self._app.config['SQLALCHEMY_POOL_PRE_PING'] and \
+          not event.contains(engine, 'engine_connect', ping_connection):
+            event.listen(engine, 'engine_connect', ping_connection)
+
+        return engine
+
+
+class RoutingSession(SignallingSession):
+    """The session sends the queries made inside the db.read_only() blocks
+    to a random replica. Flushes and insert/update/delete statements go
+    to the primary, and once the session has written anything, the rest
+    of its work stays on the primary to read its own writes.
+
+    Inside the db.unit_of_work() blocks the commits only flush, the block
+    commits once at its end."""
+
+    def __init__(self, db, **options):
+        self._read_only = 0
+        self._wrote = False
+        self._units = 0
+        # the time of the unit of work's first write, its locks are
+        # held from then until the commit
+        self._wrote_at = None
+        self._after_commit = []
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self._wrote = True
+            if self._wrote_at is None:
+                self._wrote_at = time.time()
+
+        replicas = self.app.config['SQLALCHEMY_REPLICAS']
+
+        if self._read_only and not self._wrote and replicas:
+            state = self.app.extensions['sqlalchemy']
+            return state.db.get_engine(self.app, bind=random.choice(
+                ['replica_%d' % num for num in range(len(replicas))]))
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def commit(self):
+        if self._units:
+            # the new rows get their IDs, the unit of work commits them
+            self.flush()
+        else:
+            SignallingSession.commit(self)
+
+    def rollback(self):
+        self._after_commit = []
+        SignallingSession.rollback(self)
+
+    def close(self):
+        SignallingSession.close(self)
+        self._wrote = False
+        self._after_commit = []
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with the read replicas (SQLALCHEMY_REPLICAS)
+    and the connection pre-ping (SQLALCHEMY_POOL_PRE_PING)"""
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICAS', [])
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', False)
+        app.config.setdefault('TRANSACTION_SLOW_MS', 500)
+
+        # the replicas are the binds without tables of their own
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for num, uri in enumerate(app.config['SQLALCHEMY_REPLICAS']):
+            binds['replica_%d' % num] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+
+        SQLAlchemy.init_app(self, app)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def make_connector(self, app, bind=None):
+        return EngineConnector(self, app, bind)
+
+    @contextmanager
+    def read_only(self):
+        """The queries inside the block may be sent to a replica"""
+        session = self.session()
+        session._read_only += 1
+        try:
+            yield session
+        finally:
+            session._read_only -= 1
+
+    @contextmanager
+    def unit_of_work(self, name=None):
+        """One transaction for the block: the session's commits inside only
+        flush, so the new rows get their IDs, and the block commits once at
+        its end, or rolls back on an exception. The nested blocks join the
+        outer one. The duration is recorded under the name (see
+        transaction_metrics), then the after_commit() callbacks are called"""
+        session = self.session()
+        if session._units:
+            session._units += 1
+            try:
+                yield session
+            finally:
+                session._units -= 1
+            return
+
+        session._units = 1
+        session._wrote_at = None
+        started = time.time()
+        try:
+            yield session
+            session._units = 0
+            session.commit()
+        except Exception:
+            session._units = 0
+            session.rollback()
+            _record_transaction(name, started, session._wrote_at, True)
+            raise
+
+        _record_transaction(name, started, session._wrote_at, False)
+
+        callbacks, session._after_commit = session._after_commit, []
+        for callback, args, kwargs in callbacks:
+            try:
+                callback(*args, **kwargs)
+            except Exception:
+                current_app.logger.exception('The after commit callback '
+                                             '%s failed' % callback.__name__)
+
+    def after_commit(self, callback, *args, **kwargs):
+        """Calls the callback once the current unit of work commits, and
+        never if it rolls back, e.g. to notify about the new rows. Outside
+        of a unit of work it's called at once"""
+        session = self.session()
+        if session._units:
+            session._after_commit.append((callback, args, kwargs))
+        else:
+            callback(*args, **kwargs)
+
+
+def read_only(fn):
+    """The view decorator, which sends the view's queries to a replica"""
+    @wraps(fn)
+    def decorated_view(*args, **kwargs):
+        with current_app.extensions['sqlalchemy'].db.read_only():
+            return fn(*args, **kwargs)
+    return decorated_view
+
+
+def unit_of_work(fn):
+    """The view decorator, which runs the view in one transaction"""
+    @wraps(fn)
+    def decorated_view(*args, **kwargs):
+        with current_app.extensions['sqlalchemy'].db.unit_of_work(
+                request.endpoint):
+            return fn(*args, **kwargs)
+    return decorated_view
+
+
+# the redis hash of the units of work's counters, the fields are
+# "<name>:<counter>"
+METRICS_KEY = 'metrics:transactions'
+METRICS_COUNTERS = ('count', 'failed', 'slow', 'ms', 'write_ms')
+
+
+def _record_transaction(name, started, wrote_at, failed):
+    # the package imports this module before it creates redis_store
+    from . import redis_store
+
+    now = time.time()
+    name = name or 'unnamed'
+    ms = (now - started) * 1000
+    write_ms = (now - wrote_at) * 1000 if wrote_at else 0
+    slow = ms >= current_app.config['TRANSACTION_SLOW_MS']
+
+    if slow:
+        current_app.logger.warning('The slow transaction %s: %.1f ms, '
+                                   'writing %.1f ms' % (name, ms, write_ms))
+
+    try:
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.hincrby(METRICS_KEY, name + ':count', 1)
+        pipe.hincrby(METRICS_KEY, name + ':failed', int(failed))
+        pipe.hincrby(METRICS_KEY, name + ':slow', int(slow))
+        pipe.hincrbyfloat(METRICS_KEY, name + ':ms', ms)
+        pipe.hincrbyfloat(METRICS_KEY, name + ':write_ms', write_ms)
+        pipe.execute()
+    except Exception:
+        pass
+
+
+def transaction_metrics(reset=False):
+    """Returns {name: {counter: value}} of the units of work, the "ms" and
+    "write_ms" (from the first write to the commit) are the totals"""
+    from . import redis_store
+
+    pipe = redis_store.pipeline()
+    pipe.hgetall(METRICS_KEY)
+    if reset:
+        pipe.delete(METRICS_KEY)
+    fields = pipe.execute()[0]
+
+    metrics = {}
+    for field, value in fields.items():
+        field = field.decode('utf-8') if isinstance(field, bytes) else field
+        name, counter = field.rsplit(':', 1)
+        metrics.setdefault(name, dict((counter, 0)
+                                      for counter in METRICS_COUNTERS))
+        metrics[name][counter] = float(value)
+    return metrics
@@ -0,0 +1,152 @@
+"""Date parsing for the imports. The formats the API uses have hand-written
+fast paths (strptime is slow and not thread-safe on its first use), the
+parsed values are memoized, as the policy dates repeat heavily across the
+rows, and the batches are parsed a column at a time. The invalid values
+raise DateParseError instead of being replaced by the current date."""
+from datetime import datetime
+
+DATE_FORMAT = '%m/%d/%Y'
+DATETIME_FORMAT = '%m/%d/%Y %I:%M %p'
+ISO_DATE_FORMAT = '%Y-%m-%d'
+
+# the values memoized per parser, the memo is cleared once it's full
+CACHE_SIZE = 10000
+
+
+class DateParseError(ValueError):
+    def __init__(self, value, fmt, field=None, row=None):
+        self.value = value
+        self.format = fmt
+        self.field = field
+        self.row = row
+
+        message = '"%s" does not match the date format "%s"' % (value, fmt)
+        if field is not None:
+            message = '"%s": %s' % (field, message)
+        if row is not None:
+            message = 'row %d, %s' % (row, message)
+        ValueError.__init__(self, message)
+
+
+def _digits(value, min_size, max_size):
+    if not value.isdigit() or not min_size <= len(value) <= max_size:
+        raise ValueError(value)
+    return int(value)
+
+
+def _parse_date(value):
+    # %m/%d/%Y
+    month, day, year = value.split('/')
+    return datetime(_digits(year, 4, 4), _digits(month, 1, 2),
+                    _digits(day, 1, 2))
+
+
+def _parse_iso_date(value):
+    # %Y-%m-%d
+    year, month, day = value.split('-')
+    return datetime(_digits(year, 4, 4), _digits(month, 1, 2),
+                    _digits(day, 1, 2))
+
+
+def _parse_datetime(value):
+    # %m/%d/%Y %I:%M %p
+    date, time, period = value.split()
+    hour, minute = time.split(':')
+    hour = _digits(hour, 1, 2)
+    period = period.upper()
+
+    if not 1 <= hour <= 12 or period not in ('AM', 'PM'):
+        raise ValueError(value)
+
+    parsed = _parse_date(date)
+    return parsed.replace(hour=hour % 12 + (12 if period == 'PM' else 0),
+                          minute=_digits(minute, 1, 2))
+
+
+_fast_paths = {
+    DATE_FORMAT: _parse_date,
+    ISO_DATE_FORMAT: _parse_iso_date,
+    DATETIME_FORMAT: _parse_datetime
+}
+
+
+class DateParser(object):
+    """Parses the strings of the given strptime format"""
+
+    def __init__(self, fmt, cache_size=CACHE_SIZE):
+        self.format = fmt
+        self.cache_size = cache_size
+        self.cache = {}
+        self._parse = _fast_paths.get(fmt) or \
+                      (lambda value: datetime.strptime(value, fmt))
+
+    def __call__(self, value, field=None, row=None):
+        """Returns the datetime, the empty values are None"""
+        if value is None or value == '':
+            return None
+
+        try:
+            return self.cache[value]
+        except (KeyError, TypeError):
+            pass
+
+        try:
+            parsed = self._parse(value)
+        except (ValueError, TypeError, AttributeError):
+            raise DateParseError(value, self.format, field, row)
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[value] = parsed
+
+        return parsed
+
+    def parse_column(self, values, field=None):
+        """Parses the list of values, the repeated ones come from the memo.
+        Returns the parsed values and the list of DateParseError"""
+        cache = self.cache
+        results = []
+        errors = []
+
+        for row, value in enumerate(values):
+            try:
+                results.append(cache[value])
+                continue
+            except (KeyError, TypeError):
+                pass
+
+            try:
+                results.append(self(value, field, row))
+            except DateParseError as e:
+                errors.append(e)
+                results.append(None)
+
+        return results, errors
+
+
+parse_date = DateParser(DATE_FORMAT)
+parse_datetime = DateParser(DATETIME_FORMAT)
+parse_iso_date = DateParser(ISO_DATE_FORMAT)
+
+
+def parse_date_columns(rows, fields, parser=parse_date):
+    """Parses the date fields of the row dictionaries a column at a time.
+    Returns {field: the parsed values} and the list of DateParseError"""
+    columns = {}
+    errors = []
+
+    for field in fields:
+        columns[field], column_errors = parser.parse_column(
+            [row.get(field) for row in rows], field)
+        errors.extend(column_errors)
+
+    errors.sort(key=lambda e: (e.row, e.field))
+    return columns, errors
+
+
+def date_errors_message(errors, limit=10):
+    """The error message listing the first invalid dates"""
+    message = 'Error: ' + '; '.join(str(e) for e in errors[:limit])
+    if len(errors) > limit:
+        message += '; and %d more' % (len(errors) - limit)
+    return message
@@ -0,0 +1,135 @@
+"""Terminal heartbeats. The terminals report their status every few seconds,
+the latest state of every terminal is kept in a redis hash, so the repeated
+heartbeats overwrite each other, and flush() writes the terminals changed
+since the previous flush to the terminal table in batched updates (run
+"manage.py flush_heartbeats"). The fleet status is read from redis."""
+import time
+
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import bindparam, func
+
+from . import db, models, redis_store
+
+STATE_KEY = 'terminal:state:%d'
+# the terminals which have reported since the previous flush
+DIRTY_KEY = 'terminals:dirty'
+# the terminals of the flush in progress, kept until they're written
+FLUSHING_KEY = 'terminals:flushing'
+# the terminals which have ever reported
+KNOWN_KEY = 'terminals:known'
+
+# the rows per executemany update of the flush
+CHUNK_SIZE = 500
+
+
+def _state(status, version, reported_at):
+    # the missing fields are left out, the hash keeps the reported ones
+    state = {'reported_at': '%.3f' % reported_at}
+    if status:
+        state['status'] = status
+    if version:
+        state['version'] = version
+    return state
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _load_state(terminal_id, state):
+    # the redis hash to the terminal's status dictionary
+    state = dict((_text(key), _text(value)) for key, value in state.items())
+    reported_at = float(state['reported_at'])
+    timeout = current_app.config['TERMINAL_HEARTBEAT_TIMEOUT']
+
+    return {
+        'id': terminal_id,
+        'status': state.get('status') or None,
+        'version': state.get('version') or None,
+        'last_update': datetime.fromtimestamp(reported_at),
+        'online': time.time() - reported_at <= timeout
+    }
+
+
+def _write(states):
+    # one executemany update per chunk of the terminals, the status and
+    # version never reported stay as they are
+    table = models.Terminal.__table__
+    statement = table.update()\
+                     .where(table.c.id == bindparam('_id'))\
+                     .values(status=func.coalesce(bindparam('status'),
+                                                  table.c.status),
+                             version=func.coalesce(bindparam('version'),
+                                                   table.c.version),
+                             last_update=bindparam('last_update'))
+    params = [{'_id': state['id'], 'status': state['status'],
+               'version': state['version'],
+               'last_update': state['last_update']} for state in states]
+
+    for i in range(0, len(params), CHUNK_SIZE):
+        db.session.execute(statement, params[i:i + CHUNK_SIZE])
+    db.session.commit()
+
+
+def record(terminal_id, status, version, reported_at=None):
+    """Records the terminal's heartbeat. If redis is not available,
+    the state is written to the database directly"""
+    reported_at = reported_at or time.time()
+    state = _state(status, version, reported_at)
+
+    try:
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.hmset(STATE_KEY % terminal_id, state)
+        pipe.sadd(DIRTY_KEY, terminal_id)
+        pipe.sadd(KNOWN_KEY, terminal_id)
+        pipe.execute()
+    except Exception:
+        _write([_load_state(terminal_id, state)])
+
+
+def flush():
+    """Writes the latest states of the terminals which have reported since
+    the previous flush to the database, returns the number of terminals.
+    A failed flush is retried by the next one"""
+    if not redis_store.exists(FLUSHING_KEY):
+        if not redis_store.exists(DIRTY_KEY):
+            return 0
+        # the heartbeats coming during the flush go to a new dirty set
+        redis_store.rename(DIRTY_KEY, FLUSHING_KEY)
+
+    terminal_ids = sorted(int(terminal_id) for terminal_id
+                          in redis_store.smembers(FLUSHING_KEY))
+
+    pipe = redis_store.pipeline(transaction=False)
+    for terminal_id in terminal_ids:
+        pipe.hgetall(STATE_KEY % terminal_id)
+
+    states = [_load_state(terminal_id, state) for terminal_id, state
+              in zip(terminal_ids, pipe.execute()) if state]
+
+    if states:
+        _write(states)
+
+    redis_store.delete(FLUSHING_KEY)
+    return len(states)
+
+
+def fleet_status(terminal_ids=None):
+    """Returns {terminal id: status dictionary} of the given terminals,
+    or of every terminal which has reported, read from redis only.
+    The terminals without the state in redis are left out"""
+    try:
+        if terminal_ids is None:
+            terminal_ids = sorted(int(terminal_id) for terminal_id
+                                  in redis_store.smembers(KNOWN_KEY))
+
+        pipe = redis_store.pipeline(transaction=False)
+        for terminal_id in terminal_ids:
+            pipe.hgetall(STATE_KEY % terminal_id)
+        states = pipe.execute()
+    except Exception:
+        return {}
+
+    return dict((terminal_id, _load_state(terminal_id, state))
+                for terminal_id, state in zip(terminal_ids, states) if state)
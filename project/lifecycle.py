@@ -0,0 +1,242 @@
+"""The claims' data lifecycle. On MySQL the claim and guarantee_of_payment
+tables are partitioned by month (see partition_statements), so the queries
+filtered by the date only scan the recent partitions, and the claims older
+than CLAIM_ARCHIVE_MONTHS are moved to the claim_archive table as compressed
+JSON (see archive_claims), where they're still found by their ID, member or
+provider (see archived_claims)."""
+import json, zlib
+
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from flask import current_app
+from sqlalchemy import select, text
+
+from . import db, models
+
+# the partitioned tables and their partitioning date columns
+PARTITIONED = {
+    'claim': 'datetime',
+    'guarantee_of_payment': 'timestamp'
+}
+# the date the rows without one get, the partitioning column is a part
+# of the primary key, so it can't be NULL
+NULL_DATE = '1970-01-01 00:00:00'
+# the partition of the rows older than the first month
+OLDEST_PARTITION = 'p_old'
+# the partition of the rows newer than the last month, it's split
+# into the months ahead by the next runs
+NEWEST_PARTITION = 'p_max'
+
+# the claims moved to the archive per transaction
+ARCHIVE_CHUNK_SIZE = 1000
+
+_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _month(value):
+    return datetime(value.year, value.month, 1)
+
+
+def _partition(month):
+    return "PARTITION p%s VALUES LESS THAN (TO_DAYS('%s'))" % (
+        month.strftime('%Y%m'),
+        (month + relativedelta(months=1)).strftime('%Y-%m-%d'))
+
+
+def _months(first, last):
+    month = _month(first)
+    while month <= last:
+        yield month
+        month += relativedelta(months=1)
+
+
+def _partitions(connection, table):
+    # the names of the table's partitions, none if it's not partitioned
+    return [name for name, in connection.execute(text(
+        'SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+        'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table '
+        'AND PARTITION_NAME IS NOT NULL '
+        'ORDER BY PARTITION_ORDINAL_POSITION'), table=table)]
+
+
+def _foreign_keys(connection, table):
+    # the (table, name) of the foreign keys from and to the table,
+    # InnoDB doesn't support them on the partitioned tables
+    return connection.execute(text(
+        'SELECT TABLE_NAME, CONSTRAINT_NAME '
+        'FROM information_schema.REFERENTIAL_CONSTRAINTS '
+        'WHERE CONSTRAINT_SCHEMA = DATABASE() '
+        'AND (TABLE_NAME = :table OR REFERENCED_TABLE_NAME = :table)'),
+        table=table).fetchall()
+
+
+def _unique_indexes(connection, table):
+    # the names of the table's unique indexes in the database
+    return set(name for name, in connection.execute(text(
+        'SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS '
+        'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table '
+        "AND NON_UNIQUE = 0 AND INDEX_NAME != 'PRIMARY'"), table=table))
+
+
+def partition_statements(connection, table, months_ahead=3, since=None,
+                         drop_foreign_keys=False):
+    """Returns the DDL statements partitioning the MySQL table by month.
+
+    The first run makes the date column a part of the primary key and of
+    the unique indexes, and creates the partitions of the months from
+    "since" (the oldest row by default) to "months_ahead" from now. The
+    next runs only add the months ahead, they should be scheduled monthly.
+
+    The first run changes the data: the rows without the date get NULL_DATE
+    (the column becomes NOT NULL), and the foreign keys from and to the
+    table are dropped, InnoDB doesn't support them with the partitions.
+    Raises ValueError if the table has foreign keys and "drop_foreign_keys"
+    is not set.
+
+    A unique index with the date would only be unique per date, so the
+    index unique in the database but not in the models is made a plain
+    one: ix_claim_terminal_idempotency_key, the keys are kept unique by
+    the unpartitioned claim_idempotency_key table instead"""
+    column = PARTITIONED[table]
+    last = _month(datetime.now()) + relativedelta(months=months_ahead)
+    existing = _partitions(connection, table)
+
+    if existing:
+        # split the newest partition into the missing months
+        newest = max(datetime.strptime(name[1:], '%Y%m')
+                     for name in existing if name[1:].isdigit())
+        months = list(_months(newest + relativedelta(months=1), last))
+        if not months:
+            return []
+        return ['ALTER TABLE `%s` REORGANIZE PARTITION %s INTO (%s, '
+                'PARTITION %s VALUES LESS THAN MAXVALUE)' % (table,
+                NEWEST_PARTITION, ', '.join(_partition(month)
+                                            for month in months),
+                NEWEST_PARTITION)]
+
+    foreign_keys = _foreign_keys(connection, table)
+    if foreign_keys and not drop_foreign_keys:
+        raise ValueError('the foreign keys %s would be dropped' % ', '.join(
+                         '%s.%s' % key for key in foreign_keys))
+
+    if since is None:
+        since = connection.execute(text(
+            'SELECT MIN(`%s`) FROM `%s`' % (column, table))).scalar() or \
+            datetime.now()
+
+    statements = ['ALTER TABLE `%s` DROP FOREIGN KEY `%s`' % key
+                  for key in foreign_keys]
+
+    statements.append("UPDATE `%s` SET `%s` = '%s' WHERE `%s` IS NULL" % (
+                      table, column, NULL_DATE, column))
+
+    alter = ['MODIFY `%s` DATETIME NOT NULL' % column,
+             'DROP PRIMARY KEY', 'ADD PRIMARY KEY (`id`, `%s`)' % column]
+    unique = _unique_indexes(connection, table)
+    for index in db.metadata.tables[table].indexes:
+        columns = [index_column.name for index_column in index.columns]
+        if index.unique:
+            columns.append(column)
+        elif index.name not in unique:
+            continue
+        alter += ['DROP INDEX `%s`' % index.name,
+                  'ADD %sINDEX `%s` (%s)' % (
+                      'UNIQUE ' if index.unique else '', index.name,
+                      ', '.join('`%s`' % name for name in columns))]
+    statements.append('ALTER TABLE `%s` %s' % (table, ', '.join(alter)))
+
+    partitions = ["PARTITION %s VALUES LESS THAN (TO_DAYS('%s'))" % (
+                  OLDEST_PARTITION, _month(since).strftime('%Y-%m-%d'))]
+    partitions += [_partition(month) for month in _months(since, last)]
+    partitions.append('PARTITION %s VALUES LESS THAN MAXVALUE' % \
+                      NEWEST_PARTITION)
+    statements.append('ALTER TABLE `%s` PARTITION BY RANGE (TO_DAYS(`%s`)) '
+                      '(%s)' % (table, column, ', '.join(partitions)))
+
+    return statements
+
+
+def archive_horizon(months=None):
+    """The time the claims older than are archived"""
+    if months is None:
+        months = current_app.config['CLAIM_ARCHIVE_MONTHS']
+    return _month(datetime.now()) - relativedelta(months=months)
+
+
+def _dump(row):
+    data = dict((key, value.strftime(_DATE_FORMAT)
+                 if isinstance(value, datetime) else value)
+                for key, value in row.items())
+    return zlib.compress(json.dumps(data).encode('utf-8'))
+
+
+def _load(data):
+    row = json.loads(zlib.decompress(data).decode('utf-8'))
+    for column in models.Claim.__table__.columns:
+        if isinstance(column.type, db.DateTime) and row.get(column.name):
+            row[column.name] = datetime.strptime(row[column.name],
+                                                 _DATE_FORMAT)
+    return row
+
+
+def archive_claims(months=None, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """Moves the claims older than "months" (CLAIM_ARCHIVE_MONTHS by
+    default) to the archive, a chunk per transaction, and returns the
+    number of the archived claims"""
+    claims = models.Claim.__table__
+    archive = models.ClaimArchive.__table__
+    keys = models.ClaimIdempotencyKey.__table__
+    horizon = archive_horizon(months)
+    archived = 0
+
+    while True:
+        rows = db.session.execute(select([claims])
+                                  .where(claims.c.datetime < horizon)
+                                  .order_by(claims.c.id)
+                                  .limit(chunk_size)).fetchall()
+        if not rows:
+            break
+
+        now = datetime.now()
+        db.session.execute(archive.insert(), [{
+            'id': row.id,
+            'datetime': row.datetime,
+            'member_id': row.member_id,
+            'provider_id': row.provider_id,
+            'terminal_id': row.terminal_id,
+            'data': _dump(dict(row.items())),
+            'archived_at': now} for row in rows])
+        claim_ids = [row.id for row in rows]
+        db.session.execute(keys.delete().where(
+            keys.c.claim_id.in_(claim_ids)))
+        db.session.execute(claims.delete().where(
+            claims.c.id.in_(claim_ids)))
+        db.session.commit()
+
+        archived += len(rows)
+
+    return archived
+
+
+def archived_claims(ids=None, member_id=None, provider_id=None, start=None,
+                    end=None, limit=1000):
+    """Returns the archived claims as the Claim objects, which are not added
+    to the session, the latest first"""
+    Archive = models.ClaimArchive
+    query = db.session.query(Archive.data)
+
+    if ids is not None:
+        query = query.filter(Archive.id.in_(ids))
+    if member_id is not None:
+        query = query.filter(Archive.member_id == member_id)
+    if provider_id is not None:
+        query = query.filter(Archive.provider_id == provider_id)
+    if start is not None:
+        query = query.filter(Archive.datetime >= start)
+    if end is not None:
+        query = query.filter(Archive.datetime < end)
+
+    query = query.order_by(Archive.datetime.desc(), Archive.id.desc())\
+                 .limit(limit)
+
+    return [models.Claim(**_load(data)) for data, in query]
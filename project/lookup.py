@@ -0,0 +1,282 @@
+"""The front desk member lookup. The members' names, national IDs, policy
+and card numbers are normalized into the member_search_token table (see
+MemberSearchToken): the accents are dropped, the case is folded, a name
+gives its words and an ID its letters and digits without the spaces and
+dashes, so "NID-000 042" is found by "nid000042" and "Jose" with the
+accent by "jose". A token row is kept per provider of the member, so a
+provider's lookup is the range scan of its own (provider_id, field,
+token) index prefix instead of a LIKE over the whole member table.
+
+The matches are ranked: an exact ID, an ID's prefix, the names with every
+query word as a word's prefix (the more exact words the better) and, when
+those are not enough, the names sharing most of the query's trigrams, for
+the typos. The index follows the members' changes, see members_changed."""
+import math, re, unicodedata
+
+from sqlalchemy import and_, case, distinct, func, or_, select
+
+from . import changes, db, models
+
+LOOKUP_LIMIT = 10
+LOOKUP_MAX_LIMIT = 50
+# the shortest query looked up, in letters and digits
+MIN_QUERY_LENGTH = 2
+# the share of the query's trigrams a fuzzy match has
+GRAM_SIMILARITY = 0.5
+# the members indexed per statement
+INDEX_CHUNK_SIZE = 500
+
+NAME, GRAM = 'name', 'gram'
+ID_FIELDS = ('national_id', 'policy_number', 'card_number')
+
+# the match kinds, the best first
+ID, ID_PREFIX, NAME_PREFIX, FUZZY = 'id', 'id_prefix', 'name', 'fuzzy'
+
+# the member columns the index is made of
+INDEXED_COLUMNS = frozenset((NAME,) + ID_FIELDS + ('providers',))
+
+_WORD = re.compile(r'[^\W_]+', re.UNICODE)
+# the length of the token column
+_TOKEN_LENGTH = 64
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return u'%s' % value
+
+
+def words(value):
+    """The normalized words of the text"""
+    if not value:
+        return []
+    value = unicodedata.normalize('NFKD', _text(value))
+    value = u''.join(char for char in value
+                     if not unicodedata.combining(char)).lower()
+    return [word[:_TOKEN_LENGTH] for word in _WORD.findall(value)]
+
+
+def compact(value):
+    """The normalized ID, its letters and digits"""
+    return u''.join(words(value))[:_TOKEN_LENGTH]
+
+
+def grams(value_words):
+    """The trigrams of the words, padded like the ones of pg_trgm,
+    so the words' beginnings weigh more"""
+    found = set()
+    for word in value_words:
+        padded = u'  %s ' % word
+        found.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return found
+
+
+def _tokens(member):
+    # the (field, token) pairs of the member's row
+    name = words(member.name)
+    tokens = set((NAME, word) for word in name)
+    tokens.update((GRAM, gram) for gram in grams(name))
+    for field in ID_FIELDS:
+        token = compact(getattr(member, field))
+        if token:
+            tokens.add((field, token))
+    return tokens
+
+
+def _chunks(values, size):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def index_members(member_ids, connection, chunk_size=INDEX_CHUNK_SIZE):
+    """Replaces the search tokens of the members, the deleted members'
+    ones are dropped. "connection" is the Core connection (or the session)
+    of the caller's transaction"""
+    tokens = models.MemberSearchToken.__table__
+    member = models.Member.__table__
+    links = models.custom_members
+
+    for chunk in _chunks(set(member_ids), chunk_size):
+        rows = connection.execute(
+            select([member.c.id, member.c.name] +
+                   [member.c[field] for field in ID_FIELDS])
+            .where(member.c.id.in_(chunk))).fetchall()
+
+        providers = {}
+        for member_id, provider_id in connection.execute(
+                select([links.c.member_id, links.c.provider_id])
+                .where(links.c.member_id.in_(chunk))):
+            providers.setdefault(member_id, set()).add(provider_id)
+
+        connection.execute(tokens.delete()
+                                 .where(tokens.c.member_id.in_(chunk)))
+
+        values = []
+        for row in rows:
+            member_tokens = _tokens(row)
+            for provider_id in providers.get(row.id) or (None,):
+                values.extend({'provider_id': provider_id,
+                               'member_id': row.id,
+                               'field': field,
+                               'token': token}
+                              for field, token in member_tokens)
+        if values:
+            connection.execute(tokens.insert(), values)
+
+
+def reindex(chunk_size=INDEX_CHUNK_SIZE):
+    """Rebuilds the index of every member, a chunk per transaction,
+    and returns the number of the indexed members"""
+    member = models.Member.__table__
+    indexed = 0
+    last_id = 0
+
+    while True:
+        with db.engine.begin() as connection:
+            member_ids = [row[0] for row in connection.execute(
+                select([member.c.id]).where(member.c.id > last_id)
+                .order_by(member.c.id).limit(chunk_size))]
+            if not member_ids:
+                break
+            index_members(member_ids, connection, chunk_size)
+
+        indexed += len(member_ids)
+        last_id = member_ids[-1]
+
+    # the tokens of the members deleted without the change records
+    tokens = models.MemberSearchToken.__table__
+    with db.engine.begin() as connection:
+        connection.execute(tokens.delete().where(~tokens.c.member_id.in_(
+            select([member.c.id]))))
+
+    return indexed
+
+
+@changes.subscribe('member', local=True)
+def members_changed(records):
+    # the tokens are in the shared database, the other processes
+    # don't index the forwarded changes again
+    member_ids = [record.id for record in records
+                  if record.op != changes.UPDATE or
+                  INDEXED_COLUMNS.intersection(record.columns)]
+    if member_ids:
+        with db.engine.begin() as connection:
+            index_members(member_ids, connection)
+
+
+def _successor(token):
+    # the smallest string after every string starting with the token
+    return token[:-1] + u'%c' % (ord(token[-1]) + 1)
+
+
+def _prefixed(column, token):
+    # the range scan of the index, unlike LIKE it needs no escaping
+    return and_(column >= token, column < _successor(token))
+
+
+def _search(provider_id, *criteria):
+    tokens = models.MemberSearchToken.__table__
+    if provider_id is not None:
+        criteria += (tokens.c.provider_id == provider_id,)
+    return and_(*criteria)
+
+
+def _by_id(query, provider_id, limit):
+    tokens = models.MemberSearchToken.__table__
+    exact = func.max(case([(tokens.c.token == query, 1)], else_=0))
+    rows = db.session.execute(
+        select([tokens.c.member_id, exact.label('exact')])
+        .where(_search(provider_id, tokens.c.field.in_(ID_FIELDS),
+                       _prefixed(tokens.c.token, query)))
+        .group_by(tokens.c.member_id)
+        .order_by(exact.desc(), tokens.c.member_id)
+        .limit(limit))
+    return [(member_id, ID if exact else ID_PREFIX)
+            for member_id, exact in rows]
+
+
+def _by_name(query_words, provider_id, limit):
+    tokens = models.MemberSearchToken.__table__
+    # the query word matched by the token, every one has to be
+    word = case([(_prefixed(tokens.c.token, query_word), i)
+                 for i, query_word in enumerate(query_words)])
+    exact = func.sum(case([(tokens.c.token.in_(query_words), 1)], else_=0))
+    rows = db.session.execute(
+        select([tokens.c.member_id])
+        .where(_search(provider_id, tokens.c.field == NAME,
+                       or_(*[_prefixed(tokens.c.token, query_word)
+                             for query_word in query_words])))
+        .group_by(tokens.c.member_id)
+        .having(func.count(distinct(word)) == len(query_words))
+        .order_by(exact.desc(), tokens.c.member_id)
+        .limit(limit))
+    return [(member_id, NAME_PREFIX) for member_id, in rows]
+
+
+def _by_grams(query_words, provider_id, limit):
+    tokens = models.MemberSearchToken.__table__
+    query_grams = sorted(grams(query_words))
+    shared = func.count(distinct(tokens.c.token))
+    rows = db.session.execute(
+        select([tokens.c.member_id])
+        .where(_search(provider_id, tokens.c.field == GRAM,
+                       tokens.c.token.in_(query_grams)))
+        .group_by(tokens.c.member_id)
+        .having(shared >= int(math.ceil(len(query_grams) *
+                                        GRAM_SIMILARITY)))
+        .order_by(shared.desc(), tokens.c.member_id)
+        .limit(limit))
+    return [(member_id, FUZZY) for member_id, in rows]
+
+
+def _dump(row, match):
+    return {'id': row.id,
+            'name': row.name,
+            'dob': row.dob.strftime('%Y-%m-%d') if row.dob else None,
+            'national_id': row.national_id,
+            'policy_number': row.policy_number,
+            'card_number': row.card_number,
+            'photo': row.photo,
+            'match': match}
+
+
+def lookup(query, provider_id=None, limit=LOOKUP_LIMIT):
+    """Returns up to "limit" members matching the query, the best matches
+    first, with the kind of their "match". The provider's lookup only
+    finds its own members, every member is found without one"""
+    query_words = words(query)
+    query_id = compact(query)
+    if len(query_id) < MIN_QUERY_LENGTH:
+        return []
+    # a word that is a prefix of another one matches the same names
+    query_words = sorted(set(word for word in query_words
+                             if not any(other != word and
+                                        other.startswith(word)
+                                        for other in query_words)))
+
+    found = _by_id(query_id, provider_id, limit)
+    if len(found) < limit:
+        found += _by_name(query_words, provider_id, limit + len(found))
+    if len(found) < limit and len(query_id) >= 3:
+        found += _by_grams(query_words, provider_id, limit + len(found))
+
+    # the member's best match
+    matches = {}
+    ranked = []
+    for member_id, match in found:
+        if member_id not in matches:
+            matches[member_id] = match
+            ranked.append(member_id)
+    ranked = ranked[:limit]
+    if not ranked:
+        return []
+
+    member = models.Member.__table__
+    rows = dict((row.id, row) for row in db.session.execute(
+        select([member.c.id, member.c.name, member.c.dob, member.c.photo] +
+               [member.c[field] for field in ID_FIELDS])
+        .where(member.c.id.in_(ranked))))
+
+    return [_dump(rows[member_id], matches[member_id])
+            for member_id in ranked if member_id in rows]
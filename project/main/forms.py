@@ -5,7 +5,8 @@ from wtforms import FileField, RadioField, HiddenField, SelectMultipleField
 from wtforms import BooleanField, PasswordField, ValidationError, DateField
 from wtforms import DateTimeField, IntegerField
 from wtforms.validators import Required, Email, Length, URL
-from ..models import Payer, Member, User, Provider
+from ..models import Payer, Member, User, Provider, Doctor, ICDCode
+from ..models import custom_payers
 
 
 class BaseForm(Form):
@@ -62,6 +63,19 @@ def validate_dropdown(form, field):
         if field.data == -1:
             raise ValidationError('Please select an Option From The DropDown.')
 
+class LazySelectField(SelectField):
+    """Select field whose choices are loaded by the page on demand,
+    the submitted value is checked by the form's validate_<field>"""
+    def pre_validate(self, form):
+        pass
+
+
+class LazySelectMultipleField(SelectMultipleField):
+    """Multiple select field whose choices are loaded on demand"""
+    def pre_validate(self, form):
+        pass
+
+
 class TerminalForm(BaseForm):
     status = StringField('Status', validators=[Required()])
     serial_number = StringField('Serial number', validators=[Required()])
@@ -97,7 +111,8 @@ class ClaimForm(BaseForm):
 class GOPForm(BaseForm):
     patient_medical_no = StringField('Patient medical no.',
                                      validators=[Required()])
-    payer = SelectField('Payer Select', coerce=int, choices=[('0', 'None')])
+    payer = LazySelectField('Payer Select', coerce=int,
+                            choices=[('0', 'None')])
     policy_number = StringField('Policy Number', validators=[Required()])
     name = StringField('Name', validators=[Required()])
     dob = DateField('Date of birth', validators=[Required()], 
@@ -129,15 +144,15 @@ class GOPForm(BaseForm):
     medical_details_current_therapy = StringField('Current therapy')
     medical_details_treatment_plan = TextAreaField('Treatment plan')
 
-    doctor_name = SelectField('Doctor name', validators=[Required()],
-                              coerce=int, choices=[('0', 'None')])
+    doctor_name = LazySelectField('Doctor name', validators=[Required()],
+                                  coerce=int, choices=[('0', 'None')])
     admission_date = DateTimeField('Admission date', validators=[Required()],
                                                  format='%m/%d/%Y')
     admission_time = DateTimeField('Admission time', validators=[Required()],
                                                      format='%I:%M %p')
 
-    icd_codes = SelectMultipleField('ICD codes', validators=[Required()],
-                                    coerce=int)
+    icd_codes = LazySelectMultipleField('ICD codes', validators=[Required()],
+                                        coerce=int, choices=[])
 
     room_price = StringField('Room price', validators=[Required(),
                                                        validate_comma_sep_dec,
@@ -176,6 +191,55 @@ class GOPForm(BaseForm):
                                                      default='0')
     submit = SubmitField('Send GOP request')
 
+    def __init__(self, provider=None, *args, **kwargs):
+        super(GOPForm, self).__init__(*args, **kwargs)
+        # the provider whose payers and doctors may be chosen
+        self.provider = provider
+
+    def prepare_lazy_choices(self):
+        """Fills the choices of the submitted values only,
+        the rest of the choices are loaded by the page on demand"""
+        payer = self.find_payer(self.payer.data)
+        if payer:
+            self.payer.choices = self.payer.choices + [(payer.id,
+                                                        payer.company)]
+
+        doctor = self.find_doctor(self.doctor_name.data)
+        if doctor:
+            self.doctor_name.choices = self.doctor_name.choices + [
+                (doctor.id, doctor.name + ' (%s)' % doctor.doctor_type)]
+
+        if self.icd_codes.data:
+            self.icd_codes.choices = [(i.id, i.code) for i in \
+                ICDCode.query.filter(ICDCode.id.in_(self.icd_codes.data))]
+
+    def find_payer(self, payer_id):
+        if not payer_id or not self.provider:
+            return None
+        return Payer.query.join(custom_payers,
+                                custom_payers.c.payer_id == Payer.id)\
+            .filter(custom_payers.c.provider_id == self.provider.id,
+                    Payer.id == payer_id).first()
+
+    def find_doctor(self, doctor_id):
+        if not doctor_id or not self.provider:
+            return None
+        return self.provider.doctors.filter_by(id=doctor_id).first()
+
+    def validate_payer(self, field):
+        if not self.find_payer(field.data):
+            raise ValidationError('Please select a payer.')
+
+    def validate_doctor_name(self, field):
+        if not self.find_doctor(field.data):
+            raise ValidationError('Please select a doctor.')
+
+    def validate_icd_codes(self, field):
+        ids = set(field.data or [])
+        if ids and \
+          ICDCode.query.filter(ICDCode.id.in_(ids)).count() != len(ids):
+            raise ValidationError('Unknown ICD code.')
+
     def validate_national_id(self, field):
         if field.data != self.current_national_id.data and \
           Member.query.filter_by(national_id=field.data).first():
@@ -1,6 +1,13 @@
-import os, random, string
+import os, json, random, string
+from datetime import date, datetime, time
+from sqlalchemy import case, distinct, func
 from werkzeug.utils import secure_filename
-from .. import config, redis_store
+from .. import changes, config, db, redis_store, socketio
+from ..models import Claim, Doctor, Member, Payer, Provider, custom_payers
+from ..models import date_months_ago
+
+# the seconds the providers' dropdown choices are cached for
+CHOICES_CACHE_TIMEOUT = 60 * 60
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -37,21 +44,123 @@ def safe_div(dividend, divisor):
 def percent_of(part, total):
     return safe_div(float(part), float(total)) * 100
 
-def patients_amount(claims, _type):
-    """Returns the in-patients for the given claims."""
-    result = []
+def patient_windows(months):
+    """The {"<months>": (start, end)} ranges of the claims' datetime,
+    the same as Claim.for_months uses"""
+    today = datetime.combine(date.today(), time())
+    return dict((str(month),
+                 (datetime.combine(date_months_ago(month), time()), today))
+                for month in months)
 
-    for claim in claims:
-        if claim.member.patient_type == _type:
-            result.append(claim.member.id)
+def patient_counts(query, windows=None):
+    """Counts the distinct members of the claims of the query by their
+    patient type with one grouped query. Returns {patient type: {"total":
+    count, window: count}}, the windows are the patient_windows() ranges"""
+    windows = sorted((windows or {}).items())
+    columns = [func.count(distinct(Claim.member_id))]
+    columns += [func.count(distinct(case([(Claim.datetime.between(start, end),
+                                           Claim.member_id)])))
+                for name, (start, end) in windows]
 
-    result = list(set(result))
+    rows = query.order_by(None)\
+                .join(Member, Claim.member_id == Member.id)\
+                .with_entities(Member.patient_type, *columns)\
+                .group_by(Member.patient_type)
 
-    return result
+    names = ['total'] + [name for name, _ in windows]
+    return dict((row[0], dict(zip(names, row[1:]))) for row in rows)
+
+def patient_count(counts, patient_type, window='total'):
+    """The count of the patient_counts() result, 0 if there's none"""
+    return counts.get(patient_type, {}).get(window, 0)
 
 def notify(key, value):
     """Helper function for shortest redis update"""
     try:
         redis_store.set(key, value)
     except:
-        pass
\ No newline at end of file
+        pass
+
+def notify_async(key, value):
+    """Same as notify, but doesn't hold the request on redis"""
+    socketio.start_background_task(notify, key, value)
+
+
+def _choices_key(provider_id, kind):
+    return 'choices:%s:%s' % (provider_id, kind)
+
+
+def provider_choices(provider, kind):
+    """Returns the (id, text) choices of the provider's payers or doctors,
+    the lists are cached in redis until the payers or doctors change"""
+    key = _choices_key(provider.id, kind)
+
+    try:
+        cached = redis_store.get(key)
+    except Exception:
+        cached = None
+
+    if cached:
+        return [tuple(choice) for choice in json.loads(cached.decode('utf-8'))]
+
+    if kind == 'payers':
+        choices = Payer.query.with_entities(Payer.id, Payer.company)\
+            .join(custom_payers, custom_payers.c.payer_id == Payer.id)\
+            .filter(custom_payers.c.provider_id == provider.id)\
+            .order_by(Payer.company).all()
+    elif kind == 'doctors':
+        choices = [(d.id, d.name + ' (%s)' % d.doctor_type) for d in \
+            provider.doctors.with_entities(Doctor.id, Doctor.name,
+                                           Doctor.doctor_type)\
+                            .order_by(Doctor.name)]
+    else:
+        raise ValueError('Unknown choices kind "%s"' % kind)
+
+    choices = [tuple(choice) for choice in choices]
+
+    try:
+        redis_store.set(key, json.dumps(choices), ex=CHOICES_CACHE_TIMEOUT)
+    except Exception:
+        pass
+
+    return choices
+
+
+def forget_provider_choices(provider_ids, kind):
+    keys = [_choices_key(provider_id, kind) for provider_id in provider_ids
+            if provider_id]
+    if not keys:
+        return
+    try:
+        redis_store.delete(*keys)
+    except Exception:
+        pass
+
+
+@changes.subscribe('doctor', keys=('provider_id',))
+def doctors_changed(records):
+    # the doctor could have been moved from another provider
+    forget_provider_choices(set(provider_id for record in records
+                                for provider_id
+                                in record.keys.get('provider_id', ())),
+                            'doctors')
+
+
+@changes.subscribe('payer')
+def payers_changed(records):
+    payer_ids = [record.id for record in records
+                 if record.op == changes.UPDATE]
+    if not payer_ids:
+        return
+    with db.engine.connect() as connection:
+        provider_ids = [row[0] for row in connection.execute(
+            custom_payers.select()
+                         .with_only_columns([custom_payers.c.provider_id])
+                         .where(custom_payers.c.payer_id.in_(payer_ids)))]
+    forget_provider_choices(set(provider_ids), 'payers')
+
+
+@changes.subscribe('provider')
+def providers_changed(records):
+    forget_provider_choices([record.id for record in records
+                             if 'payers' in record.columns], 'payers')
@@ -14,8 +14,10 @@ class ExtFuncsMixin(object):
             if col not in exclude and hasattr(form, col):
                 setattr(model, col, getattr(form, col).data)
 
+        # the view's unit of work commits, the flush gives the new
+        # model its ID
         self.__db__.session.add(model)
-        self.__db__.session.commit()
+        self.__db__.session.flush()
 
     def all_for_admin(self):
         return self.__model__.query.filter(self.__model__.id != False)
@@ -6,7 +6,7 @@ from dateutil.relativedelta import relativedelta
 from flask import flash, render_template, redirect, request, url_for
 from flask import jsonify, send_from_directory, session
 from flask_login import current_user, login_user
-from sqlalchemy import desc
+from sqlalchemy import desc, or_
 from flask_mail import Message
 from flask_socketio import send, emit
 
@@ -14,13 +14,20 @@ from .services import MedicalDetailsService, MemberService, ClaimService
 from .services import GuaranteeOfPaymentService, TerminalService
 from .forms import ClaimForm, MemberForm, TerminalForm, GOPForm
 from .helpers import pass_generator, photo_file_name_santizer, percent_of
-from .helpers import patients_amount
+from .helpers import patient_count, patient_counts, patient_windows
+from .helpers import provider_choices
 
 from . import main
-from .. import config, db, models, mail, socketio, redis_store
+from .. import analytics, config, db, heartbeats, lifecycle, lookup, models
+from .. import mail
+from .. import snapshots, timeseries
+from .. import socketio
+from .. import redis_store
 from ..models import Claim, Member, Terminal, ICDCode, Provider, Payer
 from ..models import Doctor, User, GuaranteeOfPayment
-from ..models import monthdelta, login_required
+from ..models import login_required
+from ..database import read_only, unit_of_work
+from ..dates import parse_iso_date
 
 
 @socketio.on('hello')
@@ -51,6 +58,7 @@ terminal_service = TerminalService()
 
 @main.route('/')
 @login_required()
+@read_only
 def index():
     if current_user.get_type() == 'provider':
         providers = []
@@ -65,61 +73,71 @@ def index():
 
     members = member_service.all_for_user(current_user).all()
 
+    # the dashboard looks back no further than the archive horizon,
+    # so only the recent partitions are scanned; the claims without the
+    # date are counted as before, they stay in the claim table until the
+    # partitioning dates them NULL_DATE (see lifecycle.py)
     claims_query = claim_service.all_for_user(current_user)\
+                                .filter(or_(Claim.datetime.is_(None),
+                                            Claim.datetime >= \
+                                            lifecycle.archive_horizon()))\
                                 .order_by(desc(Claim.datetime))
-    claims = claims_query.all()
+    # the user's claims are only counted, by their status
+    claims = snapshots.ClaimSnapshot.load(claims_query, columns=('status',))
     total_claims = len(claims)
 
-    # get the claims in the given month ranges
-    months = ['0', '1', '3', '5', '6', '24']
+    # the claims in the given month ranges and in the months that long ago,
+    # the columns of the last 24 months are loaded at once
+    windows = patient_windows([0, 1, 3, 5, 6, 24])
+    edges = snapshots.month_edges(24)
+    recent = snapshots.ClaimSnapshot.load(
+        Claim.query.filter(Claim.datetime >= edges[0]))
+    by_month = recent.histogram(edges)
+
+    ranges = {}
     historical = {}
-    for month in months:
-        historical[month] = Claim.for_months(int(month))
+    for month, (start, end) in windows.items():
+        ranges[month] = recent.between(start, end)
+        historical[month] = (recent.count(ranges[month]),
+                             by_month[-1 - int(month)])
 
     amount_summary = {'total': Claim.amount_sum(0)[0]}
     months = ['0', '1', '2', '3', '4', '5', '6', '24']
     for month in months:
         amount_summary[month] = Claim.amount_sum(int(month))
 
+    # the distinct patients of the user's claims and
+    # of the claims' month ranges, by their type
+    total_patients = patient_counts(claims_query)
+    patients = patient_counts(Claim.query, windows)
+
     in_patients = {
-        'total': len(patients_amount(claims, 'in')),
-        '1_month': len(patients_amount(historical['1'][0], 'in')),
-        '3_months': len(patients_amount(historical['3'][0], 'in')),
-        '6_months': len(patients_amount(historical['6'][0], 'in')),
-        '24_months': len(patients_amount(historical['24'][0], 'in'))
+        'total': patient_count(total_patients, 'in'),
+        '1_month': patient_count(patients, 'in', '1'),
+        '3_months': patient_count(patients, 'in', '3'),
+        '6_months': patient_count(patients, 'in', '6'),
+        '24_months': patient_count(patients, 'in', '24')
     }
 
     out_patients = {
-        'total': len(patients_amount(claims, 'out')),
-        '1_month': len(patients_amount(historical['1'][0], 'out')),
-        '3_months': len(patients_amount(historical['3'][0], 'out')),
-        '6_months': len(patients_amount(historical['6'][0], 'out')),
-        '24_months': len(patients_amount(historical['24'][0], 'out'))
+        'total': patient_count(total_patients, 'out'),
+        '1_month': patient_count(patients, 'out', '1'),
+        '3_months': patient_count(patients, 'out', '3'),
+        '6_months': patient_count(patients, 'out', '6'),
+        '24_months': patient_count(patients, 'out', '24')
     }
 
     by_cost = {}
     by_icd = {}
 
-    # calculate values for the Historical Claims section table
-    for key, value in historical.items():
-        for claim in value[0]:
-            # calculate values for the Medical Summary By Cost table
-            if not claim.amount in by_cost:
-                by_cost[claim.amount] = {}
-
-            if not key in by_cost[claim.amount]:
-                by_cost[claim.amount][key] = 1
-            else:
-                by_cost[claim.amount][key] += 1
+    # calculate values for the Medical Summary By Cost
+    # and By ICD Code tables
+    for key, mask in ranges.items():
+        for amount, count in recent.counts('amount', mask).items():
+            by_cost.setdefault(amount, {})[key] = count
 
-            # calculate values for the Medical Summary By ICD Code table
-            if not claim.icd_code in by_icd:
-                by_icd[claim.icd_code] = {}
-
-            if not key in by_icd[claim.icd_code]:
-                by_icd[claim.icd_code][key] = 1
-            else:
-                by_icd[claim.icd_code][key] += 1
+        for icd_code, count in recent.counts('icd_code', mask).items():
+            by_icd.setdefault(icd_code, {})[key] = count
 
     in_patients_perc = percent_of(in_patients['total'],
                             out_patients['total'] + in_patients['total'])
@@ -127,31 +145,29 @@ def index():
     out_patients_perc = percent_of(out_patients['total'],
                             out_patients['total'] + in_patients['total'])
 
-    open_claims = claims_query.filter_by(status="Open").all()
-    open_claims_perc = percent_of(len(open_claims), len(claims))
+    open_claims = claims.count(claims.equals('status', 'Open'))
+    open_claims_perc = percent_of(open_claims, total_claims)
 
-    closed_claims =  claims_query.filter_by(status="Closed").all()
-    closed_claims_perc = percent_of(len(closed_claims), len(claims))
+    closed_claims = claims.count(claims.equals('status', 'Closed'))
+    closed_claims_perc = percent_of(closed_claims, total_claims)
 
+    # the amounts of the claims of the last 6 months, by the month
+    amounts = timeseries.claim_series('all', [], edges[-7].date(),
+                                      date.today(), timeseries.MONTH)
     amount_chart_data = {
-        'labels': [],
-        'values': []
+        'labels': [month_abbr[int(label[5:7])] for label in amounts['labels']],
+        'values': amounts['amount']
     }
-    # fill in the chart data for the 5 months
-    for months in reversed(range(6)):
-        month_name = month_abbr[monthdelta(datetime.now(), months * -1).month]
-        amount_chart_data['labels'].append(month_name)
-        amount_chart_data['values'].append(amount_summary[str(months)][2])
 
     in_patients_data = [
-        len(patients_amount(historical['5'][0], 'in')),
-        len(patients_amount(historical['3'][0], 'in')),
-        len(patients_amount(historical['0'][0], 'in'))
+        patient_count(patients, 'in', '5'),
+        patient_count(patients, 'in', '3'),
+        patient_count(patients, 'in', '0')
     ]
     out_patients_data = [
-        len(patients_amount(historical['5'][0], 'out')),
-        len(patients_amount(historical['3'][0], 'out')),
-        len(patients_amount(historical['0'][0], 'out'))
+        patient_count(patients, 'out', '5'),
+        patient_count(patients, 'out', '3'),
+        patient_count(patients, 'out', '0')
     ]
 
     pagination, claims = claim_service.prepare_pagination(claims_query)
@@ -177,7 +193,8 @@ def index():
         'in_patients_data': in_patients_data,
         'out_patients_data': out_patients_data,
         'today': datetime.now(),
-        'amount_chart_data': amount_chart_data
+        'amount_chart_data': amount_chart_data,
+        'turnaround': analytics.turnaround_for_user(current_user)
     }
 
     return render_template('index.html', **context)
@@ -197,9 +214,13 @@ def terminals():
 
     pagination, terminals = terminal_service.prepare_pagination(terminals)
 
+    # the live statuses reported by the terminals' heartbeats
+    live = heartbeats.fleet_status([terminal.id for terminal in terminals])
+
     # render the "terminals.html" template with the given terminals
     return render_template('terminals.html', terminals=terminals,
-                                             pagination=pagination)
+                                             pagination=pagination,
+                                             live=live)
 
 
 @main.route('/terminal/<int:terminal_id>')
@@ -219,6 +240,7 @@ def terminal(terminal_id):
 
 @main.route('/terminal/add', methods=['GET', 'POST'])
 @login_required(types=['provider'])
+@unit_of_work
 def terminal_add():
     form = TerminalForm()
 
@@ -236,6 +258,7 @@ def terminal_add():
 
 @main.route('/terminal/<int:terminal_id>/edit', methods=['GET', 'POST'])
 @login_required(types=['provider'])
+@unit_of_work
 def terminal_edit(terminal_id):
     # retreive the current user's terminal by its ID
     terminal = terminal_service.get_for_user(terminal_id, current_user)
@@ -271,24 +294,19 @@ def claims():
 
 @main.route('/claim/<int:claim_id>', methods=['GET', 'POST'])
 @login_required()
+@unit_of_work
 def claim(claim_id):
     claim = claim_service.get_for_user(claim_id, current_user)
 
     if claim.new_claim:
         claim.new_claim = 0
         db.session.add(claim)
-        db.session.commit()
-
-    form = GOPForm()
 
-    form.payer.choices += [(p.id, p.company) for p in \
-                           current_user.provider.payers]
+    form = GOPForm(provider=current_user.provider)
 
-    form.icd_codes.choices = [(i.id, i.code) for i in \
-        ICDCode.query.filter(ICDCode.code != 'None' and ICDCode.code != '')]
-
-    form.doctor_name.choices += [(d.id, d.name + ' (%s)' % d.doctor_type) \
-                                for d in current_user.provider.doctors]
+    # only the submitted choices are loaded here, the page
+    # loads the rest from the "main.claim_choices" on demand
+    form.prepare_lazy_choices()
 
     if current_user.get_type() == 'provider' and request.method != 'POST':
         form.name.data = claim.member.name
@@ -322,20 +340,19 @@ def claim(claim_id):
                if field.name.replace('medical_details_', '') \
                in medical_details_service.columns})
 
-        payer = Payer.query.get(form.payer.data)
+        payer = form.find_payer(form.payer.data)
 
         gop = GuaranteeOfPayment(
                 claim=claim,
                 payer=payer,
                 member=member,
                 provider=current_user.provider,
-                doctor_name=Doctor.query.get(int(form.doctor_name.data)).name,
+                doctor_name=form.find_doctor(form.doctor_name.data).name,
                 status='pending',
                 medical_details=medical_details)
 
-        for icd_code_id in form.icd_codes.data:
-            icd_code = ICDCode.query.get(int(icd_code_id))
-            gop.icd_codes.append(icd_code)
+        gop.icd_codes = ICDCode.query.filter(
+            ICDCode.id.in_(form.icd_codes.data)).all()
 
         exclude = ['doctor_name', 'status', 'icd_codes']
         gop_service.update_from_form(gop, form, exclude=exclude)
@@ -376,11 +393,8 @@ def claim(claim_id):
                                    root=request.url_root, user=user,
                                    rand_pass = rand_pass, gop_id=gop.id)
 
-        # send the email
-        try:
-            mail.send(msg)
-        except Exception as e:
-            pass
+        # send the email once the GOP is saved
+        db.after_commit(mail.send, msg)
 
         flash('Your GOP request has been sent.')
 
@@ -390,8 +404,73 @@ def claim(claim_id):
         return render_template('claim.html', claim=claim)
 
 
+@main.route('/claims/series', methods=['GET'])
+@login_required()
+@read_only
+def claim_series():
+    """The chart data of the user's claims: their counts and amounts by
+    the day, week or month of the "start" to "end" range (YYYY-MM-DD),
+    no more than "points" of them"""
+    scope = timeseries.scope_for_user(current_user,
+                                      request.args.get('provider_id',
+                                                       type=int))
+    if scope is None:
+        return jsonify({'error': 'forbidden'}), 403
+
+    try:
+        start, end = [parse_iso_date(request.args[name], name).date()
+                      if request.args.get(name) else None
+                      for name in ('start', 'end')]
+        series = timeseries.claim_series(*scope, start=start, end=end,
+            unit=request.args.get('bucket') or None,
+            points=request.args.get('points', timeseries.MAX_POINTS,
+                                    type=int))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(series)
+
+
+@main.route('/claim/choices/<kind>', methods=['GET'])
+@login_required(types=['provider'])
+@read_only
+def claim_choices(kind):
+    """Returns the choices of the GOP form's dropdowns,
+    filtered by the optional "query" parameter"""
+    query = (request.args.get('query') or '').lower()
+
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+    except ValueError:
+        limit = 50
+
+    if kind == 'icd-codes':
+        icd_codes = ICDCode.query.with_entities(ICDCode.id, ICDCode.code)\
+            .filter(ICDCode.code != 'None', ICDCode.code != '')
+
+        if query:
+            pattern = '%' + query + '%'
+            icd_codes = icd_codes.filter(ICDCode.code.ilike(pattern) | \
+                                         ICDCode.description.ilike(pattern) | \
+                                         ICDCode.common_term.ilike(pattern))
+
+        choices = icd_codes.order_by(ICDCode.code).limit(limit).all()
+
+    elif kind in ('payers', 'doctors'):
+        choices = [choice for choice in \
+                   provider_choices(current_user.provider, kind) \
+                   if query in choice[1].lower()][:limit]
+
+    else:
+        return jsonify({'error': 'not found'}), 404
+
+    return jsonify({'results': [{'id': choice[0], 'text': choice[1]} \
+                                for choice in choices]})
+
+
 @main.route('/claim/add', methods=['GET', 'POST'])
 @login_required(types=['provider'])
+@unit_of_work
 def claim_add():
     terminals = terminal_service.all_for_user(current_user)
     members = member_service.all_for_user(current_user)
@@ -418,6 +497,7 @@ def claim_add():
 
 @main.route('/claim/<int:claim_id>/edit', methods=['GET', 'POST'])
 @login_required(deny_types=['payer'])
+@unit_of_work
 def claim_edit(claim_id):
     claim = claim_service.get_for_user(claim_id, current_user)
     members = member_service.all_for_user(current_user)
@@ -472,8 +552,32 @@ def member(member_id):
                                           pagination=pagination)
 
 
+@main.route('/member/lookup', methods=['GET'])
+@login_required()
+@read_only
+def member_lookup():
+    """The front desk's lookup of the members by the name, national ID,
+    policy or card number, the best matches first"""
+    try:
+        limit = max(min(int(request.args.get('limit', lookup.LOOKUP_LIMIT)),
+                        lookup.LOOKUP_MAX_LIMIT), 1)
+    except ValueError:
+        limit = lookup.LOOKUP_LIMIT
+
+    # the providers only find their own members, the admins every one
+    provider_id = None
+    if current_user.get_role() != 'admin':
+        if not current_user.provider:
+            return jsonify({'results': []})
+        provider_id = current_user.provider.id
+
+    return jsonify({'results': lookup.lookup(request.args.get('q'),
+                                             provider_id, limit)})
+
+
 @main.route('/member/add', methods=['GET', 'POST'])
 @login_required(types=['provider'])
+@unit_of_work
 def member_add():
     form = MemberForm()
 
@@ -498,6 +602,7 @@ def member_add():
 
 @main.route('/member/<int:member_id>/edit', methods=['GET', 'POST'])
 @login_required(types=['provider'])
+@unit_of_work
 def member_edit(member_id):
     # retreive the current user's member by its ID
     member = member_service.get_for_user(member_id, current_user)
@@ -553,6 +658,7 @@ def internal_server_error(e):
 
 
 @main.route('/search', methods=['GET'])
+@read_only
 def search():
     found = {
         'results': []
@@ -588,6 +694,7 @@ def search():
 
 
 @main.route('/icd-code/search', methods=['GET'])
+@read_only
 def icd_code_search():
     query = request.args.get('query').lower()
 
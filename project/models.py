@@ -5,9 +5,11 @@ from dateutil.relativedelta import relativedelta
 from flask import redirect, url_for
 from flask_login import current_user, UserMixin
 from functools import wraps
-from sqlalchemy import extract
-from sqlalchemy.orm import class_mapper, ColumnProperty
+from sqlalchemy import String, extract
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import class_mapper, ColumnProperty, validates
 from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import FunctionElement
 from werkzeug import check_password_hash, generate_password_hash
 
 from . import db, login_manager
@@ -49,6 +51,32 @@ class ColsMapMixin(object):
             if isinstance(prop, ColumnProperty)]
 
 
+def normalize_email(email):
+    """The user's email as it's saved and looked up, stripped and
+    lowercased, the values other than the strings are returned as is"""
+    if hasattr(email, 'strip'):
+        return email.strip().lower()
+    return email
+
+
+class email_key(FunctionElement):
+    """The email column compared case-insensitively with the normalized
+    emails, e.g. email_key(User.email) == normalize_email(email)"""
+    type = String()
+    name = 'email_key'
+
+
+@compiles(email_key)
+def _email_key(element, compiler, **kw):
+    return 'lower(%s)' % compiler.process(element.clauses, **kw)
+
+
+@compiles(email_key, 'mysql')
+def _email_key_mysql(element, compiler, **kw):
+    # the column's collation ignores the case, its index stays usable
+    return compiler.process(element.clauses, **kw)
+
+
 class User(UserMixin, ColsMapMixin, db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
@@ -77,6 +105,15 @@ class User(UserMixin, ColsMapMixin, db.Model):
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @validates('email')
+    def validate_email(self, key, email):
+        return normalize_email(email)
+
+    @classmethod
+    def by_email(cls, email):
+        """The query of the user with the email, whatever its case"""
+        return cls.query.filter(email_key(cls.email) == normalize_email(email))
+
     def get_role(self):
         return self.role
 
@@ -119,6 +156,9 @@ class Member(ColsMapMixin, db.Model):
     raiting = db.Column(db.String(50))
     device_uid = db.Column(db.String(127))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # the time of the last change, the members' app syncs by it
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     claims = db.relationship('Claim', backref='member', lazy='dynamic')
     medical_records = db.relationship('MedicalRecord', backref='member',
                                       lazy='dynamic')
@@ -177,6 +217,27 @@ custom_members = db.Table('custom_members',
     db.Column('provider_id', db.Integer, db.ForeignKey('provider.id'))
 )
 
+class MemberSearchToken(db.Model):
+    """The members' search tokens of the front desk lookup, see lookup.py:
+    the normalized words of the name, the compact IDs and the name's
+    trigrams ("field" is "gram"), a row per provider of the member
+    (provider_id is NULL for the members without one)"""
+    __tablename__ = 'member_search_token'
+    id = db.Column(db.Integer, primary_key=True)
+    provider_id = db.Column(db.Integer)
+    member_id = db.Column(db.Integer, nullable=False)
+    field = db.Column(db.String(20), nullable=False)
+    token = db.Column(db.String(64), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_member_search_token_provider_token', 'provider_id',
+                 'field', 'token', 'member_id'),
+        db.Index('ix_member_search_token_token', 'field', 'token',
+                 'member_id'),
+        db.Index('ix_member_search_token_member', 'member_id'),
+    )
+
+
 custom_icd_codes = db.Table('custom_icd_codes',
     db.Column('guarantee_of_payment_id', db.Integer,
         db.ForeignKey('guarantee_of_payment.id')),
@@ -272,6 +333,10 @@ class Claim(ColsMapMixin, db.Model):
     status = db.Column(db.String(40))
     claim_number = db.Column(db.String(80))
     claim_type = db.Column(db.String(80))
+    # the time of the last change, the members' app syncs by it
+    # (defined before the "datetime" column, which hides the module)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     datetime = db.Column(db.DateTime)
     admitted = db.Column(db.String(40))
     discharged = db.Column(db.String(40))
@@ -282,6 +347,17 @@ class Claim(ColsMapMixin, db.Model):
     member_id = db.Column(db.Integer, db.ForeignKey('member.id'))
     terminal_id = db.Column(db.Integer, db.ForeignKey('terminal.id'))
     new_claim = db.Column(db.SmallInteger, default=0)
+    # the key sent by a terminal to make its retries idempotent,
+    # it's unique per terminal, see ClaimIdempotencyKey
+    idempotency_key = db.Column(db.String(80))
+
+    __table_args__ = (
+        db.Index('ix_claim_terminal_idempotency_key', 'terminal_id',
+                 'idempotency_key'),
+        # the member's claims, the latest first
+        db.Index('ix_claim_member_datetime', 'member_id', 'datetime'),
+        db.Index('ix_claim_member_updated_at', 'member_id', 'updated_at'),
+    )
 
     @classmethod
     def for_months_filter(cls, query_object, months, _type='all'):
@@ -331,6 +407,38 @@ class Claim(ColsMapMixin, db.Model):
                                                         _type='scalar')
 
 
+class ClaimIdempotencyKey(db.Model):
+    """The terminals' claim idempotency keys, the primary key keeps them
+    unique per terminal. They're not a unique index of the claim table,
+    which is partitioned by the date on MySQL (see lifecycle.py), where
+    the unique indexes have to have the date. The archived claims' keys
+    are deleted with them"""
+    __tablename__ = 'claim_idempotency_key'
+    terminal_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    idempotency_key = db.Column(db.String(80), primary_key=True)
+    claim_id = db.Column(db.Integer, nullable=False, index=True)
+
+
+class ClaimArchive(db.Model):
+    """The claims older than CLAIM_ARCHIVE_MONTHS moved out of the claim
+    table by "manage.py archive_claims", see lifecycle.py. The whole row
+    is kept in "data" as compressed JSON, the columns are for the lookups"""
+    __tablename__ = 'claim_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    datetime = db.Column(db.DateTime)
+    member_id = db.Column(db.Integer)
+    provider_id = db.Column(db.Integer)
+    terminal_id = db.Column(db.Integer)
+    data = db.Column(db.LargeBinary)
+    archived_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_claim_archive_member_datetime', 'member_id', 'datetime'),
+        db.Index('ix_claim_archive_provider_datetime', 'provider_id',
+                 'datetime'),
+    )
+
+
 class Contract(db.Model):
     __tablename__ = 'contract'
     id = db.Column(db.Integer, primary_key=True)
@@ -418,11 +526,26 @@ class GuaranteeOfPayment(ColsMapMixin ,db.Model):
     stamp_author = db.Column(db.String(50))
     timestamp_edited = db.Column(db.DateTime, default=datetime.now())
     timestamp = db.Column(db.DateTime, default=datetime.now())
+    # the payer's reviewer working on the pending GOP until the lease
+    # expires, see api/queue.py
+    leased_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    lease_expires = db.Column(db.DateTime)
+    # the time of the last change, the members' app syncs by it
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     medical_details = db.relationship('MedicalDetails', uselist=False,
                                       backref='guarantee_of_payment')
     claim = db.relationship('Claim', uselist=False,
                             backref='guarantee_of_payment')
 
+    __table_args__ = (
+        db.Index('ix_guarantee_of_payment_member_updated_at', 'member_id',
+                 'updated_at'),
+        # the payers' queues of the pending GOPs, the oldest first
+        db.Index('ix_guarantee_of_payment_payer_status_timestamp',
+                 'payer_id', 'status', 'timestamp'),
+    )
+
     def turnaround_time(self):
         if not self.timestamp_edited:
             time_edited = datetime.now()
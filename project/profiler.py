@@ -0,0 +1,155 @@
+import os, random, sys, threading, time
+
+from collections import defaultdict
+from flask import request, g
+from flask_login import current_user
+
+_thread_module = 'thread' if sys.version_info[0] < 3 else '_thread'
+
+try:
+    # under gevent the threading module is patched to greenlets,
+    # the sampler has to run in a real OS thread to run alongside
+    # the request
+    from gevent import monkey
+    from greenlet import getcurrent
+    _start_new_thread, _get_ident, _allocate_lock = monkey.get_original(
+        _thread_module, ['start_new_thread', 'get_ident', 'allocate_lock'])
+    _sleep = monkey.get_original('time', 'sleep')
+except ImportError:
+    monkey = getcurrent = None
+    _thread = __import__(_thread_module)
+    _start_new_thread = _thread.start_new_thread
+    _get_ident = _thread.get_ident
+    _allocate_lock = _thread.allocate_lock
+    _sleep = time.sleep
+
+
+def _greenlets():
+    # the greenlets share the OS thread, the thread's frame is the one
+    # of whichever greenlet runs
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+class StackSampler(object):
+    """Statistical profiler which samples the stack of a single thread
+    from a helper thread. With the greenlet given, it samples that
+    greenlet's stack: its frame while it's switched out, the thread's
+    one while it runs"""
+
+    def __init__(self, thread_id, interval=0.005, greenlet=None):
+        self.thread_id = thread_id
+        self.greenlet = greenlet
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self._running = False
+        self._lock = _allocate_lock()
+
+    def start(self):
+        self._running = True
+        _start_new_thread(self._run, ())
+
+    def stop(self):
+        self._running = False
+
+    def _frame(self):
+        if self.greenlet is not None:
+            if self.greenlet.dead:
+                return None
+            # gr_frame is None only while the greenlet runs
+            frame = self.greenlet.gr_frame
+            if frame is not None:
+                return frame
+        return sys._current_frames().get(self.thread_id)
+
+    def _run(self):
+        while self._running:
+            frame = self._frame()
+            if frame is not None:
+                stack = self._collapse(frame)
+                with self._lock:
+                    self.stacks[stack] += 1
+            _sleep(self.interval)
+
+    @staticmethod
+    def _collapse(frame):
+        # build the "outer;...;inner" stack string used by flamegraph.pl
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                       code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self):
+        """Returns the samples in the collapsed stacks format"""
+        with self._lock:
+            return ['%s %d' % (stack, count)
+                    for stack, count in self.stacks.items()]
+
+
+class Profiler(object):
+    """Opt-in request profiler. A request is profiled either when an admin
+    asks for it with the "X-Profile" header or the "profile" query param,
+    or when it is picked by the random sampler (PROFILER_SAMPLE_RATE).
+    The samples are appended to "<PROFILER_FOLDER>/<endpoint>.folded"."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILER_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILER_INTERVAL', 0.005)
+        app.config.setdefault('PROFILER_FOLDER',
+                              os.path.join(app.root_path, 'profiles'))
+
+        self.app = app
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _requested(self):
+        flag = request.headers.get('X-Profile') or request.args.get('profile')
+        if not flag or flag == '0':
+            return False
+        # profiling on demand is restricted to admins
+        return current_user.is_authenticated and \
+            current_user.get_role() == 'admin'
+
+    def _before_request(self):
+        rate = self.app.config['PROFILER_SAMPLE_RATE']
+        if not request.endpoint or request.endpoint == 'static':
+            return
+        if not (rate and random.random() < rate) and not self._requested():
+            return
+
+        g.profiler_sampler = StackSampler(_get_ident(),
+            self.app.config['PROFILER_INTERVAL'],
+            getcurrent() if _greenlets() else None)
+        g.profiler_sampler.start()
+
+    def _teardown_request(self, exc):
+        sampler = g.pop('profiler_sampler', None)
+        if sampler is None:
+            return
+
+        sampler.stop()
+
+        try:
+            self.save(request.endpoint, sampler.collapsed())
+        except (IOError, OSError):
+            pass
+
+    def save(self, endpoint, lines):
+        if not lines:
+            return
+
+        folder = self.app.config['PROFILER_FOLDER']
+        filename = os.path.join(folder, endpoint.replace('.', '_') + '.folded')
+
+        with self._lock:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(filename, 'a') as fh:
+                fh.write('\n'.join(lines) + '\n')
@@ -0,0 +1,87 @@
+"""The read replica routing check (see database.RoutingSession). The app is
+run on two temporary SQLite files, the primary and its "replica", which
+hold different rows, so the rows a query finds tell which database it was
+sent to: the db.read_only() reads have to come from the replica, the other
+reads and every write from the primary, and a session which has written
+has to read its own writes from the primary until it's closed."""
+import os, tempfile
+
+from sqlalchemy import select
+
+from . import create_app, db, models
+
+PRIMARY, REPLICA = 'primary', 'replica'
+
+
+def _database():
+    handle, path = tempfile.mkstemp(suffix='.db', prefix='routing-')
+    os.close(handle)
+    return path
+
+
+def _code():
+    # the code of the first ICD code, it tells the database apart
+    return models.ICDCode.query.with_entities(models.ICDCode.code)\
+                         .order_by(models.ICDCode.id).limit(1).scalar()
+
+
+def _found(engine, code):
+    table = models.ICDCode.__table__
+    return engine.execute(select([table.c.id])
+                          .where(table.c.code == code)).first() is not None
+
+
+def _checks(app):
+    primary = db.get_engine(app)
+    replica = db.get_engine(app, 'replica_0')
+    for engine, code in ((primary, PRIMARY), (replica, REPLICA)):
+        db.metadata.create_all(engine, tables=[models.ICDCode.__table__])
+        engine.execute(models.ICDCode.__table__.insert(), code=code)
+
+    checks = []
+
+    checks.append(('the reads go to the primary', _code() == PRIMARY))
+
+    with db.read_only():
+        checks.append(('the read_only reads go to the replica',
+                       _code() == REPLICA))
+
+        db.session.add(models.ICDCode(code='written'))
+        db.session.flush()
+        checks.append(('the session reads its writes from the primary',
+                       _code() == PRIMARY))
+        db.session.commit()
+
+    checks.append(('the read_only writes go to the primary',
+                   _found(primary, 'written') and
+                   not _found(replica, 'written')))
+
+    db.session.remove()
+    with db.read_only():
+        checks.append(('the closed session reads from the replica again',
+                       _code() == REPLICA))
+    db.session.remove()
+
+    return checks
+
+
+def run():
+    """Runs the routing check, returns the [(check, passed)]"""
+    paths = [_database(), _database()]
+    app = create_app('testing')
+    # the engines are made on the first use, the replica's bind is the one
+    # RoutingSQLAlchemy.init_app makes of SQLALCHEMY_REPLICAS
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + paths[0],
+                      SQLALCHEMY_REPLICAS=['sqlite:///' + paths[1]],
+                      SQLALCHEMY_BINDS={'replica_0': 'sqlite:///' + paths[1]})
+
+    try:
+        with app.app_context():
+            return _checks(app)
+    finally:
+        with app.app_context():
+            db.session.remove()
+            for bind in (None, 'replica_0'):
+                db.get_engine(app, bind).dispose()
+        for path in paths:
+            os.remove(path)
@@ -0,0 +1,140 @@
+import os
+
+from base64 import urlsafe_b64encode
+from flask.sessions import SessionInterface, SessionMixin
+from flask.sessions import SecureCookieSessionInterface
+from flask.sessions import session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+
+def total_seconds(td):
+    return td.days * 60 * 60 * 24 + td.seconds
+
+
+class RedisSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, ttl=None,
+                 stateless=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        # the seconds the session had left in redis when it was opened
+        self.ttl = ttl
+        # the stateless sessions are never saved
+        self.stateless = stateless
+        # the id the session had before regenerate()
+        self.old_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        """Moves the session to a new id, the old one is deleted when the
+        session is saved. Called when the user logs in or out, so an id
+        planted before the login is never authenticated"""
+        if not self.stateless:
+            if not self.new and self.old_sid is None:
+                self.old_sid = self.sid
+            self.sid = RedisSessionInterface.generate_sid()
+            self.new = True
+            self.modified = True
+
+
+def regenerate_session(session):
+    """Gives the session a new id, the signed cookie sessions
+    of the redis fallback have none"""
+    # the session is usually the flask.session proxy
+    regenerate = getattr(session, 'regenerate', None)
+    if regenerate is not None:
+        regenerate()
+
+
+class RedisSessionInterface(SessionInterface):
+    """Server-side sessions kept in redis with a sliding expiration.
+    The cookie holds the session id only, so it is sent just once, when
+    the session is created. The session's TTL is refreshed at most once
+    per SESSION_REFRESH_INTERVAL and its content is written only when it
+    changes. The id changes on the login and the logout, see
+    regenerate_session(). The blueprints in "stateless_blueprints" get
+    an empty session which is never stored. If redis is not available, the signed cookie
+    sessions are used."""
+
+    serializer = session_json_serializer
+    session_class = RedisSession
+
+    def __init__(self, redis, prefix='session:', stateless_blueprints=()):
+        self.redis = redis
+        self.prefix = prefix
+        self.stateless_blueprints = stateless_blueprints
+        self.fallback = SecureCookieSessionInterface()
+
+    @staticmethod
+    def generate_sid():
+        return urlsafe_b64encode(os.urandom(24)).decode('ascii')
+
+    def open_session(self, app, request):
+        if request.blueprint in self.stateless_blueprints:
+            return self.session_class(stateless=True)
+
+        sid = request.cookies.get(app.session_cookie_name)
+
+        if not sid:
+            return self.session_class(sid=self.generate_sid(), new=True)
+
+        try:
+            # fetch the session and its TTL in one round trip
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.get(self.prefix + sid)
+            pipe.ttl(self.prefix + sid)
+            data, ttl = pipe.execute()
+        except Exception:
+            return self.fallback.open_session(app, request)
+
+        if data is not None:
+            try:
+                return self.session_class(
+                    self.serializer.loads(data.decode('utf-8')),
+                    sid=sid, ttl=ttl)
+            except ValueError:
+                pass
+
+        return self.session_class(sid=self.generate_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        if not isinstance(session, self.session_class):
+            return self.fallback.save_session(app, session, response)
+
+        if session.stateless:
+            return
+
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        key = self.prefix + session.sid
+        lifetime = total_seconds(app.permanent_session_lifetime)
+
+        try:
+            if session.old_sid:
+                self.redis.delete(self.prefix + session.old_sid)
+
+            if not session:
+                # the existing session has been cleared, e.g. on logout
+                if (session.modified and not session.new) or session.old_sid:
+                    self.redis.delete(key)
+                    response.delete_cookie(app.session_cookie_name,
+                                           domain=domain, path=path)
+                return
+
+            if session.modified or session.new:
+                self.redis.set(key, self.serializer.dumps(dict(session)),
+                               ex=lifetime)
+            elif session.ttl is None or session.ttl < lifetime - \
+                    app.config['SESSION_REFRESH_INTERVAL']:
+                self.redis.expire(key, lifetime)
+        except Exception:
+            return self.fallback.save_session(app, session, response)
+
+        if session.new:
+            # the cookie has no expiration date, redis expires the session
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app))
@@ -0,0 +1,230 @@
+"""Read-only columnar snapshots of the claims for the analytics. Only the
+columns a report needs are fetched, with one Core select, so there are no
+ORM objects, identity map or relationship proxies: the IDs and datetimes
+go to the compact typed arrays and the text columns (amount, icd_code,
+status...) are dictionary-encoded into the integer codes of their labels,
+a few dozens of bytes per claim. The window filters, group-by counts and
+histograms work on the whole columns at once, with numpy if it's installed
+and with the array module and the C-level itertools otherwise."""
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from datetime import date, datetime
+from itertools import compress
+
+from dateutil.relativedelta import relativedelta
+
+from . import db, models
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the rows fetched per round trip while a snapshot is loaded
+FETCH_SIZE = 5000
+# the value of the NULL IDs
+NULL_ID = -1
+
+ID, TIME, LABEL = 'id', 'time', 'label'
+
+# the snapshots' columns, {name: (kind, expression)}, the patient type
+# comes from the claim's member
+COLUMNS = {
+    'id': (ID, models.Claim.id),
+    'member_id': (ID, models.Claim.member_id),
+    'provider_id': (ID, models.Claim.provider_id),
+    'datetime': (TIME, models.Claim.datetime),
+    'amount': (LABEL, models.Claim.amount),
+    'icd_code': (LABEL, models.Claim.icd_code),
+    'status': (LABEL, models.Claim.status),
+    'claim_type': (LABEL, models.Claim.claim_type),
+    'patient_type': (LABEL, models.Member.patient_type)
+}
+
+# the array typecodes of the column kinds, numpy reads the same buffers
+_TYPECODES = {ID: 'l', TIME: 'd', LABEL: 'i'}
+
+_EPOCH = datetime(1970, 1, 1)
+_NAN = float('nan')
+
+
+def timestamp(value):
+    """The datetime (or date) as the seconds since the epoch, NaN for None.
+    The naive datetimes are taken as they are, without a time zone"""
+    if value is None:
+        return _NAN
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return (value - _EPOCH).total_seconds()
+
+
+def _month(value):
+    return datetime(value.year, value.month, 1)
+
+
+class ClaimSnapshot(object):
+    """The claims' columns: the IDs (NULL_ID for NULL), the datetimes as
+    timestamp() and the labels' codes, see "labels". The masks returned by
+    the filters select the claims for the aggregations"""
+
+    def __init__(self, columns, labels, size):
+        self.columns = columns
+        self.labels = labels
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def load(cls, query=None, columns=('datetime', 'amount', 'icd_code'),
+             fetch_size=FETCH_SIZE):
+        """Loads the given columns of the claims of the ORM query
+        (every claim by default)"""
+        if query is None:
+            query = models.Claim.query
+        kinds = [COLUMNS[name][0] for name in columns]
+
+        query = query.order_by(None)\
+                     .with_entities(*[COLUMNS[name][1] for name in columns])
+        if 'patient_type' in columns:
+            query = query.outerjoin(models.Member,
+                                    models.Claim.member_id == models.Member.id)
+
+        values = [array(_TYPECODES[kind]) for kind in kinds]
+        codes = [{} for _ in columns]
+        size = 0
+
+        result = db.session.execute(query.statement)
+        while True:
+            rows = result.fetchmany(fetch_size)
+            if not rows:
+                break
+            size += len(rows)
+
+            for i, column in enumerate(zip(*rows)):
+                if kinds[i] == ID:
+                    values[i].extend(NULL_ID if value is None else value
+                                     for value in column)
+                elif kinds[i] == TIME:
+                    values[i].extend(timestamp(value) for value in column)
+                else:
+                    # the new labels get the next codes
+                    index = codes[i]
+                    values[i].extend(index.setdefault(value, len(index))
+                                     for value in column)
+
+        if numpy is not None:
+            # the arrays' buffers are shared, not copied
+            values = [numpy.frombuffer(column, dtype=column.typecode)
+                      if column else numpy.zeros(0, dtype=column.typecode)
+                      for column in values]
+
+        labels = {}
+        for name, index in zip(columns, codes):
+            if index:
+                labels[name] = sorted(index, key=index.get)
+
+        return cls(dict(zip(columns, values)), labels, size)
+
+    def _nothing(self):
+        if numpy is not None:
+            return numpy.zeros(self.size, dtype=bool)
+        return bytearray(self.size)
+
+    def between(self, start, end, column='datetime'):
+        """The mask of the claims with the time from "start" to "end",
+        both inclusive, like BETWEEN"""
+        start, end = timestamp(start), timestamp(end)
+        values = self.columns[column]
+        if numpy is not None:
+            return (values >= start) & (values <= end)
+        return bytearray(start <= value <= end for value in values)
+
+    def in_month(self, value, column='datetime'):
+        """The mask of the claims with the time in the month of the value"""
+        first = timestamp(_month(value))
+        last = timestamp(_month(value) + relativedelta(months=1))
+        values = self.columns[column]
+        if numpy is not None:
+            return (values >= first) & (values < last)
+        return bytearray(first <= value < last for value in values)
+
+    def equals(self, column, value):
+        """The mask of the claims with the column's value"""
+        values = self.columns[column]
+        if column in self.labels:
+            if value not in self.labels[column]:
+                return self._nothing()
+            value = self.labels[column].index(value)
+        elif value is None:
+            value = NULL_ID
+        if numpy is not None:
+            return values == value
+        return bytearray(item == value for item in values)
+
+    def both(self, mask, other):
+        """The mask of the claims selected by the both masks"""
+        if numpy is not None:
+            return mask & other
+        return bytearray(a & b for a, b in zip(mask, other))
+
+    def count(self, mask=None):
+        """The number of the claims of the mask (every claim by default)"""
+        if mask is None:
+            return self.size
+        if numpy is not None:
+            return int(numpy.count_nonzero(mask))
+        return mask.count(b'\x01')
+
+    def _selected(self, column, mask):
+        values = self.columns[column]
+        if mask is None:
+            return values
+        if numpy is not None:
+            return values[mask]
+        return compress(values, mask)
+
+    def counts(self, column, mask=None):
+        """Groups the claims of the mask by the column, returns {value:
+        count} of the values found, the NULL ones are counted as None"""
+        values = self._selected(column, mask)
+        if numpy is not None:
+            found, counts = numpy.unique(values, return_counts=True)
+            counts = zip(found.tolist(), counts.tolist())
+        else:
+            counts = Counter(values).items()
+
+        labels = self.labels.get(column)
+        if labels is not None:
+            return dict((labels[code], count) for code, count in counts)
+        return dict((None if value == NULL_ID else value, count)
+                    for value, count in counts)
+
+    def histogram(self, edges, column='datetime', mask=None):
+        """The numbers of the claims of the mask with the time from each
+        of the sorted edges (inclusive) to the next one (exclusive)"""
+        edges = [timestamp(edge) for edge in edges]
+        bins = len(edges) - 1
+        values = self._selected(column, mask)
+
+        if numpy is not None:
+            found = numpy.searchsorted(edges, values, side='right') - 1
+            found = found[(found >= 0) & (found < bins)]
+            return numpy.bincount(found, minlength=bins).tolist()
+
+        counts = [0] * bins
+        for value in values:
+            # NaN is past the last edge
+            found = bisect_right(edges, value) - 1
+            if 0 <= found < bins:
+                counts[found] += 1
+        return counts
+
+
+def month_edges(months, today=None):
+    """The first days of the months from "months" ago to the current one
+    and of the next month, the histogram() edges by the month"""
+    first = _month(today or date.today())
+    return [first - relativedelta(months=month)
+            for month in range(months, -2, -1)]
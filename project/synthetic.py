@@ -0,0 +1,221 @@
+"""Synthetic dataset generator used by the benchmarks and for local load
+testing. The generated data is reproducible for the given sizes and seed."""
+import random, string
+
+from datetime import datetime, timedelta
+from sqlalchemy.sql import func
+from werkzeug.security import generate_password_hash
+
+from . import db, lookup, models
+
+DEFAULT_SIZES = {
+    'providers': 5,
+    'payers': 5,
+    'members': 2000,
+    'terminals': 2,     # per provider
+    'doctors': 5,       # per provider
+    'claims': 10000,
+    'gops': 2000,
+    'icd_codes': 2000
+}
+
+PASSWORD = 'benchmark'
+API_KEY = 'benchmark-api-key'
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _insert(table, rows, chunk_size=1000):
+    # executemany requires the same keys in every row
+    keys = set()
+    for row in rows:
+        keys.update(row)
+    rows = [dict((key, row.get(key)) for key in keys) for row in rows]
+
+    # executemany in chunks, much faster than adding ORM objects
+    for i in range(0, len(rows), chunk_size):
+        db.session.execute(table.insert(), rows[i:i + chunk_size])
+
+
+def _word(rnd, size=8):
+    return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(size))
+
+
+def generate(sizes=None, seed=1):
+    """Fills the current database with the synthetic dataset,
+    returns a dictionary with the created objects' IDs"""
+    sizes = dict(DEFAULT_SIZES, **(sizes or {}))
+    rnd = random.Random(seed)
+    now = datetime.now()
+    password_hash = generate_password_hash(PASSWORD)
+
+    ids = {}
+
+    def id_range(model, amount):
+        start = _next_id(model)
+        return list(range(start, start + amount))
+
+    # users: one admin, one per provider and one per payer
+    user_ids = id_range(models.User, 1 + sizes['providers'] + sizes['payers'])
+    users = [{'id': user_ids[0], 'name': 'admin',
+              'email': 'admin.%d@example.com' % user_ids[0],
+              'user_type': 'admin', 'role': 'admin',
+              'password_hash': password_hash, 'api_key': API_KEY}]
+
+    ids['providers'] = id_range(models.Provider, sizes['providers'])
+    ids['payers'] = id_range(models.Payer, sizes['payers'])
+
+    providers, payers = [], []
+    for num, provider_id in enumerate(ids['providers']):
+        user_id = user_ids[1 + num]
+        users.append({'id': user_id, 'name': 'provider %d' % provider_id,
+                      'email': 'provider.%d@example.com' % user_id,
+                      'user_type': 'provider', 'role': 'user',
+                      'password_hash': password_hash})
+        providers.append({'id': provider_id, 'user_id': user_id,
+                          'company': 'Hospital %d' % provider_id,
+                          'provider_type': 'hospital',
+                          'pic_email': 'pic.%d@example.com' % provider_id})
+
+    for num, payer_id in enumerate(ids['payers']):
+        user_id = user_ids[1 + sizes['providers'] + num]
+        users.append({'id': user_id, 'name': 'payer %d' % payer_id,
+                      'email': 'payer.%d@example.com' % user_id,
+                      'user_type': 'payer', 'role': 'user',
+                      'password_hash': password_hash})
+        payers.append({'id': payer_id, 'user_id': user_id,
+                       'company': 'Insurance %d' % payer_id,
+                       'payer_type': 'insurance',
+                       'pic_email': 'payer.pic.%d@example.com' % payer_id})
+
+    ids['users'] = user_ids
+    # emails of the users to log in as, one per user type
+    ids['logins'] = {'admin': users[0]['email'],
+                     'provider': users[1]['email'],
+                     'payer': users[1 + sizes['providers']]['email']}
+
+    _insert(models.User.__table__, users)
+    _insert(models.Provider.__table__, providers)
+    _insert(models.Payer.__table__, payers)
+    _insert(models.custom_payers, [{'provider_id': provider_id,
+                                    'payer_id': payer_id}
+                                   for provider_id in ids['providers']
+                                   for payer_id in ids['payers']])
+
+    ids['doctors'] = id_range(models.Doctor,
+                              sizes['doctors'] * sizes['providers'])
+    _insert(models.Doctor.__table__, [
+        {'id': doctor_id, 'name': 'Dr. %s' % _word(rnd).title(),
+         'doctor_type': rnd.choice(['general', 'specialist']),
+         'provider_id': ids['providers'][num % sizes['providers']]}
+        for num, doctor_id in enumerate(ids['doctors'])])
+
+    ids['terminals'] = id_range(models.Terminal,
+                                sizes['terminals'] * sizes['providers'])
+    terminals = []
+    for num, terminal_id in enumerate(ids['terminals']):
+        terminals.append({'id': terminal_id, 'status': 'active',
+                          'serial_number': 'SN%08d' % terminal_id,
+                          'model': 'T1', 'version': '1.0',
+                          'location': 'Desk %d' % num,
+                          'device_uid': 'terminal-%d' % terminal_id,
+                          'last_update': now,
+                          'provider_id': ids['providers'][
+                              num % sizes['providers']]})
+    _insert(models.Terminal.__table__, terminals)
+    ids['terminal_uids'] = [t['device_uid'] for t in terminals]
+    ids['terminal_providers'] = dict((t['id'], t['provider_id'])
+                                     for t in terminals)
+
+    ids['icd_codes'] = id_range(models.ICDCode, sizes['icd_codes'])
+    icd_codes = [{'id': icd_id,
+                  'code': '%s%02d.%d' % (rnd.choice(string.ascii_uppercase),
+                                         rnd.randint(0, 99), rnd.randint(0, 9)),
+                  'description': ' '.join(_word(rnd) for _ in range(3)),
+                  'common_term': _word(rnd)}
+                 for icd_id in ids['icd_codes']]
+    _insert(models.ICDCode.__table__, icd_codes)
+    # the claims refer to a small set of the most common codes
+    common_codes = [icd['code'] for icd in icd_codes[:50]] or [None]
+
+    ids['members'] = id_range(models.Member, sizes['members'])
+    members, links = [], []
+    for member_id in ids['members']:
+        start_date = now - timedelta(days=rnd.randint(30, 3650))
+        members.append({'id': member_id,
+                        'name': '%s %s' % (_word(rnd, 6).title(),
+                                           _word(rnd, 9).title()),
+                        'email': 'member.%d@example.com' % member_id,
+                        'tel': '+6%09d' % member_id,
+                        'gender': rnd.choice(['male', 'female']),
+                        'marital_status': rnd.choice(['married', 'single']),
+                        'dob': now - timedelta(days=rnd.randint(6000, 30000)),
+                        'start_date': start_date,
+                        'effective_date': start_date,
+                        'mature_date': start_date + timedelta(days=3650),
+                        'exit_date': start_date + timedelta(days=3650),
+                        'policy_number': 'POL%09d' % member_id,
+                        'national_id': 'NID%09d' % member_id,
+                        'card_number': 'CARD%09d' % member_id,
+                        'patient_type': rnd.choice(['in', 'out']),
+                        'device_uid': 'member-%d' % member_id})
+        links.append({'member_id': member_id,
+                      'provider_id': rnd.choice(ids['providers'])})
+    _insert(models.Member.__table__, members)
+    _insert(models.custom_members, links)
+    # the lookup's index, the Core inserts don't record the changes
+    lookup.index_members(ids['members'], db.session)
+
+    # the claims are spread over the last 30 months
+    ids['claims'] = id_range(models.Claim, sizes['claims'])
+    claims = []
+    for claim_id in ids['claims']:
+        terminal_id = rnd.choice(ids['terminals'])
+        claims.append({'id': claim_id,
+                       'status': rnd.choice(['Open', 'Closed']),
+                       'claim_number': 'CL%09d' % claim_id,
+                       'claim_type': rnd.choice(['in-patient',
+                                                 'out-patient']),
+                       'datetime': now - timedelta(
+                           minutes=rnd.randint(0, 30 * 30 * 24 * 60)),
+                       'amount': str(rnd.choice([50, 100, 250, 500, 1000])),
+                       'icd_code': rnd.choice(common_codes),
+                       'provider_id': ids['terminal_providers'][terminal_id],
+                       'terminal_id': terminal_id,
+                       'member_id': rnd.choice(ids['members']),
+                       'new_claim': 0})
+
+    ids['gops'] = id_range(models.GuaranteeOfPayment,
+                           min(sizes['gops'], sizes['claims']))
+    gops, gop_icd_codes = [], []
+    for num, gop_id in enumerate(ids['gops']):
+        claim = claims[num]
+        created = claim['datetime']
+        claim['gop_id'] = gop_id
+        gops.append({'id': gop_id,
+                     'provider_id': claim['provider_id'],
+                     'payer_id': rnd.choice(ids['payers']),
+                     'member_id': claim['member_id'],
+                     'status': rnd.choice(['pending', 'approved',
+                                           'declined']),
+                     'reason': rnd.choice(['general', 'specialist',
+                                           'emergency', 'scheduled']),
+                     'doctor_name': 'Dr. %s' % _word(rnd).title(),
+                     'quotation': float(claim['amount']),
+                     'admission_date': created,
+                     'admission_time': created,
+                     'timestamp': created,
+                     'timestamp_edited': created + timedelta(
+                         minutes=rnd.randint(5, 3 * 24 * 60))})
+        gop_icd_codes.append({'guarantee_of_payment_id': gop_id,
+                              'icd_code_id': rnd.choice(ids['icd_codes'])})
+
+    _insert(models.GuaranteeOfPayment.__table__, gops)
+    _insert(models.Claim.__table__, claims)
+    _insert(models.custom_icd_codes, gop_icd_codes)
+
+    db.session.commit()
+
+    return ids
@@ -0,0 +1,220 @@
+"""The claims' time series for the dashboard charts. The number of the claims
+and their amount per day, week (from Monday) or month of any date range are
+computed by the database with one grouped query, so no claim is loaded into
+Python. The empty buckets are filled with zeros and, when the range has more
+buckets than the chart's points, the adjacent ones are merged, the counts
+and amounts add up exactly. The series are cached in redis per scope, range,
+bucket and points for CACHE_TIMEOUT. The archived claims are not counted,
+see lifecycle.py."""
+import json
+
+from datetime import date, datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import Date, Float, cast, func, literal_column, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from . import db, models, redis_store
+
+# the seconds the series are cached for
+CACHE_TIMEOUT = 300
+DEFAULT_DAYS = 180
+# the points of a series, the buckets past that are merged
+MAX_POINTS = 120
+POINTS_LIMIT = 1000
+# the longest range, in days
+MAX_DAYS = 366 * 20
+
+DAY, WEEK, MONTH = 'day', 'week', 'month'
+# the buckets, the finest first
+BUCKETS = (DAY, WEEK, MONTH)
+
+
+class bucket(FunctionElement):
+    """The first day of the day, week (from Monday) or month of the
+    datetime, e.g. bucket(Claim.datetime, 'week')"""
+    type = Date()
+    name = 'bucket'
+
+    def __init__(self, value, unit):
+        if unit not in BUCKETS:
+            raise ValueError('the bucket is one of %s' % ', '.join(BUCKETS))
+        self.unit = unit
+        FunctionElement.__init__(self, value)
+
+
+@compiles(bucket)
+def _bucket(element, compiler, **kw):
+    value = compiler.process(element.clauses.clauses[0], **kw)
+    return "CAST(date_trunc('%s', %s) AS DATE)" % (element.unit, value)
+
+
+@compiles(bucket, 'mysql')
+def _bucket_mysql(element, compiler, **kw):
+    value = compiler.process(element.clauses.clauses[0], **kw)
+    if element.unit == DAY:
+        return 'DATE(%s)' % value
+    if element.unit == WEEK:
+        return 'DATE(%s) - INTERVAL WEEKDAY(%s) DAY' % (value, value)
+    return 'DATE(%s) - INTERVAL (DAYOFMONTH(%s) - 1) DAY' % (value, value)
+
+
+@compiles(bucket, 'sqlite')
+def _bucket_sqlite(element, compiler, **kw):
+    value = compiler.process(element.clauses.clauses[0], **kw)
+    if element.unit == DAY:
+        return 'date(%s)' % value
+    if element.unit == WEEK:
+        return "date(%s, '-' || ((CAST(strftime('%%w', %s) AS INTEGER) " \
+               "+ 6) %% 7) || ' days')" % (value, value)
+    return "date(%s, 'start of month')" % value
+
+
+def _as_date(value):
+    # SQLite returns the dates as text
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+def bucket_start(value, unit):
+    """The Python version of bucket()"""
+    value = _as_date(value)
+    if unit == WEEK:
+        return value - timedelta(days=value.weekday())
+    if unit == MONTH:
+        return value.replace(day=1)
+    return value
+
+
+def _next(value, unit):
+    if unit == DAY:
+        return value + timedelta(days=1)
+    if unit == WEEK:
+        return value + timedelta(days=7)
+    return value + relativedelta(months=1)
+
+
+def buckets(start, end, unit):
+    """The first days of the buckets from the start's one to the end's"""
+    found = []
+    value = bucket_start(start, unit)
+    while value <= end:
+        found.append(value)
+        value = _next(value, unit)
+    return found
+
+
+def choose_bucket(start, end, points=MAX_POINTS):
+    """The finest bucket the range fits the points with, unmerged"""
+    for unit in BUCKETS:
+        if len(buckets(start, end, unit)) <= points:
+            return unit
+    return MONTH
+
+
+def downsample(labels, series, points):
+    """Merges the adjacent buckets, each "step" of them to one point,
+    so there are no more than "points". Returns the first labels of the
+    merged buckets, the summed series and the step"""
+    step = max(1, -(-len(labels) // points))
+    if step == 1:
+        return labels, series, step
+    merged = dict((name, [sum(values[i:i + step])
+                          for i in range(0, len(values), step)])
+                  for name, values in series.items())
+    return labels[::step], merged, step
+
+
+def _compute(criteria, start, end, unit, points):
+    Claim = models.Claim
+    claim_bucket = bucket(Claim.datetime, unit).label('bucket')
+    query = select([claim_bucket, func.count(Claim.id),
+                    func.sum(cast(Claim.amount, Float))])\
+            .where(Claim.datetime >= datetime.combine(start,
+                                                      datetime.min.time()))\
+            .where(Claim.datetime < datetime.combine(end + timedelta(days=1),
+                                                     datetime.min.time()))
+    for criterion in criteria:
+        query = query.where(criterion)
+    query = query.group_by(literal_column('bucket'))
+
+    found = dict((_as_date(row[0]), (row[1], row[2] or 0))
+                 for row in db.session.execute(query))
+
+    labels = buckets(start, end, unit)
+    series = {'claims': [found.get(label, (0, 0))[0] for label in labels],
+              'amount': [round(found.get(label, (0, 0))[1], 2)
+                         for label in labels]}
+    labels, series, step = downsample(labels, series, points)
+
+    result = {'start': start.isoformat(),
+              'end': end.isoformat(),
+              'bucket': unit,
+              'step': step,
+              'labels': [label.isoformat() for label in labels]}
+    result.update(series)
+    return result
+
+
+def claim_series(scope, criteria, start=None, end=None, unit=None,
+                 points=MAX_POINTS):
+    """Returns the claims' counts and amounts from the start to the end
+    date (both inclusive, the last DEFAULT_DAYS by default) by the bucket
+    ("day", "week", "month", the finest fitting the points by default):
+    {"labels": the buckets' first days, "claims": [...], "amount": [...],
+    "step": the buckets merged per point, ...}. "criteria" are the filters
+    of the Claim columns of the scope, "scope" is its cache key, e.g.
+    "provider:1". Raises ValueError on an invalid range or bucket"""
+    end = end or date.today()
+    start = start or end - timedelta(days=DEFAULT_DAYS - 1)
+    if start > end:
+        raise ValueError('the start is after the end')
+    if (end - start).days > MAX_DAYS:
+        raise ValueError('the range is longer than %d days' % MAX_DAYS)
+    points = max(1, min(points, POINTS_LIMIT))
+    unit = unit or choose_bucket(start, end, points)
+    if unit not in BUCKETS:
+        raise ValueError('the bucket is one of %s' % ', '.join(BUCKETS))
+
+    key = 'claim_series:%s:%s:%s:%s:%d' % (scope, start.isoformat(),
+                                           end.isoformat(), unit, points)
+    try:
+        cached = redis_store.get(key)
+        if cached:
+            return json.loads(cached.decode('utf-8')
+                              if isinstance(cached, bytes) else cached)
+    except Exception:
+        pass
+
+    result = _compute(criteria, start, end, unit, points)
+
+    try:
+        redis_store.set(key, json.dumps(result), ex=CACHE_TIMEOUT)
+    except Exception:
+        pass
+
+    return result
+
+
+def scope_for_user(user, provider_id=None):
+    """The (cache key, criteria) of the claims the user may see: every
+    claim (or the provider's) for the admins, their own for the providers
+    and the ones of their GOPs for the payers, None for the others"""
+    Claim = models.Claim
+    if user.get_role() == 'admin':
+        if provider_id:
+            return 'provider:%d' % provider_id, \
+                   [Claim.provider_id == provider_id]
+        return 'all', []
+    if user.get_type() == 'provider' and user.provider:
+        return 'provider:%d' % user.provider.id, \
+               [Claim.provider_id == user.provider.id]
+    if user.get_type() == 'payer' and user.payer:
+        GOP = models.GuaranteeOfPayment
+        return 'payer:%d' % user.payer.id, \
+               [Claim.gop_id.in_(select([GOP.id])
+                                 .where(GOP.payer_id == user.payer.id))]
+    return None
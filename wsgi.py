@@ -1,6 +1,19 @@
-from project import create_app
+import os
+
+# the gevent workers (e.g. "uwsgi --gevent 1000 --http-websockets") need the
+# standard library patched before anything else is imported, so the sockets,
+# redis and the MySQL driver (mysql+pymysql, see config.py) yield
+if os.environ.get('GEVENT'):
+    from gevent import monkey
+    monkey.patch_all()
+
+from project import changes, create_app, socketio
 
 application = create_app('development')
 
+# the changes committed by the other processes drop this one's caches too
+if application.config['CHANGES_CHANNEL']:
+    socketio.start_background_task(changes.listen, application)
+
 if __name__ == "__main__":
-    create_app('development').run()
\ No newline at end of file
+    create_app('development').run()